@@ -1,9 +1,15 @@
-from typing import List, Optional
+from typing import List, Optional, Sequence, Tuple
 import random
+import math
+import time
 import numpy as np
 
 from game import Game, State
 from neural_network import NNet
+from book import OpeningBook
+from tablebase import Tablebase
+from instrumentation import stats
+import constants as c
 
 
 def move_max(state: State, nnet: NNet) -> tuple:
@@ -32,7 +38,39 @@ def move_weighted(state: State, nnet: NNet) -> tuple:
     return random.choices(moves, weights=weights)[0]
 
 
-def fast_tree_search(state: State, nnet: NNet, move_number: int, depth: int) -> tuple:
+def moves_weighted(states: List[State], nnet: NNet) -> List[tuple]:
+    """
+    Returns a random move for each state like move_weighted, with all states evaluated in a single batch.
+
+    :param states: States to evaluate
+    :param nnet: Neural network used for evaluation
+    :return: List of moves in the same order
+    """
+    return [random.choices(list(policy.keys()), weights=list(policy.values()))[0]
+            for policy, _ in nnet.predictions(states)]
+
+
+def lookup_move(state: State, book: Optional[OpeningBook] = None, tablebases: Sequence[Tablebase] = ()) \
+        -> Optional[tuple]:
+    """
+    Returns a move from the endgame tablebases or the opening book without any search, so it should be tried before
+    running a search.
+
+    :param state: State to look up
+    :param book: Opening book
+    :param tablebases: Endgame tablebases
+    :return: Move or None if the position is neither in a tablebase nor in the book
+    """
+    for tablebase in tablebases:
+        if tablebase.covers(state):
+            return tablebase.best_move(state)
+    if book:
+        return book.move(state)
+    return None
+
+
+def fast_tree_search(state: State, nnet: NNet, move_number: int, depth: int,
+                     prune_margin: Optional[float] = c.DEFAULT_PRUNE_MARGIN) -> tuple:
     """
     For a given start state the moves with the highest policy are evaluated. For each of these the series of most likely
     best moves is considered up to a certain depth. At that depth the predicted values resulting from each initial move
@@ -42,40 +80,292 @@ def fast_tree_search(state: State, nnet: NNet, move_number: int, depth: int) ->
     :param nnet: Neural network used for evaluation
     :param move_number: Number of moves considered for the initial state
     :param depth: Length of the series of moves evaluated going out from each initial move
+    :param prune_margin: A series is counted as lost without further network calls, once the handcrafted evaluation
+        has dropped by more than this number of pawns. None disables this.
     :return: Best move as ((origin_row, origin_column),(target_row,target_column)
     """
-    start_node = _Node(None, state, None)
-    start_node.fetch_prediction(nnet)
-    start_node.create_children(move_number)
-    move_values = {}
-
-    for child in start_node.children:
-        current_node = child
-        value = None
-        for _ in range(depth):
-            if current_node.state.winner == 'draw':
-                value = 0.5
-                break
-            if current_node.state.winner == start_node.state.player:
-                value = 1
+    with stats.session('fast_tree_search'), stats.timer('search'):
+        move_values = _search_move_values(state, nnet, move_number, depth, prune_margin)
+    for move, value in move_values.items():
+        print(f'{state.player} - move:{move}, value:{value}')
+    return max(move_values, key=move_values.get)
+
+
+def search_policy(state: State, nnet: NNet, move_number: int, depth: int, temperature: float = 1.,
+                  prune_margin: Optional[float] = c.DEFAULT_PRUNE_MARGIN) -> dict:
+    """
+    Runs the same search as fast_tree_search, but returns a probability distribution over the evaluated initial moves
+    instead of the best move. The probabilities are proportional to the searched values raised to 1/temperature.
+
+    :param state: State to evaluate
+    :param nnet: Neural network used for evaluation
+    :param move_number: Number of moves considered for the initial state
+    :param depth: Length of the series of moves evaluated going out from each initial move
+    :param temperature: Lower values concentrate the distribution on the best moves
+    :param prune_margin: See fast_tree_search
+    :return: Dict(move: probability)
+    """
+    return search_policies([state], nnet, move_number, depth, temperature, prune_margin)[0]
+
+
+def search_policies(states: List[State], nnet: NNet, move_number: int, depth: int, temperature: float = 1.,
+                    prune_margin: Optional[float] = c.DEFAULT_PRUNE_MARGIN) -> List[dict]:
+    """
+    Runs search_policy for several states at once. The searches advance in lockstep, so the positions of all
+    searches at the same depth are evaluated in a single batch.
+
+    :param states: States to evaluate
+    :return: List of Dict(move: probability) in the same order, see search_policy for the other parameters
+    """
+    policies = []
+    for move_values in _search_many_move_values(states, nnet, move_number, depth, prune_margin):
+        weights = {move: value ** (1 / temperature) for move, value in move_values.items()}
+        weight_sum = sum(weights.values())
+        if not weight_sum:
+            policies.append({move: 1 / len(weights) for move in weights})
+        else:
+            policies.append({move: weight / weight_sum for move, weight in weights.items()})
+    return policies
+
+
+def _search_move_values(state: State, nnet: NNet, move_number: int, depth: int,
+                        prune_margin: Optional[float] = None) -> dict:
+    return _search_many_move_values([state], nnet, move_number, depth, prune_margin)[0]
+
+
+def _search_many_move_values(states: List[State], nnet: NNet, move_number: int, depth: int,
+                             prune_margin: Optional[float] = None) -> List[dict]:
+    start_nodes = [_Node(None, state, None) for state in states]
+    _fetch_predictions(start_nodes, nnet)
+    # one line per initial move as [start node, initial node, current node, value]
+    lines = []
+    for start_node in start_nodes:
+        start_node.create_children(move_number)
+        lines.extend([start_node, child, child, None] for child in start_node.children)
+
+    active = lines
+    for _ in range(depth):
+        pending = []
+        for line in active:
+            line[3] = _final_value(line[0].state, line[2].state, prune_margin)
+            if line[3] is None:
+                pending.append(line)
+        _fetch_predictions([line[2] for line in pending], nnet)
+        for line in pending:
+            current_node = line[2]
+            line[3] = current_node.value
+            current_node.create_children(1)
+            line[2] = current_node.children[0]
+        active = pending
+
+    move_values = {start_node: {} for start_node in start_nodes}
+    for start_node, child, _, value in lines:
+        move_values[start_node][child.move] = value
+    return [move_values[start_node] for start_node in start_nodes]
+
+
+def _final_value(start_state: State, state: State, prune_margin: Optional[float]) -> Optional[float]:
+    # value of a finished series from the perspective of the start player, None if the series continues
+    if state.winner == 'draw':
+        return 0.5
+    if state.winner == start_state.player:
+        return 1
+    if state.winner == Game.swap_player(start_state.player):
+        return 0
+    # only checked with the start player to move, so that recaptures are not pruned
+    if prune_margin is not None and state.player == start_state.player \
+            and _evaluation_loss(start_state, state) > prune_margin:
+        return 0
+    return None
+
+
+def _fetch_predictions(nodes: List['_Node'], nnet: NNet) -> None:
+    for node, (policy, value) in zip(nodes, nnet.predictions([node.state for node in nodes])):
+        node.policy, node.value = policy, value
+
+
+def alpha_beta_search(state: State, nnet: Optional[NNet] = None, max_depth: int = c.DEFAULT_SEARCH_DEPTH,
+                      time_limit: Optional[float] = None, evaluation: str = 'handcrafted',
+                      policy_depth: int = c.DEFAULT_POLICY_ORDERING_DEPTH) -> tuple:
+    """
+    Negamax search with alpha-beta pruning and iterative deepening. Leaves are extended by a quiescence search over
+    captures. Moves are ordered by the policy of the network close to the root and by captures, killer moves and the
+    history heuristic elsewhere.
+
+    :param state: State to search
+    :param nnet: Neural network used for move ordering and for evaluation='network', optional otherwise
+    :param max_depth: Maximal search depth in half moves
+    :param time_limit: Stops the search after this number of seconds, the best move of the deepest completed
+        iteration is returned
+    :param evaluation: 'handcrafted' for the material and piece-square evaluation of the states, see
+        State.evaluation, or 'network' for the value head of the network
+    :param policy_depth: Number of half moves from the root for which the policy is used for move ordering
+    :return: Best move as ((origin_row, origin_column),(target_row,target_column)
+    """
+    with stats.session('alpha_beta_search'), stats.timer('search'):
+        return _AlphaBeta(nnet, evaluation, policy_depth, time_limit).search(state, max_depth)
+
+
+class _SearchTimeout(Exception):
+    pass
+
+
+class _AlphaBeta:
+    def __init__(self, nnet: Optional[NNet], evaluation: str, policy_depth: int, time_limit: Optional[float]):
+        if evaluation not in ('handcrafted', 'network'):
+            raise ValueError('Evaluation has to be handcrafted or network!')
+        if evaluation == 'network' and nnet is None:
+            raise ValueError('Network evaluation needs a network!')
+        self.nnet = nnet
+        self.evaluation = evaluation
+        self.policy_depth = policy_depth if nnet else 0
+        self.deadline = time.perf_counter() + time_limit if time_limit else None
+
+        self.nodes = 0
+        self.killers = {}
+        self.history = {}
+        # network outputs are cached, as iterative deepening visits the same positions again
+        self._predictions = {}
+
+    def search(self, state: State, max_depth: int) -> tuple:
+        if self.nnet is not None:
+            # the input planes of the network follow the moves along the searched lines
+            state = state.copy()
+            state.track_planes()
+        moves = list(Game.get_legal_moves(state))
+        if not moves:
+            raise ValueError('No legal moves!')
+        best_move = moves[0]
+        for depth in range(1, max_depth + 1):
+            try:
+                score, best_move = self._search_root(state, moves, depth, best_move)
+            except _SearchTimeout:
                 break
-            if current_node.state.winner == Game.swap_player(start_node.state.player):
-                value = 0
+            print(f'{state.player} - depth:{depth}, move:{best_move}, score:{score:.2f}, nodes:{self.nodes}')
+            if abs(score) >= c.MATE_SCORE - max_depth:
                 break
+        stats.count('search_nodes', self.nodes)
+        return best_move
 
-            current_node.fetch_prediction(nnet)
-            value = current_node.value
-            current_node.create_children(1)
-            current_node = current_node.children[0]
+    def _search_root(self, state: State, moves: List[tuple], depth: int, previous_best: tuple) -> Tuple[float, tuple]:
+        alpha, beta = -math.inf, math.inf
+        best_move = previous_best
+        for move in self._order(state, moves, 0, previous_best):
+            score = -self._negamax(Game.move(state, *move, update_winner=False), depth - 1, -beta, -alpha, 1)
+            if score > alpha:
+                alpha, best_move = score, move
+        return alpha, best_move
 
-        print(f'{state.player} - move:{child.move}, value:{value}')
-        move_values[child.move] = value
+    def _negamax(self, state: State, depth: int, alpha: float, beta: float, ply: int) -> float:
+        self._count_node()
+        if state.winner == 'draw' or state.halfmove_clock >= c.FIFTY_MOVE_LIMIT:
+            return 0
+        moves = Game.get_legal_moves(state)
+        if not moves:
+            return -(c.MATE_SCORE - ply) if Game.is_check(state) else 0
+        if depth <= 0:
+            return self._quiescence(state, moves, alpha, beta, ply)
 
-    return max(move_values, key=move_values.get)
+        for move in self._order(state, moves, ply):
+            score = -self._negamax(Game.move(state, *move, update_winner=False), depth - 1, -beta, -alpha, ply + 1)
+            if score >= beta:
+                if not self._is_capture(state, move):
+                    killers = self.killers.setdefault(ply, [])
+                    if move not in killers:
+                        killers.insert(0, move)
+                        del killers[2:]
+                    key = (state.player, move)
+                    self.history[key] = self.history.get(key, 0) + depth * depth
+                return beta
+            alpha = max(alpha, score)
+        return alpha
+
+    def _quiescence(self, state: State, moves: set, alpha: float, beta: float, ply: int) -> float:
+        stand_pat = self._evaluate(state)
+        if stand_pat >= beta:
+            return beta
+        alpha = max(alpha, stand_pat)
+        captures = [move for move in moves if self._is_capture(state, move)]
+        for move in sorted(captures, key=lambda move_: self._capture_order(state, move_), reverse=True):
+            self._count_node()
+            new_state = Game.move(state, *move, update_winner=False)
+            new_moves = Game.get_legal_moves(new_state)
+            if new_moves:
+                score = -self._quiescence(new_state, new_moves, -beta, -alpha, ply + 1)
+            else:
+                # mate or stalemate, scored as in _negamax
+                score = c.MATE_SCORE - (ply + 1) if Game.is_check(new_state) else 0
+            if score >= beta:
+                return beta
+            alpha = max(alpha, score)
+        return alpha
+
+    def _order(self, state: State, moves: set, ply: int, first: Optional[tuple] = None) -> List[tuple]:
+        if ply < self.policy_depth:
+            policy = self._prediction(state)[0]
+            return sorted(moves, key=lambda move: (move == first, policy.get(move, 0)), reverse=True)
+
+        killers = self.killers.get(ply, [])
+
+        def priority(move: tuple) -> tuple:
+            if move == first:
+                return 3, 0
+            if self._is_capture(state, move):
+                return 2, self._capture_order(state, move)
+            if move in killers:
+                return 1, -killers.index(move)
+            return 0, self.history.get((state.player, move), 0)
+
+        return sorted(moves, key=priority, reverse=True)
+
+    def _evaluate(self, state: State) -> float:
+        """
+        Returns the evaluation in pawns from the perspective of the player to move.
+        """
+        if self.evaluation == 'network':
+            value = min(max(float(self._prediction(state)[1]), 1e-6), 1 - 1e-6)
+            # inverse of the sigmoid applied to the training targets
+            return math.log(value / (1 - value)) / c.ALPHA_SIGMOID
+        evaluation = state.evaluation / 100
+        return evaluation if state.player == 'white' else -evaluation
+
+    def _prediction(self, state: State) -> Tuple[dict, float]:
+        key = state.position_key()
+        if key not in self._predictions:
+            self._predictions[key] = self.nnet.prediction(state)
+        else:
+            stats.count('prediction_cache_hits')
+        return self._predictions[key]
+
+    def _count_node(self) -> None:
+        self.nodes += 1
+        if self.deadline and time.perf_counter() > self.deadline:
+            raise _SearchTimeout()
+
+    @staticmethod
+    def _is_capture(state: State, move: tuple) -> bool:
+        if state.entry(move[1]) != 'empty':
+            return True
+        # en passant
+        return state.entry(move[0]).endswith('pawn') and move[0][1] != move[1][1]
+
+    @staticmethod
+    def _capture_order(state: State, move: tuple) -> float:
+        # most valuable victim, least valuable attacker
+        victim = state.entry(move[1])
+        victim_value = c.PIECE_VALUES[victim.split('_')[1]] if victim != 'empty' else 1
+        return victim_value * 10 - c.PIECE_VALUES[state.entry(move[0]).split('_')[1]]
+
+
+def _evaluation_loss(start_state: State, state: State) -> float:
+    # drop of the handcrafted evaluation in pawns from the perspective of the player to move in the start state
+    loss = (start_state.evaluation - state.evaluation) / 100
+    return loss if start_state.player == 'white' else -loss
 
 
 class _Node:
     def __init__(self, parent: Optional['_Node'], state: State, move: Optional[tuple]):
+        stats.count('tree_nodes')
         self.state = state
         self.children: List['_Node'] = []
         self.parent = parent
@@ -94,7 +384,7 @@ class _Node:
             self._create_child(move)
 
     def _create_child(self, move: tuple) -> None:
-        self.children.append(_Node(self, Game.move(self.state, move[0], move[1]), move))
+        self.children.append(_Node(self, Game.move(self.state, *move), move))
 
     def fetch_prediction(self, nnet: NNet) -> None:
         self.policy, self.value = nnet.prediction(self.state)
@@ -0,0 +1,192 @@
+import argparse
+import itertools
+import json
+import re
+from typing import IO, Iterable, Iterator, Optional, Tuple
+
+from game import Game, State
+from neural_network import NNet
+from notation import to_algebraic
+import constants as c
+
+_SAN_PIECES = {'N': 'knight', 'B': 'bishop', 'R': 'rook', 'Q': 'queen', 'K': 'king'}
+_SAN = re.compile(r'^([NBRQK])?([a-h])?([1-8])?x?([a-h])([1-8])(?:=?([NBRQ]))?$')
+_RESULTS = {'1-0', '0-1', '1/2-1/2', '*'}
+_HEADER = re.compile(r'^\[(\w+)\s+"(.*)"\]$')
+
+
+def from_san(state: State, san: str) -> tuple:
+    """
+    Returns the legal move given in standard algebraic notation, e.g. 'Nf3', 'exd5', 'e8=Q+' or 'O-O'.
+
+    :param state: State in which the move is played
+    :param san: Move in standard algebraic notation
+    :return: Move as (origin_position, target_position) or (origin_position, target_position, piece)
+    """
+    san = san.rstrip('+#!?')
+    row = c.ROWS - 1 if state.player == 'white' else 0
+    if san in ('O-O', '0-0', 'O-O-O', '0-0-0'):
+        king_column = 6 if len(san) == 3 else 2
+        candidates = [move for move in Game.iter_legal_moves(state)
+                      if move[0] == (row, 4) and move[1] == (row, king_column)
+                      and state.entry(move[0]) == f'{state.player}_king']
+    else:
+        match = _SAN.match(san)
+        if not match:
+            raise ValueError(f'Move not valid: {san}')
+        piece, column, rank, target_column, target_rank, promotion = match.groups()
+        piece = f'{state.player}_{_SAN_PIECES[piece] if piece else "pawn"}'
+        target = (c.ROWS - int(target_rank), ord(target_column) - ord('a'))
+        promotion = _SAN_PIECES[promotion] if promotion else None
+        candidates = [move for move in Game.iter_legal_moves(state)
+                      if move[1] == target and state.entry(move[0]) == piece
+                      and (column is None or move[0][1] == ord(column) - ord('a'))
+                      and (rank is None or move[0][0] == c.ROWS - int(rank))
+                      and (move[2] if len(move) == 3 else None) == promotion]
+    if len(candidates) != 1:
+        raise ValueError(f'Move {"ambiguous" if candidates else "not legal"}: {san}')
+    return candidates[0]
+
+
+def iter_fen_positions(lines: Iterable[str]) -> Iterator[Tuple[dict, State]]:
+    """
+    Reads one position in FEN notation per line. Empty lines are ignored and invalid ones skipped with a message.
+
+    :param lines: Lines of a file
+    :return: Iterator((info, state)) with info as Dict('fen': FEN string)
+    """
+    for line_number, line in enumerate(lines, 1):
+        fen = line.strip()
+        if not fen:
+            continue
+        try:
+            state = State(fen)
+        # the FEN import raises NameError for unknown pieces
+        except (ValueError, NameError) as e:
+            print(f'Skipped line {line_number}: {e}')
+            continue
+        yield {'fen': fen}, state
+
+
+def iter_pgn_positions(lines: Iterable[str]) -> Iterator[Tuple[dict, State]]:
+    """
+    Replays the games of a PGN file and yields every position before a move, including the move played. Games are
+    read one at a time, so the file can be of any size. Comments, variations and annotations are ignored, a game with
+    an invalid move is skipped from there on with a message.
+
+    :param lines: Lines of a file
+    :return: Iterator((info, state)) with info as Dict('fen', 'game', 'ply', 'played')
+    """
+    game_number = 0
+    for headers, sans in _iter_pgn_games(lines):
+        game_number += 1
+        try:
+            state = State(headers.get('FEN', c.DEFAULT_POSITION))
+            for ply, san in enumerate(sans):
+                move = from_san(state, san)
+                yield {'fen': state.to_fen(), 'game': game_number, 'ply': ply, 'played': to_algebraic(move)}, state
+                state = Game.move(state, *move)
+        except (ValueError, NameError) as e:
+            print(f'Skipped rest of game {game_number}: {e}')
+
+
+def _iter_pgn_games(lines: Iterable[str]) -> Iterator[Tuple[dict, list]]:
+    # (headers, moves in SAN) of every game, comments in braces may span several lines
+    headers, sans = {}, []
+    comment, variation = False, 0
+    for line in lines:
+        line = line.strip()
+        if not comment and not variation and line.startswith('['):
+            if sans:
+                yield headers, sans
+                headers, sans = {}, []
+            match = _HEADER.match(line)
+            if match:
+                headers[match.group(1)] = match.group(2)
+            continue
+        for token in re.split(r'(\{|\}|\(|\)|;|\s+)', line):
+            if not token or token.isspace():
+                continue
+            if comment:
+                comment = token != '}'
+            elif token == '{':
+                comment = True
+            elif token == ';':
+                break
+            elif token == '(':
+                variation += 1
+            elif token == ')':
+                variation = max(variation - 1, 0)
+            elif variation or token.startswith('$'):
+                continue
+            elif token in _RESULTS:
+                yield headers, sans
+                headers, sans = {}, []
+            else:
+                # move numbers as '12.' or '12...' may be attached to the move
+                san = re.sub(r'^\d+\.+', '', token)
+                if san:
+                    sans.append(san)
+    if sans:
+        yield headers, sans
+
+
+def analyse(positions: Iterable[Tuple[dict, State]], nnet: NNet, output: IO[str],
+            batch_size: int = c.ANALYSIS_BATCH_SIZE, top_k: int = c.ANALYSIS_TOP_K) -> int:
+    """
+    Evaluates positions in batches and writes one JSON line per position to the output. Only a single batch is held in
+    memory at a time. Positions in which the game is over are skipped.
+
+    :param positions: Iterator((info, state)), e.g. from iter_fen_positions() or iter_pgn_positions()
+    :param output: Writable text file
+    :param top_k: Number of moves of the policy which are written
+    :return: Number of evaluated positions
+    """
+    positions = iter(positions)
+    number = 0
+    while True:
+        chunk = list(itertools.islice(positions, batch_size))
+        if not chunk:
+            return number
+        batch = [(info, state) for info, state in chunk if not Game.get_winner(state)]
+        for (info, _), (policy, value) in zip(batch, nnet.predictions([state for _, state in batch])):
+            moves = sorted(policy, key=policy.get, reverse=True)[:top_k]
+            output.write(json.dumps({
+                **info,
+                'move': to_algebraic(moves[0]),
+                'value': round(float(value), 5),
+                'policy': {to_algebraic(move): round(float(policy[move]), 5) for move in moves},
+            }) + '\n')
+        number += len(batch)
+        print(f'Analysed {number} positions.')
+
+
+def analyse_file(input_path: str, output_path: str, nnet: NNet, file_format: Optional[str] = None,
+                 batch_size: int = c.ANALYSIS_BATCH_SIZE, top_k: int = c.ANALYSIS_TOP_K) -> int:
+    """
+    Evaluates all positions of a FEN or PGN file, see analyse().
+
+    :param file_format: 'fen' or 'pgn', by default taken from the file extension
+    :return: Number of evaluated positions
+    """
+    file_format = file_format or ('pgn' if input_path.lower().endswith('.pgn') else 'fen')
+    if file_format not in ('fen', 'pgn'):
+        raise ValueError(f'Unknown file format: {file_format}')
+    with open(input_path) as input_file, open(output_path, 'w') as output:
+        positions = iter_pgn_positions(input_file) if file_format == 'pgn' else iter_fen_positions(input_file)
+        return analyse(positions, nnet, output, batch_size, top_k)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluates the positions of a FEN or PGN file with a network and '
+                                                 'writes the best move, value and top policy moves as JSON lines.')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--format', choices=['fen', 'pgn'], default=None)
+    parser.add_argument('--model-name', default=c.DEFAULT_MODEL_NAME)
+    parser.add_argument('--batch-size', type=int, default=c.ANALYSIS_BATCH_SIZE)
+    parser.add_argument('--top-k', type=int, default=c.ANALYSIS_TOP_K)
+    args = parser.parse_args()
+
+    analyse_file(args.input, args.output, NNet(model_name=args.model_name, inference_only=True), args.format,
+                 args.batch_size, args.top_k)
@@ -0,0 +1,225 @@
+import numpy as np
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import time
+from typing import Callable, List, Optional, Sequence
+
+from game import Game, State
+from neural_network import NNet
+from matches import fast_match, fast_matches
+import constants as c
+
+BATCH_SIZES = (1, 8, 64, 256)
+# opening, middlegame and endgame positions for the engine and search benchmarks
+BENCHMARK_POSITIONS = (
+    c.DEFAULT_POSITION,
+    'r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1',
+    '8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1',
+)
+
+
+def benchmark_architecture(nnet: NNet, examples: Optional[list] = None, batch_sizes: Sequence[int] = BATCH_SIZES,
+                           repetitions: int = 10) -> dict:
+    """
+    Measures the forward pass latency of a network at different batch sizes, its number of parameters and, if
+    examples are given, its losses on them.
+
+    :param nnet: Network to benchmark
+    :param examples: Held-out examples as List[(state,(policy,value))]
+    :param batch_sizes: Batch sizes for the latency measurement
+    :param repetitions: Number of timed forward passes per batch size, the median is reported
+    :return: Dict with the architecture, 'parameters', 'latency_ms' per batch size and the losses
+    """
+    result = {'model_name': nnet.model_name, 'architecture': nnet.architecture,
+              'parameters': int(nnet.model.count_params()), 'latency_ms': {}}
+    for batch_size in batch_sizes:
+        x = np.random.randint(0, 2, size=(batch_size, c.ROWS, c.COLUMNS, 6 * 2 + 6)).astype(np.float32)
+        nnet.model.predict(x, verbose=0)  # warm up
+        timings = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            nnet.model.predict(x, verbose=0)
+            timings.append(time.perf_counter() - start)
+        result['latency_ms'][batch_size] = float(np.median(timings)) * 1000
+    if examples:
+        result.update(nnet.evaluate(examples))
+    return result
+
+
+def benchmark_engine(positions: Sequence[str] = BENCHMARK_POSITIONS, duration: float = 1.) -> dict:
+    """
+    Measures the throughput of the game implementation and the input encoding on fixed positions.
+
+    :param positions: FEN strings of the positions
+    :param duration: Seconds each measurement runs for
+    :return: Dict with 'legal_moves_per_s' (full generations), 'moves_per_s' (Game.move), 'encodes_per_s' (full
+        encoding), 'move_encodes_per_s' (Game.move followed by the encoding of the new state) and
+        'incremental_move_encodes_per_s' (the same for states which track their input planes, so the difference to
+        move_encodes_per_s is the gain of the incremental update)
+    """
+    states = [State(position) for position in positions]
+    moves = [(state, move) for state in states for move in Game.get_legal_moves(state)]
+    tracked_moves = []
+    for state in states:
+        tracked = state.copy()
+        tracked.track_planes()
+        tracked_moves.extend((tracked, move) for move in Game.get_legal_moves(state))
+
+    def generate(state: State) -> None:
+        # without the cache of the state, which would make every generation after the first free
+        state = state.copy(planes=False)
+        state.move_cache = None
+        Game.get_legal_moves(state)
+
+    def move_and_encode(entry: tuple) -> None:
+        # the encoding of a tracked state only returns its planes, which Game.move has updated
+        NNet._to_binary_state(Game.move(entry[0], *entry[1], update_winner=False))
+
+    return {
+        'legal_moves_per_s': _rate(states, generate, duration),
+        'moves_per_s': _rate(moves, lambda entry: Game.move(entry[0], *entry[1]), duration),
+        'encodes_per_s': _rate(states, NNet._to_binary_state, duration),
+        'move_encodes_per_s': _rate(moves, move_and_encode, duration),
+        'incremental_move_encodes_per_s': _rate(tracked_moves, move_and_encode, duration),
+    }
+
+
+def benchmark_search(nnet: NNet, positions: Sequence[str] = BENCHMARK_POSITIONS,
+                     move_number: int = c.DEFAULT_SELF_PLAY_WIDTH, depth: int = c.DEFAULT_SELF_PLAY_DEPTH) -> dict:
+    """
+    Measures the time per move of ai.fast_tree_search on fixed positions.
+
+    :param nnet: Network used for the search
+    :param positions: FEN strings of the positions
+    :param move_number: Number of moves considered for each position
+    :param depth: Search depth
+    :return: Dict with 'search_s_per_move' per position and its mean
+    """
+    import ai
+    timings = {}
+    for position in positions:
+        start = time.perf_counter()
+        # the search prints the value of every move
+        with contextlib.redirect_stdout(io.StringIO()):
+            ai.fast_tree_search(State(position), nnet, move_number, depth)
+        timings[position] = time.perf_counter() - start
+    return {'search_s_per_move': timings, 'mean_search_s_per_move': float(np.mean(list(timings.values())))}
+
+
+def benchmark_matches(nnet: NNet, matches: int = 8, sequential_matches: int = 3) -> dict:
+    """
+    Measures the number of matches of a network against itself per minute, once played one after another with
+    matches.fast_match and once in lockstep with matches.fast_matches. The length of the games varies, so the
+    spread of the sequential matches is reported as well.
+
+    :param nnet: Network playing both sides
+    :param matches: Number of matches played in lockstep
+    :param sequential_matches: Number of matches played one after another
+    :return: Dict with 'sequential_matches_per_min', its standard deviation over the single matches
+        'sequential_matches_per_min_std' and 'lockstep_matches_per_min'
+    """
+    timings = []
+    for _ in range(sequential_matches):
+        start = time.perf_counter()
+        fast_match(nnet, nnet)
+        timings.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    fast_matches(nnet, nnet, matches)
+    return {'sequential_matches_per_min': sequential_matches * 60 / sum(timings),
+            'sequential_matches_per_min_std': float(np.std([60 / timing for timing in timings])),
+            'lockstep_matches_per_min': matches * 60 / (time.perf_counter() - start)}
+
+
+def run_suite(architecture: Optional[dict] = None, batch_sizes: Sequence[int] = BATCH_SIZES, duration: float = 1.,
+              matches: int = 8) -> dict:
+    """
+    Runs all benchmarks with a randomly initialised network, so no weights, Stockfish or database are needed.
+
+    :param architecture: Architecture of the network, see c.DEFAULT_ARCHITECTURE
+    :param batch_sizes: Batch sizes for the latency measurement
+    :param duration: Seconds each engine measurement runs for
+    :param matches: Number of matches played in lockstep
+    :return: Dict with the commit, the time and the results of each benchmark
+    """
+    nnet = NNet(model_name='untrained', load_data=False, architecture=architecture)
+    return {
+        'commit': _commit(),
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'engine': benchmark_engine(duration=duration),
+        'inference': benchmark_architecture(nnet, batch_sizes=batch_sizes),
+        'search': benchmark_search(nnet),
+        'matches': benchmark_matches(nnet, matches),
+    }
+
+
+def _rate(items: Sequence, function: Callable, duration: float) -> float:
+    # calls per second, cycling through the items until the duration has passed
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        for item in items:
+            function(item)
+        calls += len(items)
+    return calls / (time.perf_counter() - start)
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_results(results: List[dict]) -> None:
+    for result in results:
+        latencies = ', '.join(f'{batch}: {latency:.1f}ms' for batch, latency in result['latency_ms'].items())
+        losses = f", policy loss: {result['policy_loss']:.4f}, value loss: {result['value_loss']:.4f}" \
+            if 'policy_loss' in result else ''
+        print(f"{result['model_name']} {result['architecture']}\n"
+              f"    parameters: {result['parameters']}, latency per batch size: {latencies}{losses}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks network architectures, or the engine with --suite.')
+    parser.add_argument('--suite', action='store_true',
+                        help='Runs the offline benchmarks of move generation, encoding, inference, search and matches '
+                             'with an untrained network of the first architecture')
+    parser.add_argument('--models', nargs='*', default=[],
+                        help='Names of trained models, each is loaded with its stored architecture')
+    parser.add_argument('--architectures', nargs='*', default=[],
+                        help='Untrained architectures as JSON, e.g. \'{"filters": 64, "blocks": 3}\'')
+    parser.add_argument('--table', help='Database table with held-out examples for the losses')
+    parser.add_argument('--samples', type=int, default=2000, help='Number of held-out examples')
+    parser.add_argument('--batch-sizes', type=int, nargs='*', default=list(BATCH_SIZES))
+    parser.add_argument('--output', help='Writes the results as JSON to this file')
+    parser.add_argument('--duration', type=float, default=1., help='Seconds per engine measurement of --suite')
+    args = parser.parse_args()
+
+    if args.suite:
+        suite_results = run_suite(json.loads(args.architectures[0]) if args.architectures else None,
+                                  args.batch_sizes, args.duration)
+        print(json.dumps(suite_results, indent=2))
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(suite_results, output_file, indent=2)
+        raise SystemExit
+
+    held_out = None
+    if args.table:
+        from db_connector import Connector
+        held_out = Connector.to_examples(Connector().get_data(args.samples, args.table))
+
+    model_names = args.models if args.models or args.architectures else [c.DEFAULT_MODEL_NAME]
+    nets = [NNet(model_name=model_name) for model_name in model_names]
+    nets += [NNet(model_name='untrained', load_data=False, architecture=json.loads(architecture))
+             for architecture in args.architectures]
+    benchmark_results = [benchmark_architecture(nnet, held_out, args.batch_sizes) for nnet in nets]
+    _print_results(benchmark_results)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(benchmark_results, output_file, indent=2)
@@ -0,0 +1,131 @@
+import numpy as np
+import argparse
+import hashlib
+import os
+from typing import Iterable, Optional, Tuple
+
+from game import Game, State
+import constants as c
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# one record per (position, move), sorted by hash
+RECORD_TYPE = np.dtype([('hash', '<u8'), ('move', '<u2'), ('weight', '<u4')])
+
+
+class OpeningBook:
+    """
+    Opening book mapping positions to moves. The records are stored sorted by position hash in a .npy file, which is
+    memory-mapped, so loading is instant and only the pages touched by lookups are read.
+    """
+
+    def __init__(self, name: str = c.DEFAULT_BOOK):
+        self.name = name
+        self.records = np.load(self.path(name), mmap_mode='r')
+        self._hashes = self.records['hash']
+
+    @staticmethod
+    def path(name: str = c.DEFAULT_BOOK) -> str:
+        return os.path.join(parent_dir, 'lookup', f'{name}.npy')
+
+    @classmethod
+    def exists(cls, name: str = c.DEFAULT_BOOK) -> bool:
+        return os.path.isfile(cls.path(name))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def moves(self, state: State) -> dict:
+        """
+        Returns the book moves of a state with their weights. Moves which are not legal in the state, due to a hash
+        collision, are left out.
+
+        :param state: State to look up
+        :return: Dict(move: weight), empty if the position is not in the book
+        """
+        key = np.uint64(position_hash(state))
+        start, end = np.searchsorted(self._hashes, key, 'left'), np.searchsorted(self._hashes, key, 'right')
+        if start == end:
+            return {}
+        legal_moves = Game.get_legal_moves(state)
+        moves = {}
+        for record in self.records[start:end]:
+            move = decode_move(int(record['move']))
+            if move in legal_moves:
+                moves[move] = moves.get(move, 0) + int(record['weight'])
+        return moves
+
+    def move(self, state: State) -> Optional[tuple]:
+        """
+        Returns the book move with the highest weight for a state, or None if the position is not in the book.
+
+        :param state: State to look up
+        """
+        moves = self.moves(state)
+        if not moves:
+            return None
+        return max(moves, key=moves.get)
+
+    @classmethod
+    def build(cls, entries: Iterable[Tuple[State, tuple, int]], name: str = c.DEFAULT_BOOK,
+              min_pieces: int = c.BOOK_MIN_PIECES) -> 'OpeningBook':
+        """
+        Builds a book and saves it, an existing book with the same name is replaced.
+
+        :param entries: Positions with a move and its weight as Iterable[(state, move, weight)]. Weights of equal
+            positions and moves are added up.
+        :param name: Name of the book
+        :param min_pieces: Positions with fewer pieces on the board are left out
+        :return: The new book
+        """
+        weights = {}
+        for state, move, weight in entries:
+            if sum(code != c.EMPTY for code in state.board) < min_pieces:
+                continue
+            key = (position_hash(state), encode_move(move))
+            weights[key] = weights.get(key, 0) + weight
+
+        records = np.array([(key, move, weight) for (key, move), weight in weights.items()], dtype=RECORD_TYPE)
+        records.sort(order=['hash', 'weight'])
+        path = cls.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, records)
+        return cls(name)
+
+
+def position_hash(state: State) -> int:
+    """
+    Returns a 64 bit hash of a position, equal for positions that are equal under the repetition rule.
+    """
+    return int.from_bytes(hashlib.blake2b(state.position_key(), digest_size=8).digest(), 'little')
+
+
+# moves are packed into 16 bits: origin square, target square and promotion piece (0 if none)
+def encode_move(move: tuple) -> int:
+    code = (move[0][0] * c.COLUMNS + move[0][1]) | (move[1][0] * c.COLUMNS + move[1][1]) << 6
+    if len(move) == 3:
+        code |= (c.PROMOTION_PIECES.index(move[2]) + 1) << 12
+    return code
+
+
+def decode_move(code: int) -> tuple:
+    origin, target, promotion = divmod(code & 63, c.COLUMNS), divmod(code >> 6 & 63, c.COLUMNS), code >> 12
+    if promotion:
+        return origin, target, c.PROMOTION_PIECES[promotion - 1]
+    return origin, target
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Builds the opening book from the training data in the database.')
+    parser.add_argument('--table', default=c.DEFAULT_TABLE)
+    parser.add_argument('--name', default=c.DEFAULT_BOOK)
+    parser.add_argument('--min-pieces', type=int, default=c.BOOK_MIN_PIECES)
+    args = parser.parse_args()
+
+    from db_connector import Connector
+    from notation import from_algebraic
+
+    data = Connector().get_data(None, args.table)
+    book = OpeningBook.build(((State(entry['state']), from_algebraic(entry['move']), 1)
+                              for entry in data.to_dict('records')), args.name, args.min_pieces)
+    print(f'book {args.name} with {len(book)} moves saved to {OpeningBook.path(args.name)}')
@@ -7,6 +7,26 @@ NINE_TIMES_NINE = 'rnbqkqbnr/ppppppppp/9/9/9/9/9/PPPPPPPPP/RNBQKQBNR w KQkq - 0
 WHITE_PIECES = ['white_pawn', 'white_knight', 'white_bishop', 'white_rook', 'white_queen', 'white_king']
 BLACK_PIECES = ['black_pawn', 'black_knight', 'black_bishop', 'black_rook', 'black_queen', 'black_king']
 
+# pieces are stored as integer codes: 0 is an empty square, white pieces are 1-6 and black pieces 7-12
+EMPTY = 0
+PIECE_NAMES = ['empty'] + WHITE_PIECES + BLACK_PIECES
+PIECE_CODES = {piece: code for code, piece in enumerate(PIECE_NAMES)}
+WHITE_CODES = range(1, 7)
+BLACK_CODES = range(7, 13)
+
+# castle rights are stored as bit flags
+WHITE_KING_SIDE = 1
+WHITE_QUEEN_SIDE = 2
+BLACK_KING_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+
+# pawns reaching the last row are promoted to one of these pieces, moves carry it as third element
+PROMOTION_PIECES = ['queen', 'knight', 'bishop', 'rook']
+UNDERPROMOTIONS = PROMOTION_PIECES[1:]
+
+# a game is drawn after this many half moves without a capture or pawn move
+FIFTY_MOVE_LIMIT = 100
+
 COLUMNS = 8
 ROWS = 8
 
@@ -14,10 +34,31 @@ ROWS = 8
 SQUARE_SIZE = 64
 COLOR1 = '#b58863'
 COLOR2 = '#f0d9b5'
+# milliseconds between two checks for results of the engine thread, about 60 times per second
+GUI_POLL_INTERVAL = 16
 
 """Neural Network"""
 DEFAULT_MODEL_NAME = 'model0'
 
+# moves are encoded by origin and target square, queen promotions included
+POLICY_SIZE = (ROWS * COLUMNS) ** 2
+# optional extra outputs for underpromotions, encoded by origin column, target column offset and piece
+UNDERPROMOTION_POLICY_SIZE = POLICY_SIZE + COLUMNS * 3 * len(UNDERPROMOTIONS)
+
+# squeeze_excitation is the reduction ratio of the squeeze-excitation layers, 0 disables them.
+# Dense layers with size 0 are left out. underpromotions adds the underpromotion outputs to the policy, it is off by
+# default to stay compatible with weights trained without them.
+DEFAULT_ARCHITECTURE = {
+    'filters': 256,
+    'blocks': 5,
+    'policy_filters': 256,
+    'policy_dense': 256,
+    'value_filters': 128,
+    'value_dense': 0,
+    'squeeze_excitation': 0,
+    'underpromotions': 0,
+}
+
 ALPHA_SIGMOID = 0.4
 
 """Training"""
@@ -28,10 +69,74 @@ DEFAULT_BATCH_SIZE = 256
 DEFAULT_EPOCHS = 1
 DEFAULT_THRESHOLD = 0
 DEFAULT_TRAINING_NOISE = 0.5
+# share of random promotions in generated games which choose a knight, bishop or rook instead of a queen
+RANDOM_UNDERPROMOTION_RATE = 0.1
+
+DEFAULT_GATING = 'fixed'
+DEFAULT_SPRT_ELO0 = 0
+DEFAULT_SPRT_ELO1 = 50
+DEFAULT_SPRT_ALPHA = 0.05
+DEFAULT_SPRT_BETA = 0.05
+DEFAULT_SPRT_MAX_MATCHES = 200
+
+DEFAULT_REPLAY_BUFFER_SIZE = 200000
+DEFAULT_SELF_PLAY_GAMES = 25
+DEFAULT_SELF_PLAY_SAMPLE = 50000
+DEFAULT_SELF_PLAY_WIDTH = 3
+DEFAULT_SELF_PLAY_DEPTH = 2
+DEFAULT_SELF_PLAY_TEMPERATURE = 1.
+DEFAULT_SELF_PLAY_MAX_MOVES = 160
+DEFAULT_SELF_PLAY_PARALLEL = 128
+
+"""Search"""
+# material values in pawns for the evaluation without network
+PIECE_VALUES = {'pawn': 1, 'knight': 3, 'bishop': 3, 'rook': 5, 'queen': 9, 'king': 0}
+# score of a mate in pawns, reduced by the number of half moves until the mate
+MATE_SCORE = 1000
+
+DEFAULT_SEARCH_DEPTH = 4
+DEFAULT_SEARCH_TIME = 5.
+# the policy of the network is used for move ordering up to this number of half moves from the root
+DEFAULT_POLICY_ORDERING_DEPTH = 2
+# lines of fast_tree_search losing more pawns by the handcrafted evaluation are not evaluated further
+DEFAULT_PRUNE_MARGIN = 5.
+
+"""Lookup"""
+DEFAULT_BOOK = 'book'
+# positions with fewer pieces are not stored in the opening book
+BOOK_MIN_PIECES = 24
+# endgames solved by the tablebase, each is a king and one piece against a lone king
+TABLEBASE_ENDGAMES = ['KQK', 'KRK']
+
+"""Server"""
+SERVER_HOST = '127.0.0.1'
+SERVER_PORT = 8765
+# seconds a prediction waits for concurrent requests to join its batch
+SERVER_BATCH_WINDOW = 0.005
+SERVER_MAX_BATCH = 256
+SERVER_SEARCH_THREADS = 4
+# seconds between two checks of the weights for changes
+SERVER_RELOAD_INTERVAL = 2.
+
+"""Analysis"""
+# positions evaluated in one batch by core/analysis.py
+ANALYSIS_BATCH_SIZE = 512
+ANALYSIS_TOP_K = 3
+
+"""Instrumentation"""
+# folder in which a JSON report of the counters and timers of every search and match is written, None disables it
+INSTRUMENTATION_DIR = None
 
 """Database"""
 DEFAULT_TABLE = 'training_data0'
 
+# 'mysql' for the server below or 'sqlite' for a local file in the data folder, which needs no server
+DATABASE_BACKEND = 'mysql'
+SQLITE_FILE = 'chess.db'
+# the background writer flushes once this many examples are queued or the oldest has waited this many seconds
+WRITER_BATCH_SIZE = 2000
+WRITER_FLUSH_INTERVAL = 10.
+
 HOST_NAME = 'localhost'
 USER_NAME = 'root'
 PASSWORD = 'password'
@@ -1,26 +1,76 @@
-import mysql.connector
-from mysql.connector import Error
 import pandas as pd
-from typing import List, Optional
+import sqlite3
+import os
+import time
+from queue import Queue, Empty
+from threading import Thread
+from typing import List, Optional, Tuple
 
+from game import State
+from notation import from_algebraic
 import constants as c
 
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# statements which differ between the backends
+_DIALECTS = {
+    'mysql': {
+        'placeholder': '%s',
+        'insert_ignore': 'INSERT IGNORE INTO',
+        'upsert': 'ON DUPLICATE KEY UPDATE',
+        'new_value': 'VALUES({column})',
+        'random': 'RAND()',
+        'id_column': 'id INT(11) NOT NULL AUTO_INCREMENT,',
+        'id_key': 'PRIMARY KEY (ID)',
+    },
+    'sqlite': {
+        'placeholder': '?',
+        'insert_ignore': 'INSERT OR IGNORE INTO',
+        'upsert': 'ON CONFLICT({key}) DO UPDATE SET',
+        'new_value': 'excluded.{column}',
+        'random': 'RANDOM()',
+        'id_column': 'id INTEGER PRIMARY KEY,',
+        'id_key': None,
+    },
+}
+
 
 class Connector:
     """
-    Allows inserting and retrieving training data from a MySQL database.
+    Allows inserting and retrieving training data from a database. The backend is either a MySQL server, set up with
+    the connection in constants.py, or an SQLite file, which needs no server.
     """
-    def __init__(self):
+    def __init__(self, backend: str = c.DATABASE_BACKEND, path: Optional[str] = None):
+        """
+        :param backend: 'mysql' or 'sqlite'
+        :param path: Database file of the SQLite backend, defaults to c.SQLITE_FILE in the data folder
+        """
+        if backend not in _DIALECTS:
+            raise ValueError(f'Unknown database backend: {backend}')
+        self.backend = backend
+        self.dialect = _DIALECTS[backend]
         self.connection = None
-        try:
-            self.connection = mysql.connector.connect(
-                host=c.HOST_NAME,
-                user=c.USER_NAME,
-                passwd=c.PASSWORD,
-                database=c.DATABASE,
-            )
-        except Error as e:
-            print(f"The error '{e}' occurred")
+        if backend == 'mysql':
+            import mysql.connector
+            self._error = mysql.connector.Error
+            try:
+                self.connection = mysql.connector.connect(
+                    host=c.HOST_NAME,
+                    user=c.USER_NAME,
+                    passwd=c.PASSWORD,
+                    database=c.DATABASE,
+                )
+            except self._error as e:
+                print(f"The error '{e}' occurred")
+        else:
+            self._error = sqlite3.Error
+            path = path or os.path.join(parent_dir, 'data', c.SQLITE_FILE)
+            if path != ':memory:':
+                os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            # write ahead logging lets readers continue while examples are inserted
+            self.connection.execute('PRAGMA journal_mode=WAL;')
+            self.connection.execute('PRAGMA synchronous=NORMAL;')
 
     def insert_examples(self, examples: List[tuple], table: str) -> None:
         """
@@ -30,14 +80,37 @@ class Connector:
         :param table: Name of the database table
         """
         self._create_training_data_table(table)
-        for ex in examples:
-            self._send_query(
-                f"INSERT INTO {table} (STATE, MOVE, VAL)"
-                f"VALUES ('{ex[0]}', '{ex[1][0]}', '{ex[1][1]}');",
-                print_out_errors=False
-            )
+        # duplicate states are skipped by the unique index, use insert_positions() to keep their targets
+        self._send_many(
+            f"{self.dialect['insert_ignore']} {table} (state, move, val) VALUES ({self._placeholders(3)});",
+            [(ex[0], ex[1][0], float(ex[1][1])) for ex in examples]
+        )
         print(f'Inserted {len(examples)} examples.')
 
+    def insert_positions(self, examples: List[tuple], table: str) -> None:
+        """
+        Inserts training examples into a position store, which keeps one row per state with the number of visits,
+        the sum of the values and the frequency of every move. Duplicate states are aggregated, both within the
+        examples and with the states already stored, in a single bulk upsert per table.
+
+        :param examples: List of examples as List[(state,(policy, value))] with the state as FEN string and the policy
+            as move in algebraic notation
+        :param table: Name of the position store, the moves are stored in the table {table}_moves
+        """
+        self._create_position_tables(table)
+        positions, moves = self._aggregate(examples)
+        self._send_many(
+            f"INSERT INTO {table} (state, visits, val_sum) VALUES ({self._placeholders(3)}) "
+            f"{self._upsert('state', 'visits', 'val_sum')};",
+            positions
+        )
+        self._send_many(
+            f"INSERT INTO {table}_moves (state, move, visits) VALUES ({self._placeholders(3)}) "
+            f"{self._upsert('state, move', 'visits')};",
+            moves
+        )
+        print(f'Inserted {len(examples)} examples into {len(positions)} positions.')
+
     def get_data(self, limit: Optional[int], table: str) -> pd.DataFrame:
         """
         Returns a random sample of training examples as s pandas DataFrame.
@@ -47,9 +120,76 @@ class Connector:
         :return: Pandas DataFrame with examples as ['state', 'move', 'val']
         """
         return self._retrieve_data(
-            f"SELECT state, move, val FROM {table} ORDER BY RAND() {f'LIMIT {limit}' if limit else ''};"
+            f"SELECT state, move, val FROM {table} ORDER BY {self.dialect['random']} "
+            f"{f'LIMIT {limit}' if limit else ''};"
         )
 
+    def get_positions(self, limit: Optional[int], table: str) -> pd.DataFrame:
+        """
+        Returns a random sample of positions from a position store as pandas DataFrame.
+
+        :param limit: Number of positions, None gives all positions in the table
+        :param table: Name of the position store
+        :return: Pandas DataFrame with positions as ['state', 'move', 'val', 'visits', 'policy']. 'val' is the
+            average value, 'move' the most frequent move and 'policy' the frequencies of all moves as
+            Dict(move: frequency).
+        """
+        df = self._retrieve_data(
+            f"SELECT p.state, p.visits, p.val_sum / p.visits AS val, m.move, m.visits AS move_visits "
+            f"FROM (SELECT * FROM {table} ORDER BY {self.dialect['random']} "
+            f"{f'LIMIT {limit}' if limit else ''}) AS p "
+            f"JOIN {table}_moves AS m ON m.state = p.state;"
+        )
+        return self._to_positions(df)
+
+    @staticmethod
+    def to_examples(df: pd.DataFrame) -> list:
+        """
+        Converts the result of get_data() or get_positions() into training examples.
+
+        :param df: Pandas DataFrame with examples or positions
+        :return: List((state, (move, value))) with the move frequencies as Dict(move: frequency) for positions
+        """
+        examples = []
+        for entry in df.to_dict('records'):
+            state = State(entry['state'])
+            if 'policy' in entry:
+                move = {from_algebraic(move_): frequency for move_, frequency in entry['policy'].items()}
+            else:
+                move = from_algebraic(entry['move'])
+            examples.append((state, (move, entry['val'])))
+        return examples
+
+    @staticmethod
+    def _aggregate(examples: List[tuple]) -> Tuple[List[tuple], List[tuple]]:
+        positions, moves = {}, {}
+        for state, (move, value) in examples:
+            visits, value_sum = positions.get(state, (0, 0.))
+            positions[state] = (visits + 1, value_sum + float(value))
+            moves[(state, move)] = moves.get((state, move), 0) + 1
+        return [(state, *position) for state, position in positions.items()], \
+               [(*key, visits) for key, visits in moves.items()]
+
+    @staticmethod
+    def _to_positions(df: pd.DataFrame) -> pd.DataFrame:
+        # one row per state from one row per (state, move)
+        move_visits = {}
+        for state, move, visits in zip(df['state'], df['move'], df['move_visits']):
+            move_visits.setdefault(state, {})[move] = int(visits)
+        positions = df.drop_duplicates('state')[['state', 'val', 'visits']].reset_index(drop=True)
+        positions['move'] = [max(move_visits[state], key=move_visits[state].get) for state in positions['state']]
+        positions['policy'] = [{move: visits / sum(move_visits[state].values())
+                                for move, visits in move_visits[state].items()} for state in positions['state']]
+        return positions
+
+    def _placeholders(self, number: int) -> str:
+        return ', '.join([self.dialect['placeholder']] * number)
+
+    def _upsert(self, key: str, *columns: str) -> str:
+        # adds the new values of the columns to the stored ones, if a row with the same key exists
+        return self.dialect['upsert'].format(key=key) + ' ' + ', '.join(
+            f"{column} = {column} + {self.dialect['new_value'].format(column=column)}" for column in columns)
+
     def _send_query(self, query: str, print_out=False, print_out_errors=True) -> Optional[List[tuple]]:
         cursor = self.connection.cursor()
         try:
@@ -59,32 +199,159 @@ class Connector:
             if print_out:
                 print('send query successfully')
             return result
-        except Error as e:
+        except self._error as e:
             if print_out_errors:
                 print(f"The error '{e}' occurred")
 
+    def _send_many(self, query: str, rows: List[tuple]) -> None:
+        # a single multi-row statement instead of a round-trip per row
+        if not rows:
+            return
+        cursor = self.connection.cursor()
+        try:
+            cursor.executemany(query, rows)
+            self.connection.commit()
+        except self._error as e:
+            print(f"The error '{e}' occurred")
+
     def _retrieve_data(self, query: str) -> Optional[pd.DataFrame]:
         try:
             df = pd.read_sql(query, self.connection)
             self.connection.commit()
             return df
-        except Error as e:
+        except self._error as e:
             print(f"The error '{e}' occurred")
 
     def _create_training_data_table(self, table: str) -> None:
         self._send_query(
             f"CREATE TABLE IF NOT EXISTS {table} ("
-            f"id INT(11) NOT NULL AUTO_INCREMENT,"
+            f"{self.dialect['id_column']}"
             f"state VARCHAR(100) UNIQUE NOT NULL,"
-            f"move CHAR(4) NOT NULL,"
-            f"val DECIMAL(10,7) NOT NULL,"
-            f"PRIMARY KEY (ID)"
+            f"move VARCHAR(5) NOT NULL,"
+            f"val DECIMAL(10,7) NOT NULL"
+            f"{', ' + self.dialect['id_key'] if self.dialect['id_key'] else ''}"
             f");"
         )
         self._send_query(
             f"CREATE UNIQUE INDEX state_index ON {table}(state);",
             print_out_errors=False
         )
+        if self.backend == 'mysql':
+            # tables created before promotions were stored have 'move CHAR(4)', which would cut off the piece
+            self._send_query(f"ALTER TABLE {table} MODIFY move VARCHAR(5) NOT NULL;")
+
+    def _create_position_tables(self, table: str) -> None:
+        self._send_query(
+            f"CREATE TABLE IF NOT EXISTS {table} ("
+            f"state VARCHAR(100) NOT NULL,"
+            f"visits INT(11) NOT NULL,"
+            f"val_sum DOUBLE NOT NULL,"
+            f"PRIMARY KEY (state)"
+            f");"
+        )
+        self._send_query(
+            f"CREATE TABLE IF NOT EXISTS {table}_moves ("
+            f"state VARCHAR(100) NOT NULL,"
+            f"move VARCHAR(5) NOT NULL,"
+            f"visits INT(11) NOT NULL,"
+            f"PRIMARY KEY (state, move)"
+            f");"
+        )
+
+
+class ExampleWriter:
+    """
+    Inserts training examples from a background thread, so that generating examples and writing them overlap. The
+    writer keeps a single connection and collects the examples of many games, which are flushed in one insert once
+    c.WRITER_BATCH_SIZE examples are queued or the oldest has waited c.WRITER_FLUSH_INTERVAL seconds. Closing the
+    writer, also by leaving a with block, flushes the remaining examples.
+
+    An error stops the worker thread, e.g. a failed connection. It is printed and raised again as RuntimeError by the
+    next put() or close(), so that no examples are lost silently.
+    """
+
+    def __init__(self, table: str = c.DEFAULT_TABLE, aggregate: bool = False, backend: str = c.DATABASE_BACKEND,
+                 path: Optional[str] = None, batch_size: int = c.WRITER_BATCH_SIZE,
+                 flush_interval: float = c.WRITER_FLUSH_INTERVAL):
+        """
+        :param table: Name of the database table
+        :param aggregate: Inserts into a position store, see Connector.insert_positions()
+        :param backend: 'mysql' or 'sqlite'
+        :param path: Database file of the SQLite backend
+        :param batch_size: Number of queued examples which triggers a flush
+        :param flush_interval: Maximal time in seconds an example is queued
+        """
+        self.table = table
+        self.aggregate = aggregate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.error = None
+        self._queue = Queue()
+        # the connection is opened in the worker thread, which is the only one using it
+        self._thread = Thread(target=self._run, args=(backend, path), daemon=True)
+        self._thread.start()
+
+    def put(self, examples: List[tuple]) -> None:
+        """
+        Queues examples for insertion and returns immediately.
+
+        :param examples: List of examples as List[(state,(policy, value))]
+        """
+        self._check()
+        self._queue.put(examples)
 
+    def close(self) -> None:
+        """
+        Writes all queued examples and stops the worker thread.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._check()
+
+    def _check(self) -> None:
+        if self.error is not None:
+            raise RuntimeError(f'Example writer stopped after {self.written} examples: {self.error}') from self.error
+
+    def __enter__(self) -> 'ExampleWriter':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def _run(self, backend: str, path: Optional[str]) -> None:
+        try:
+            self._write(backend, path)
+        except Exception as e:
+            self.error = e
+            print(f"The error '{e}' occurred, the example writer stopped")
 
+    def _write(self, backend: str, path: Optional[str]) -> None:
+        connector = Connector(backend, path)
+        pending = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            try:
+                examples = self._queue.get(timeout=timeout)
+            except Empty:
+                examples = []
+            if examples is None:
+                break
+            if examples and not pending:
+                deadline = time.monotonic() + self.flush_interval
+            pending.extend(examples)
+            if pending and (len(pending) >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(connector, pending)
+                pending, deadline = [], None
+        self._flush(connector, pending)
 
+    def _flush(self, connector: Connector, examples: List[tuple]) -> None:
+        if not examples:
+            return
+        if self.aggregate:
+            connector.insert_positions(examples, self.table)
+        else:
+            connector.insert_examples(examples, self.table)
+        self.written += len(examples)
@@ -0,0 +1,98 @@
+from typing import List
+
+import constants as c
+
+# piece-square tables in centipawns from white's perspective, the first row is the eighth rank
+_PIECE_SQUARE_TABLES = {
+    'pawn': [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        50, 50, 50, 50, 50, 50, 50, 50,
+        10, 10, 20, 30, 30, 20, 10, 10,
+        5, 5, 10, 25, 25, 10, 5, 5,
+        0, 0, 0, 20, 20, 0, 0, 0,
+        5, -5, -10, 0, 0, -10, -5, 5,
+        5, 10, 10, -20, -20, 10, 10, 5,
+        0, 0, 0, 0, 0, 0, 0, 0,
+    ],
+    'knight': [
+        -50, -40, -30, -30, -30, -30, -40, -50,
+        -40, -20, 0, 0, 0, 0, -20, -40,
+        -30, 0, 10, 15, 15, 10, 0, -30,
+        -30, 5, 15, 20, 20, 15, 5, -30,
+        -30, 0, 15, 20, 20, 15, 0, -30,
+        -30, 5, 10, 15, 15, 10, 5, -30,
+        -40, -20, 0, 5, 5, 0, -20, -40,
+        -50, -40, -30, -30, -30, -30, -40, -50,
+    ],
+    'bishop': [
+        -20, -10, -10, -10, -10, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 10, 10, 5, 0, -10,
+        -10, 5, 5, 10, 10, 5, 5, -10,
+        -10, 0, 10, 10, 10, 10, 0, -10,
+        -10, 10, 10, 10, 10, 10, 10, -10,
+        -10, 5, 0, 0, 0, 0, 5, -10,
+        -20, -10, -10, -10, -10, -10, -10, -20,
+    ],
+    'rook': [
+        0, 0, 0, 0, 0, 0, 0, 0,
+        5, 10, 10, 10, 10, 10, 10, 5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        -5, 0, 0, 0, 0, 0, 0, -5,
+        0, 0, 0, 5, 5, 0, 0, 0,
+    ],
+    'queen': [
+        -20, -10, -10, -5, -5, -10, -10, -20,
+        -10, 0, 0, 0, 0, 0, 0, -10,
+        -10, 0, 5, 5, 5, 5, 0, -10,
+        -5, 0, 5, 5, 5, 5, 0, -5,
+        0, 0, 5, 5, 5, 5, 0, -5,
+        -10, 5, 5, 5, 5, 5, 0, -10,
+        -10, 0, 5, 0, 0, 0, 0, -10,
+        -20, -10, -10, -5, -5, -10, -10, -20,
+    ],
+    'king': [
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -30, -40, -40, -50, -50, -40, -40, -30,
+        -20, -30, -30, -40, -40, -30, -30, -20,
+        -10, -20, -20, -20, -20, -20, -20, -10,
+        20, 20, 0, 0, 0, 0, 20, 20,
+        20, 30, 10, 0, 0, 10, 30, 20,
+    ],
+}
+
+
+def _square_values() -> List[List[int]]:
+    # material plus piece-square value of every piece code on every square, negative for black pieces
+    values = [[0] * (c.ROWS * c.COLUMNS)]
+    for piece in c.PIECE_NAMES[1:]:
+        player, piece_type = piece.split('_')
+        table = _PIECE_SQUARE_TABLES[piece_type]
+        piece_values = []
+        for index in range(c.ROWS * c.COLUMNS):
+            row, column = divmod(index, c.COLUMNS)
+            if player == 'white':
+                piece_values.append(c.PIECE_VALUES[piece_type] * 100 + table[index])
+            else:
+                piece_values.append(-c.PIECE_VALUES[piece_type] * 100 - table[(c.ROWS - 1 - row) * c.COLUMNS + column])
+        values.append(piece_values)
+    return values
+
+
+SQUARE_VALUES = _square_values()
+
+
+def evaluate(board: bytearray) -> int:
+    """
+    Returns the material and piece-square evaluation of a board in centipawns from white's perspective. States keep
+    this evaluation up to date with every move, see State.evaluation, so it only has to be computed for new
+    positions.
+
+    :param board: Board of a State
+    """
+    return sum(SQUARE_VALUES[code][index] for index, code in enumerate(board))
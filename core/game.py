@@ -1,9 +1,25 @@
 import numpy as np
-import copy
-from typing import Optional, Tuple
+import time
+from typing import Iterator, List, Optional, Tuple
 
+from evaluation import SQUARE_VALUES, evaluate
+from input_planes import InputPlanes
+from instrumentation import stats
 import constants as c
 
+_PAWNS = (c.PIECE_CODES['white_pawn'], c.PIECE_CODES['black_pawn'])
+_KINGS = (c.PIECE_CODES['white_king'], c.PIECE_CODES['black_king'])
+_FEN_CHARACTERS = ' PNBRQKpnbrqk'
+# codes of the pieces of a player which attack a square: pawn, knight, king, bishop or queen, rook or queen
+_ATTACKERS = {player: (c.PIECE_CODES[f'{player}_pawn'], c.PIECE_CODES[f'{player}_knight'],
+                       c.PIECE_CODES[f'{player}_king'],
+                       (c.PIECE_CODES[f'{player}_bishop'], c.PIECE_CODES[f'{player}_queen']),
+                       (c.PIECE_CODES[f'{player}_rook'], c.PIECE_CODES[f'{player}_queen']))
+              for player in ('white', 'black')}
+_KNIGHT_STEPS = ((1, 2), (2, 1), (-1, 2), (2, -1), (1, -2), (-2, 1), (-1, -2), (-2, -1))
+_DIAGONAL_STEPS = ((1, 1), (-1, 1), (1, -1), (-1, -1))
+_STRAIGHT_STEPS = ((1, 0), (0, 1), (-1, 0), (0, -1))
+
 
 class Game:
     """
@@ -15,14 +31,19 @@ class Game:
 
     Methods on the state of the current instance:
         game_winner() -> Str,
-        make_move(origin_pos, target_pos) -> None,
-        game_legal_moves() -> Set((origin_pos, target_pos))
+        make_move(origin_pos, target_pos, promotion) -> None,
+        game_legal_moves() -> Set(move)
 
     Class methods:
         get_winner(state) -> Str,
-        move(state, origin_pos, target_pos) -> State,
-        get_legal_moves(state) -> Set((origin_pos, target_pos)),
+        move(state, origin_pos, target_pos, promotion) -> State,
+        get_legal_moves(state) -> Set(move),
+        iter_legal_moves(state) -> Iterator(move),
+        has_legal_move(state) -> Bool,
         is_check(state) -> Bool
+
+    Moves are tuples (origin_pos, target_pos), promotions carry the piece as third element, e.g.
+    ((1, 0), (0, 0), 'knight'). Moves can therefore be applied with make_move(*move).
     """
 
     def __init__(self, position=c.DEFAULT_POSITION):
@@ -46,43 +67,53 @@ class Game:
         """
         if state.winner:
             return state.winner
-        if cls.get_legal_moves(state):
-            return None
+        # a single legal move is enough to know that the game is not over
+        if cls.has_legal_move(state):
+            return 'draw' if state.halfmove_clock >= c.FIFTY_MOVE_LIMIT else None
         if cls.is_check(state):
             return cls.swap_player(state.player)
         return 'draw'
 
     @classmethod
     def is_check(cls, state: 'State') -> bool:
-        if not state.pieces[f'{state.player}_king']:
+        cache = cls._move_cache(state)
+        if cache.check is None:
+            cache.check = cls._in_check(state)
+        return cache.check
+
+    @classmethod
+    def _in_check(cls, state: 'State') -> bool:
+        king_index = state.board.find(c.PIECE_CODES[f'{state.player}_king'])
+        if king_index == -1:
             return False
-        king_pos = next(iter(state.pieces[f'{state.player}_king']))
-        return cls._is_attacked(state, king_pos)
+        return cls._is_attacked(state, divmod(king_index, c.COLUMNS))
 
-    def make_move(self, origin_pos: Tuple[int, int], target_pos: Tuple[int, int]) -> None:
+    def make_move(self, origin_pos: Tuple[int, int], target_pos: Tuple[int, int], promotion: str = 'queen') -> None:
         """
         Makes a move on the current instance of the game. It automatically applies en passant, castling
-        and pawn to queen promotions. Castling is specified by moving the king to squares. This method does not check
+        and promotions. Castling is specified by moving the king to squares. This method does not check
         whether a move is legal!
 
         :param origin_pos: (row, column)
         :param target_pos: (row, column)
+        :param promotion: Piece a pawn reaching the last row is promoted to, see c.PROMOTION_PIECES
         """
-        self.state = self.move(self.state, origin_pos, target_pos)
+        self.state = self.move(self.state, origin_pos, target_pos, promotion)
 
     # this implementation allows taking of own state.pieces and does not check if move is legal
     @classmethod
-    def move(cls, state: 'State', origin_pos: Tuple[int, int], target_pos: Tuple[int, int],
+    def move(cls, state: 'State', origin_pos: Tuple[int, int], target_pos: Tuple[int, int], promotion: str = 'queen',
              update_winner: bool = True) -> 'State':
         """
         Makes a move on an input state and outputs the resulting state. It automatically applies en passant, castling
-        and pawn to queen promotions. Castling is specified by moving the king to squares. This method does not check
+        and promotions. Castling is specified by moving the king to squares. This method does not check
         whether a move is legal!
 
         :param update_winner: Updates the winner attribute of the new State. Option is needed to prevent recursion loop.
         :param state: State
         :param origin_pos: (row, column)
         :param target_pos: (row, column)
+        :param promotion: Piece a pawn reaching the last row is promoted to, see c.PROMOTION_PIECES
         :return: State object
         """
 
@@ -92,49 +123,56 @@ class Game:
             raise ValueError('Target position not on board!')
         if origin_pos == target_pos:
             raise ValueError('Origin and target position cannot be equal!')
-        if state.board[origin_pos[0]][origin_pos[1]] == 'empty':
+        if state.board[origin_pos[0] * c.COLUMNS + origin_pos[1]] == c.EMPTY:
             raise ValueError('Origin position is empty!')
-        state = copy.deepcopy(state)
-        old_state = copy.deepcopy(state)
+        if promotion not in c.PROMOTION_PIECES:
+            raise ValueError('Promotion piece not valid!')
+        if stats.enabled:
+            stats.count('moves')
+        state = state.copy()
+        irreversible = cls._is_irreversible(state, origin_pos, target_pos)
+        castle_rights = state.castle_rights
 
         state = cls._apply_en_passant(state, origin_pos, target_pos)
         state = cls._apply_castling(state, origin_pos, target_pos)
         state = cls._apply_normal_move(state, origin_pos, target_pos)
-        state = cls._apply_promotion(state, target_pos)
+        state = cls._apply_promotion(state, target_pos, promotion)
 
+        state.halfmove_clock = 0 if irreversible else state.halfmove_clock + 1
+        if state.player == 'black':
+            state.fullmove_number += 1
         state.swap_player()
-        state = cls._add_repetition(state, old_state)
+        state = cls._add_repetition(state, irreversible or state.castle_rights != castle_rights)
 
         if update_winner:
             state.winner = cls.get_winner(state)
+            # with the winner and the check status known, the partly generated moves are dropped, so that states kept
+            # in search trees do not hold a suspended generation
+            cache = state.move_cache
+            if cache is not None and not cache.complete:
+                cache.moves, cache.pending = [], None
 
         return state
 
     @classmethod
     def _apply_normal_move(cls, state: 'State', origin_pos: Tuple[int, int], target_pos: Tuple[int, int]) -> 'State':
-        origin_piece = state.entry(origin_pos)
-        tar_get_piece = state.entry(target_pos)
-        state.board[origin_pos[0]][origin_pos[1]] = 'empty'
-        state.pieces[origin_piece].remove(origin_pos)
-
-        state.board[target_pos[0]][target_pos[1]] = origin_piece
-        state.pieces[origin_piece].add(target_pos)
-
-        if tar_get_piece != 'empty':
-            state.pieces[tar_get_piece].remove(target_pos)
-            state.repetition_counter = {}
+        origin_index = origin_pos[0] * c.COLUMNS + origin_pos[1]
+        target_index = target_pos[0] * c.COLUMNS + target_pos[1]
+        origin_piece = state.board[origin_index]
+        tar_get_piece = state.board[target_index]
+        state.set_code(origin_index, c.EMPTY)
+        state.set_code(target_index, origin_piece)
 
         state.castle_rights = cls._update_castle_rights(state.castle_rights, origin_piece, origin_pos, target_pos)
         state.en_passant = cls._update_en_passant(origin_piece, origin_pos, target_pos)
         return state
 
     @staticmethod
-    def _apply_promotion(state: 'State', position: Tuple[int, int]) -> 'State':
-        piece = state.entry(position)
-        if (piece == 'white_pawn' and position[0] == 0) or (piece == 'black_pawn' and position[0] == c.ROWS - 1):
-            state.board[position[0]][position[1]] = f'{state.player}_queen'
-            state.pieces[f'{state.player}_queen'].add(position)
-            state.pieces[f'{state.player}_pawn'].remove(position)
+    def _apply_promotion(state: 'State', position: Tuple[int, int], promotion: str) -> 'State':
+        index = position[0] * c.COLUMNS + position[1]
+        piece = state.board[index]
+        if (piece == _PAWNS[0] and position[0] == 0) or (piece == _PAWNS[1] and position[0] == c.ROWS - 1):
+            state.set_code(index, c.PIECE_CODES[f'{state.player}_{promotion}'])
         return state
 
     @classmethod
@@ -144,16 +182,15 @@ class Game:
         rook_row = origin_pos[0]
         rook_origin_column = 0 if target_pos[1] == 2 else c.COLUMNS - 1
         rook_target_column = 3 if target_pos[1] == 2 else c.COLUMNS - 3
-        if state.entry((rook_row, rook_origin_column)) == 'empty':
+        if state.board[rook_row * c.COLUMNS + rook_origin_column] == c.EMPTY:
             return state
-        state = cls.move(state, (rook_row, rook_origin_column), (rook_row, rook_target_column))
-        state.swap_player()
-        return state
+        # castle rights and en passant are overwritten by the following king move
+        return cls._apply_normal_move(state, (rook_row, rook_origin_column), (rook_row, rook_target_column))
 
     @staticmethod
     def _detect_castling(state: 'State', origin_pos: Tuple[int, int], target_pos: Tuple[int, int]) -> bool:
-        piece = state.entry(origin_pos)
-        if piece not in ('white_king', 'black_king'):
+        piece = state.board[origin_pos[0] * c.COLUMNS + origin_pos[1]]
+        if piece not in _KINGS:
             return False
         if abs(origin_pos[1] - target_pos[1]) == 2:
             return True
@@ -163,66 +200,60 @@ class Game:
     def _apply_en_passant(cls, state: 'State', origin_pos: Tuple[int, int], target_pos: Tuple[int, int]) -> 'State':
         if not cls._detect_en_passant(state, origin_pos, target_pos):
             return state
-        square_to_remove = (origin_pos[0], target_pos[1])
-        piece_to_remove = state.entry(square_to_remove)
-        state.board[square_to_remove[0]][square_to_remove[1]] = 'empty'
-        state.pieces[piece_to_remove].remove(square_to_remove)
+        state.set_code(origin_pos[0] * c.COLUMNS + target_pos[1], c.EMPTY)
         return state
 
     @staticmethod
     def _detect_en_passant(state: 'State', origin_pos: Tuple[int, int], target_pos: Tuple[int, int]) -> bool:
-        piece = state.entry(origin_pos)
-        if piece not in ('white_pawn', 'black_pawn'):
+        piece = state.board[origin_pos[0] * c.COLUMNS + origin_pos[1]]
+        if piece not in _PAWNS:
             return False
-        tar_get_piece = state.entry(target_pos)
-        if tar_get_piece == 'empty':
+        tar_get_piece = state.board[target_pos[0] * c.COLUMNS + target_pos[1]]
+        if tar_get_piece == c.EMPTY:
             if abs(origin_pos[0] - target_pos[0]) == 1 and abs(origin_pos[1] - target_pos[1]) == 1:
                 return True
         return False
 
     @staticmethod
-    def _update_en_passant(origin_piece: str, origin_pos: Tuple[int, int], target_pos: Tuple[int, int]) \
+    def _update_en_passant(origin_piece: int, origin_pos: Tuple[int, int], target_pos: Tuple[int, int]) \
             -> Optional[Tuple[int, int]]:
         en_passant = None
-        if origin_piece in ('white_pawn', 'black_pawn'):
+        if origin_piece in _PAWNS:
             if origin_pos[0] - target_pos[0] in (-2, 2):
                 en_passant = target_pos
         return en_passant
 
     @staticmethod
-    def _update_castle_rights(castle_rights: dict, origin_piece: str, origin_pos: Tuple[int, int],
-                              target_pos: Tuple[int, int]) -> dict:
-        if origin_piece == 'white_king':
-            castle_rights['white_king_side'] = False
-            castle_rights['white_queen_side'] = False
-        if origin_piece == 'black_king':
-            castle_rights['black_king_side'] = False
-            castle_rights['black_queen_side'] = False
+    def _update_castle_rights(castle_rights: int, origin_piece: int, origin_pos: Tuple[int, int],
+                              target_pos: Tuple[int, int]) -> int:
+        if origin_piece == _KINGS[0]:
+            castle_rights &= ~(c.WHITE_KING_SIDE | c.WHITE_QUEEN_SIDE)
+        if origin_piece == _KINGS[1]:
+            castle_rights &= ~(c.BLACK_KING_SIDE | c.BLACK_QUEEN_SIDE)
 
         if (0, 0) in (origin_pos, target_pos):
-            castle_rights['black_queen_side'] = False
+            castle_rights &= ~c.BLACK_QUEEN_SIDE
         if (0, 7) in (origin_pos, target_pos):
-            castle_rights['black_king_side'] = False
+            castle_rights &= ~c.BLACK_KING_SIDE
         if (7, 0) in (origin_pos, target_pos):
-            castle_rights['white_queen_side'] = False
+            castle_rights &= ~c.WHITE_QUEEN_SIDE
         if (7, 7) in (origin_pos, target_pos):
-            castle_rights['white_king_side'] = False
+            castle_rights &= ~c.WHITE_KING_SIDE
 
         return castle_rights
 
+    @staticmethod
+    def _is_irreversible(state: 'State', origin_pos: Tuple[int, int], target_pos: Tuple[int, int]) -> bool:
+        # no position before a capture or pawn move can occur again
+        return state.board[origin_pos[0] * c.COLUMNS + origin_pos[1]] in _PAWNS \
+            or state.board[target_pos[0] * c.COLUMNS + target_pos[1]] != c.EMPTY
+
     @classmethod
-    def _add_repetition(cls, new_state: 'State', old_state: 'State') -> 'State':
-        repetition_counter = old_state.repetition_counter
-        new_board = tuple(tuple(row) for row in new_state.board)
-        if new_board in repetition_counter.keys():
-            if repetition_counter[new_board] == 0:
-                new_state.repetition_counter[new_board] = 1
-            else:
-                new_state.winner = 'draw'
-            return new_state
-        repetition_counter[new_board] = 0
-        new_state.repetition_counter = repetition_counter
-        return new_state
+    def _add_repetition(cls, state: 'State', irreversible: bool) -> 'State':
+        state.history = RepetitionHistory(state.position_key(), None if irreversible else state.history)
+        if state.history.count() >= 3:
+            state.winner = 'draw'
+        return state
 
     @staticmethod
     def _on_board(position: Tuple[int, int]) -> bool:
@@ -234,7 +265,7 @@ class Game:
         """
         Returns all legal move options for the state of the current game instance.
 
-        :return: Set(move) with  move: (origin_position, target_position)
+        :return: Set(move) with  move: (origin_position, target_position) or (origin_position, target_position, piece)
         """
         return self.get_legal_moves(self.state)
 
@@ -244,125 +275,248 @@ class Game:
         Returns all legal move options for a given state.
 
         :param state: State
-        :return: Set(move) with  move: (origin_position, target_position)
+        :return: Set(move) with  move: (origin_position, target_position) or (origin_position, target_position, piece)
+        """
+        return set(cls.iter_legal_moves(state))
+
+    @classmethod
+    def iter_legal_moves(cls, state: 'State') -> Iterator[tuple]:
+        """
+        Yields the legal moves of a given state one by one. Moves are only generated and validated when they are
+        requested, so stopping early saves the work for the remaining moves.
+
+        :param state: State
+        :return: Iterator(move) with move: (origin_position, target_position) or (origin_position, target_position,
+            piece)
+        """
+        # moves found once are kept in the cache of the state, so every consumer of the state shares one generation
+        cache = cls._move_cache(state)
+        index = 0
+        while True:
+            if index < len(cache.moves):
+                yield cache.moves[index]
+                index += 1
+                continue
+            if cache.complete:
+                return
+            if cache.pending is None:
+                # the moves are generated from a snapshot, which cannot be changed by the caller in the meantime
+                cache.pending = cls._generate_legal_moves(state.snapshot())
+            start = time.perf_counter() if stats.enabled else None
+            move_ = next(cache.pending, None)
+            if start is not None:
+                stats.add_time('move_generation', time.perf_counter() - start)
+            if move_ is None:
+                cache.pending, cache.complete = None, True
+            else:
+                cache.moves.append(move_)
+
+    @classmethod
+    def _generate_legal_moves(cls, state: 'State') -> Iterator[tuple]:
+        for move_ in cls._iter_pseudolegal_moves(state):
+            if cls._is_legal(state, move_):
+                yield move_
+
+    @classmethod
+    def _move_cache(cls, state: 'State') -> 'MoveCache':
+        # State.set_code() drops the cache with every change of the board, the key covers the rest of the position
+        key = (state.player, state.castle_rights, state.en_passant)
+        if state.move_cache is None or state.move_cache.key != key:
+            if stats.enabled:
+                stats.count('move_cache_misses')
+            state.move_cache = MoveCache(key)
+        elif stats.enabled:
+            stats.count('move_cache_hits')
+        return state.move_cache
+
+    @classmethod
+    def has_legal_move(cls, state: 'State') -> bool:
+        """
+        Returns whether a given state has any legal move, stopping at the first one found.
+
+        :param state: State
+        """
+        return next(cls.iter_legal_moves(state), None) is not None
+
+    @classmethod
+    def _is_legal(cls, state: 'State', move_: tuple) -> bool:
+        # only the pieces on the board decide whether the own king is left in check, so the clocks, the repetition
+        # history and the promotion piece are not needed
+        new_state = state.copy(planes=False)
+        new_state = cls._apply_en_passant(new_state, move_[0], move_[1])
+        new_state = cls._apply_castling(new_state, move_[0], move_[1])
+        new_state = cls._apply_normal_move(new_state, move_[0], move_[1])
+        return not cls._in_check(new_state)
+
+    @classmethod
+    def get_legal_move_indices(cls, state: 'State', underpromotions: bool = False) -> Tuple[List[tuple], np.array]:
+        """
+        Returns all legal moves for a given state together with their indices in the policy vector of the neural
+        network.
+
+        :param state: State
+        :param underpromotions: Whether the policy vector has underpromotion outputs. Without them underpromotions
+            are left out, so only queen promotions are returned.
+        :return: (List(move), array of policy indices in the same order)
+        """
+        moves = list(cls.get_legal_moves(state))
+        if not underpromotions:
+            moves = [move for move in moves if len(move) == 2 or move[2] == 'queen']
+        return moves, cls.policy_indices(moves, state.player, underpromotions)
+
+    @classmethod
+    def get_legal_mask(cls, state: 'State', underpromotions: bool = False) -> np.array:
+        """
+        Returns a boolean mask over the policy vector of the neural network, which is True for legal moves.
+
+        :param state: State
+        :param underpromotions: Whether the policy vector has underpromotion outputs
+        :return: Array of shape (c.POLICY_SIZE,) or (c.UNDERPROMOTION_POLICY_SIZE,)
         """
-        moves = cls._get_pseudolegal_moves(state)
-        legal_moves = set()
-        for move_ in moves:
-            new_state = cls.move(state, move_[0], move_[1], update_winner=False)
-            new_state.swap_player()
-            if not cls.is_check(new_state):
-                legal_moves.add(move_)
-        return legal_moves
+        mask = np.zeros(c.UNDERPROMOTION_POLICY_SIZE if underpromotions else c.POLICY_SIZE, dtype=bool)
+        mask[cls.get_legal_move_indices(state, underpromotions)[1]] = True
+        return mask
+
+    # policy indices are from the perspective of the player making the move
+    @staticmethod
+    def policy_index(move: tuple, player: str, underpromotions: bool = False) -> int:
+        if underpromotions and len(move) == 3 and move[2] != 'queen':
+            # promotions always start on the second to last row, so the columns and the piece determine the move
+            direction = move[1][1] - move[0][1] + 1
+            return c.POLICY_SIZE + (move[0][1] * 3 + direction) * len(c.UNDERPROMOTIONS) \
+                + c.UNDERPROMOTIONS.index(move[2])
+        if player == 'black':
+            # mirror row of move
+            move = ((c.ROWS - move[0][0] - 1, move[0][1]), (c.ROWS - move[1][0] - 1, move[1][1]))
+        base = (1, c.ROWS, c.ROWS * c.COLUMNS, c.ROWS * c.COLUMNS * c.ROWS)
+        return move[0][0] * base[0] + move[0][1] * base[1] + move[1][0] * base[2] + move[1][1] * base[3]
+
+    @classmethod
+    def policy_indices(cls, moves: List[tuple], player: str, underpromotions: bool = False) -> np.array:
+        if not moves:
+            return np.zeros(0, dtype=int)
+        squares = np.array([move[0] + move[1] for move in moves], dtype=int)
+        if player == 'black':
+            squares[:, [0, 2]] = c.ROWS - squares[:, [0, 2]] - 1
+        indices = squares @ np.array([1, c.ROWS, c.ROWS * c.COLUMNS, c.ROWS * c.COLUMNS * c.ROWS])
+        if underpromotions:
+            for i, move in enumerate(moves):
+                if len(move) == 3:
+                    indices[i] = cls.policy_index(move, player, underpromotions)
+        return indices
 
     @classmethod
     def _get_pseudolegal_moves(cls, state: 'State') -> set:
-        moves = set()
-        for piece_type in c.WHITE_PIECES if state.player == 'white' else c.BLACK_PIECES:
-            for piece_pos in state.pieces[piece_type]:
-                if piece_type in ('white_pawn', 'black_pawn'):
-                    moves.update(cls._get_pawn_moves(piece_type, piece_pos, state))
-                    moves.update(cls._get_pawn_takes(piece_type, piece_pos, state))
-                else:
-                    moves.update(cls._get_normal_moves(piece_type, piece_pos, state))
-
-                if state.castle_rights:
-                    if piece_type in ('white_king', 'black_king'):
-                        moves.update(cls._get_castle_moves(piece_type, piece_pos, state))
-        return moves
+        return set(cls._iter_pseudolegal_moves(state))
+
+    @classmethod
+    def _iter_pseudolegal_moves(cls, state: 'State') -> Iterator[tuple]:
+        # the moves are generated piece by piece
+        own_pieces = c.WHITE_CODES if state.player == 'white' else c.BLACK_CODES
+        for index, code in enumerate(state.board):
+            if code not in own_pieces:
+                continue
+            piece_type = c.PIECE_NAMES[code]
+            piece_pos = divmod(index, c.COLUMNS)
+            if code in _PAWNS:
+                pawn_moves = cls._get_pawn_moves(piece_type, piece_pos, state) \
+                    | cls._get_pawn_takes(piece_type, piece_pos, state)
+                if piece_pos[0] == (1 if code == _PAWNS[0] else c.ROWS - 2):
+                    pawn_moves = {(*move, piece) for move in pawn_moves for piece in c.PROMOTION_PIECES}
+                yield from pawn_moves
+            else:
+                yield from cls._get_normal_moves(piece_type, piece_pos, state)
+
+            if state.castle_rights:
+                if code in _KINGS:
+                    yield from cls._get_castle_moves(piece_type, piece_pos, state)
 
     @classmethod
     def _get_normal_moves(cls, piece: str, position: Tuple[int, int], state: 'State') -> set:
         _opponent_pieces = cls._opponent_pieces(piece)
-        position_array = np.array(list(position))
         moves = set()
         _directions, is_single_step = cls._directions(piece)
 
-        for direction in _directions:
-            current_position = position_array + direction
-            while cls._on_board(current_position):
-                if state.entry(current_position) in _opponent_pieces + ['empty']:
-                    moves.add((position, tuple(current_position)))
-                    if state.entry(current_position) != 'empty':
-                        break
-                    current_position += direction
-                else:
+        for row_step, column_step in _directions:
+            row, column = position[0] + row_step, position[1] + column_step
+            while 0 <= row < c.ROWS and 0 <= column < c.COLUMNS:
+                target = state.board[row * c.COLUMNS + column]
+                if target != c.EMPTY and target not in _opponent_pieces:
                     break
-                if is_single_step:
+                moves.add((position, (row, column)))
+                if target != c.EMPTY or is_single_step:
                     break
+                row, column = row + row_step, column + column_step
         return moves
 
     @staticmethod
-    def _directions(piece: str) -> np.array:
+    def _directions(piece: str) -> Tuple[tuple, bool]:
         # 2nd output is True if piece does only a single step
         if piece in ('white_queen', 'black_queen'):
-            return np.array([[1, 1], [-1, 1], [1, -1], [-1, -1], [1, 0], [0, 1], [-1, 0], [0, -1]]), False
+            return ((1, 1), (-1, 1), (1, -1), (-1, -1), (1, 0), (0, 1), (-1, 0), (0, -1)), False
         if piece in ('white_rook', 'black_rook'):
-            return np.array([[1, 0], [0, 1], [-1, 0], [0, -1]]), False
+            return ((1, 0), (0, 1), (-1, 0), (0, -1)), False
         if piece in ('white_bishop', 'black_bishop'):
-            return np.array([[1, 1], [-1, 1], [1, -1], [-1, -1]]), False
+            return ((1, 1), (-1, 1), (1, -1), (-1, -1)), False
         if piece in ('white_knight', 'black_knight'):
-            return np.array([[1, 2], [2, 1], [-1, 2], [2, -1], [1, -2], [-2, 1], [-1, -2], [-2, -1]]), True
+            return ((1, 2), (2, 1), (-1, 2), (2, -1), (1, -2), (-2, 1), (-1, -2), (-2, -1)), True
         if piece in ('white_king', 'black_king'):
-            return np.array([[1, 1], [-1, 1], [1, -1], [-1, -1], [1, 0], [0, 1], [-1, 0], [0, -1]]), True
+            return ((1, 1), (-1, 1), (1, -1), (-1, -1), (1, 0), (0, 1), (-1, 0), (0, -1)), True
         raise NameError('Piece not valid!')
 
     @classmethod
     def _get_pawn_moves(cls, piece: str, position: Tuple[int, int], state: 'State') -> set:
         moves = set()
-        move_direction = np.array([-1, 0] if piece == 'white_pawn' else [1, 0])
+        move_direction = -1 if piece == 'white_pawn' else 1
 
-        single_move_pos = np.array(list(position)) + move_direction
+        single_move_pos = (position[0] + move_direction, position[1])
         if not cls._on_board(single_move_pos):
             return moves
-        if state.entry(single_move_pos) == 'empty':
-            moves.add((position, tuple(single_move_pos)))
+        if state.board[single_move_pos[0] * c.COLUMNS + single_move_pos[1]] == c.EMPTY:
+            moves.add((position, single_move_pos))
             # check for double pawn move
-            double_move_pos = single_move_pos + move_direction
+            double_move_pos = (single_move_pos[0] + move_direction, position[1])
             if not cls._on_board(double_move_pos):
                 return moves
             if (piece == 'white_pawn' and double_move_pos[0] == c.ROWS - 4) \
                     or (piece == 'black_pawn' and double_move_pos[0] == 3):
-                if state.entry(double_move_pos) == 'empty':
-                    moves.add((position, tuple(double_move_pos)))
+                if state.board[double_move_pos[0] * c.COLUMNS + double_move_pos[1]] == c.EMPTY:
+                    moves.add((position, double_move_pos))
         return moves
 
     @classmethod
     def _get_pawn_takes(cls, piece: str, position: Tuple[int, int], state: 'State') -> set:
         moves = set()
-        position_array = np.array(list(position))
-        take__directions = np.array([[-1, 1], [-1, -1]] if piece == 'white_pawn' else [[1, 1], [1, -1]])
-        for direction in take__directions:
-            target_pos = direction + position_array
+        row = position[0] + (-1 if piece == 'white_pawn' else 1)
+        for column in (position[1] + 1, position[1] - 1):
+            target_pos = (row, column)
             if not cls._on_board(target_pos):
                 continue
-            if state.entry(target_pos) in cls._opponent_pieces(piece):
-                moves.add((position, tuple(target_pos)))
+            if state.board[row * c.COLUMNS + column] in cls._opponent_pieces(piece):
+                moves.add((position, target_pos))
             if state.en_passant:
                 correct_row = (piece == 'white_pawn' and target_pos[0] == 2 and state.en_passant[0] == 3) \
                               or (piece == 'black_pawn' and target_pos[0] == 5 and state.en_passant[0] == 4)
                 correct_column = (target_pos[1] == state.en_passant[1])
                 if correct_row and correct_column:
-                    moves.add((position, tuple(target_pos)))
+                    moves.add((position, target_pos))
         return moves
 
     @classmethod
     def _get_castle_moves(cls, piece: str, position: Tuple[int, int], state: 'State') -> set:
         moves = set()
         if piece == 'white_king':
-            if state.castle_rights['white_king_side']:
-                if cls._check_king_side(position, state):
-                    moves.add((position, (position[0], position[1] + 2)))
-            if state.castle_rights['white_queen_side']:
-                if cls._check_queen_side(position, state):
-                    moves.add((position, (position[0], position[1] - 2)))
-        if piece == 'black_king':
-            if state.castle_rights['black_king_side']:
-                if cls._check_king_side(position, state):
-                    moves.add((position, (position[0], position[1] + 2)))
-            if state.castle_rights['black_queen_side']:
-                if cls._check_queen_side(position, state):
-                    moves.add((position, (position[0], position[1] - 2)))
+            king_side, queen_side = c.WHITE_KING_SIDE, c.WHITE_QUEEN_SIDE
+        elif piece == 'black_king':
+            king_side, queen_side = c.BLACK_KING_SIDE, c.BLACK_QUEEN_SIDE
+        else:
+            return moves
+        if state.castle_rights & king_side:
+            if cls._check_king_side(position, state):
+                moves.add((position, (position[0], position[1] + 2)))
+        if state.castle_rights & queen_side:
+            if cls._check_queen_side(position, state):
+                moves.add((position, (position[0], position[1] - 2)))
         return moves
 
     @classmethod
@@ -373,7 +527,7 @@ class Game:
         for square in ((row, column + 1), (row, column + 2)):
             if not cls._on_board(square):
                 raise ValueError('Castling outside board!')
-            if state.entry(square) != 'empty':
+            if state.board[square[0] * c.COLUMNS + square[1]] != c.EMPTY:
                 return False
             if cls._is_attacked(state, square):
                 return False
@@ -387,32 +541,52 @@ class Game:
         for square in ((row, column - 1), (row, column - 2)):
             if not cls._on_board(square):
                 raise ValueError('Castling outside board!')
-            if state.entry(square) != 'empty':
+            if state.board[square[0] * c.COLUMNS + square[1]] != c.EMPTY:
                 return False
             if cls._is_attacked(state, square):
                 return False
         if not cls._on_board((row, column - 3)):
             raise ValueError('Castling outside board!')
-        if state.entry((row, column - 3)) != 'empty':
+        if state.board[row * c.COLUMNS + column - 3] != c.EMPTY:
             return False
         return True
 
     @classmethod
     def _is_attacked(cls, state: 'State', position: Tuple[int, int]) -> bool:
-        state = copy.deepcopy(state)
-        state.castle_rights = None
-        state.swap_player()
-        opponent_moves = cls._get_pseudolegal_moves(state)
-        for op_move in opponent_moves:
-            if op_move[1] == position:
-                return True
+        # looks from the square for opponent pieces instead of generating all moves of the opponent
+        opponent = cls.swap_player(state.player)
+        pawn, knight, king, diagonal, straight = _ATTACKERS[opponent]
+        board = state.board
+        row, column = position
+
+        pawn_row = row + 1 if opponent == 'white' else row - 1
+        if 0 <= pawn_row < c.ROWS:
+            for pawn_column in (column - 1, column + 1):
+                if 0 <= pawn_column < c.COLUMNS and board[pawn_row * c.COLUMNS + pawn_column] == pawn:
+                    return True
+        for steps, code in ((_KNIGHT_STEPS, knight), (_DIAGONAL_STEPS + _STRAIGHT_STEPS, king)):
+            for row_step, column_step in steps:
+                new_row, new_column = row + row_step, column + column_step
+                if 0 <= new_row < c.ROWS and 0 <= new_column < c.COLUMNS \
+                        and board[new_row * c.COLUMNS + new_column] == code:
+                    return True
+        for steps, codes in ((_DIAGONAL_STEPS, diagonal), (_STRAIGHT_STEPS, straight)):
+            for row_step, column_step in steps:
+                new_row, new_column = row + row_step, column + column_step
+                while 0 <= new_row < c.ROWS and 0 <= new_column < c.COLUMNS:
+                    code = board[new_row * c.COLUMNS + new_column]
+                    if code != c.EMPTY:
+                        if code in codes:
+                            return True
+                        break
+                    new_row, new_column = new_row + row_step, new_column + column_step
         return False
 
     @staticmethod
-    def _opponent_pieces(piece: str) -> Optional[list]:
+    def _opponent_pieces(piece: str) -> Optional[range]:
         if piece == 'empty':
             return None
-        return c.BLACK_PIECES if piece in c.WHITE_PIECES else c.WHITE_PIECES
+        return c.BLACK_CODES if piece in c.WHITE_PIECES else c.WHITE_CODES
 
     @staticmethod
     def _get_player(piece: str) -> str:
@@ -427,35 +601,164 @@ class Game:
         return 'black' if player == 'white' else 'white'
 
 
+class RepetitionHistory:
+    """
+    Stack of position keys since the last irreversible move, used to detect threefold repetitions. Each state
+    references the entry of its own position, which points to the entry of the previous position. Copies and
+    successors of a state share all earlier entries, so a move only adds a single entry and an irreversible move
+    starts a new stack.
+    """
+    __slots__ = ('key', 'previous')
+
+    def __init__(self, key: bytes, previous: Optional['RepetitionHistory'] = None):
+        self.key = key
+        self.previous = previous
+
+    def count(self) -> int:
+        """
+        Returns how often the latest position occurred since the last irreversible move.
+        """
+        count = 1
+        # the same position can only occur with the same player to move, so every second entry is skipped
+        entry = self.previous.previous if self.previous else None
+        while entry:
+            if entry.key == self.key:
+                count += 1
+            entry = entry.previous.previous if entry.previous else None
+        return count
+
+
+class MoveCache:
+    """
+    Legal moves and check status of a position, shared by all consumers of a state and its copies. Moves are added
+    as they are generated, so a partly generated cache is continued by the next consumer. Together with State.winner,
+    which Game.move sets on every new state, the winner follows from the cache without generating moves again.
+
+    Attrs:
+        key (tuple): Player to move, castle rights and en passant of the position, changes of the board replace the
+            cache instead
+        moves (list): Legal moves generated so far
+        pending (Iterator): Generation of the remaining moves, None before the first and after the last move
+        complete (bool): Whether all legal moves are generated
+        check (bool): Whether the player to move is in check, None if not known yet
+    """
+    __slots__ = ('key', 'moves', 'pending', 'complete', 'check')
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.moves = []
+        self.pending = None
+        self.complete = False
+        self.check = None
+
+
 class State:
+    """
+    Position of a game in a compact representation, so that search trees can hold many states.
+
+    Attrs:
+        board (bytearray): Piece codes of all squares row by row, see c.PIECE_CODES
+        player (str): 'white' or 'black'
+        castle_rights (int): Bit flags c.WHITE_KING_SIDE, c.WHITE_QUEEN_SIDE, c.BLACK_KING_SIDE and c.BLACK_QUEEN_SIDE
+        en_passant (tuple): Position of a pawn that has just moved two squares, otherwise None
+        halfmove_clock (int): Number of half moves since the last capture or pawn move
+        fullmove_number (int): Number of the current move, starting at 1 and increased after each move of black
+        evaluation (int): Material and piece-square evaluation in centipawns from white's perspective, updated with
+            every change of the board
+        winner (str): 'white', 'black', 'draw' or None
+        move_cache (MoveCache): Legal moves and check status, dropped by every change of the board
+        planes (InputPlanes): Network input planes updated with every change of the board, only kept after
+            track_planes() was called, otherwise None
+    """
+    __slots__ = ('board', 'player', 'castle_rights', 'en_passant', 'halfmove_clock', 'fullmove_number', 'evaluation',
+                 'winner', 'history', 'move_cache', 'planes')
+
     def __init__(self, fen_string: str):
-        self.board, self.pieces, self.player, self.castle_rights, self.en_passant \
-            = self._import_position(fen_string)
+        (self.board, self.player, self.castle_rights, self.en_passant, self.halfmove_clock,
+         self.fullmove_number) = self._import_position(fen_string)
+        self.evaluation = evaluate(self.board)
         self.winner = None
-        self.repetition_counter = {}
+        self.history = RepetitionHistory(self.position_key())
+        self.move_cache = None
+        self.planes = None
+
+    def copy(self, planes: bool = True) -> 'State':
+        """
+        :param planes: Copies the input planes, if they are tracked. Copies which are only used to test moves can
+            leave them out.
+        """
+        if stats.enabled:
+            stats.count('state_copies')
+        state = State.__new__(State)
+        state.board = self.board[:]
+        state.player = self.player
+        state.castle_rights = self.castle_rights
+        state.en_passant = self.en_passant
+        state.halfmove_clock = self.halfmove_clock
+        state.fullmove_number = self.fullmove_number
+        state.evaluation = self.evaluation
+        state.winner = self.winner
+        state.history = self.history
+        state.move_cache = self.move_cache
+        state.planes = self.planes.copy() if planes and self.planes is not None else None
+        return state
+
+    def snapshot(self) -> 'State':
+        """
+        Returns a copy with only the pieces, the player to move, the castle rights and en passant, which decide the
+        legal moves. Clocks, evaluation, history and input planes are left out.
+        """
+        state = State.__new__(State)
+        state.board = self.board[:]
+        state.player = self.player
+        state.castle_rights = self.castle_rights
+        state.en_passant = self.en_passant
+        state.halfmove_clock = 0
+        state.fullmove_number = 1
+        state.evaluation = 0
+        state.winner = None
+        state.history = None
+        state.move_cache = None
+        state.planes = None
+        return state
+
+    def __copy__(self) -> 'State':
+        return self.copy()
+
+    def __deepcopy__(self, memo: dict) -> 'State':
+        return self.copy()
 
     @classmethod
-    def _import_position(cls, fen_position: str) -> Tuple[list, dict, str, dict, Optional[tuple]]:
-        fen_position = fen_position.split(' ')
+    def _import_position(cls, fen_position: str) -> Tuple[bytearray, str, int, Optional[tuple], int, int]:
+        fen_position = fen_position.split()
+        if len(fen_position) < 4:
+            raise ValueError('Position not valid: Player, castle rights and en passant are missing!')
 
-        board, pieces = cls._import_board_position(fen_position[0])
+        board = cls._import_board_position(fen_position[0])
         player = 'white' if fen_position[1] == 'w' else 'black'
         castle_rights = cls._import_castle_rights(fen_position[2])
-        en_passant = cls._import_en_passant(fen_position[3])
+        en_passant = cls._import_en_passant(fen_position[3], player)
+        # the clocks are optional, as in the truncated FEN strings stored in the database
+        halfmove_clock = int(fen_position[4]) if len(fen_position) > 4 else 0
+        fullmove_number = int(fen_position[5]) if len(fen_position) > 5 else 1
 
-        return board, pieces, player, castle_rights, en_passant
+        return board, player, castle_rights, en_passant, halfmove_clock, fullmove_number
 
     def set_position(self, fen_position: str) -> None:
         try:
-            self.board, self.pieces, self.player, self.castle_rights, self.en_passant \
-                = self._import_position(fen_position)
+            (self.board, self.player, self.castle_rights, self.en_passant, self.halfmove_clock,
+             self.fullmove_number) = self._import_position(fen_position)
+            self.evaluation = evaluate(self.board)
+            self.history = RepetitionHistory(self.position_key())
+            self.move_cache = None
+            if self.planes is not None:
+                self.planes = InputPlanes(self.board)
         except ValueError as E:
             print(f'Error: {E}')
 
     @classmethod
-    def _import_board_position(cls, fen_position: str) -> Tuple[list, dict]:
-        board = [['empty' for _ in range(c.ROWS)] for _ in range(c.COLUMNS)]
-        pieces = {piece: set() for piece in c.WHITE_PIECES + c.BLACK_PIECES}
+    def _import_board_position(cls, fen_position: str) -> bytearray:
+        board = bytearray(c.ROWS * c.COLUMNS)
         column, row = 0, 0
         for character in fen_position:
             if character == '/':
@@ -475,12 +778,12 @@ class State:
                 continue
 
             piece = cls._get_piece(character)
-            board, pieces = cls._add_piece(piece, board, pieces, row, column)
+            board = cls._add_piece(piece, board, row, column)
             column += 1
 
         if column < c.COLUMNS - 1 or row < c.ROWS - 1:
             raise ValueError('Position not valid: Board string too short!')
-        return board, pieces
+        return board
 
     @staticmethod
     def _get_piece(character: chr) -> str:
@@ -501,39 +804,121 @@ class State:
         return switcher.get(character)
 
     @staticmethod
-    def _add_piece(piece: str, board: list, pieces: dict, row: int, column: int) -> Tuple[list, dict]:
-        if board[row][column] != 'empty':
+    def _add_piece(piece: str, board: bytearray, row: int, column: int) -> bytearray:
+        if board[row * c.COLUMNS + column] != c.EMPTY:
             raise ValueError('Target square not empty!')
         if piece not in c.WHITE_PIECES + c.BLACK_PIECES:
             raise NameError('Input piece not valid!')
-        board[row][column] = piece
-        pieces[piece].add((row, column))
-        return board, pieces
+        board[row * c.COLUMNS + column] = c.PIECE_CODES[piece]
+        return board
 
     @staticmethod
-    def _import_castle_rights(fen_position: str) -> dict:
-        castle_rights = {'white_king_side': False, 'white_queen_side': False,
-                         'black_king_side': False, 'black_queen_side': False}
+    def _import_castle_rights(fen_position: str) -> int:
+        castle_rights = 0
         for character in fen_position:
             if character == 'K':
-                castle_rights['white_king_side'] = True
+                castle_rights |= c.WHITE_KING_SIDE
             if character == 'Q':
-                castle_rights['white_queen_side'] = True
+                castle_rights |= c.WHITE_QUEEN_SIDE
             if character == 'k':
-                castle_rights['black_king_side'] = True
+                castle_rights |= c.BLACK_KING_SIDE
             if character == 'q':
-                castle_rights['black_queen_side'] = True
+                castle_rights |= c.BLACK_QUEEN_SIDE
         return castle_rights
 
     @staticmethod
-    def _import_en_passant(algebraic: str) -> Optional[tuple]:
+    def _import_en_passant(algebraic: str, player: str) -> Optional[tuple]:
         if algebraic == '-':
             return None
         alg = list(algebraic)
-        return c.ROWS - int(alg[1]), ord(alg[0]) - 97
+        # FEN notes the square the pawn skipped, the state stores the position of the pawn itself
+        row = c.ROWS - int(alg[1]) + (1 if player == 'white' else -1)
+        return row, ord(alg[0]) - 97
+
+    def to_fen(self) -> str:
+        """
+        Returns the position in FEN notation. The en passant square is only noted if a pawn can capture en passant.
+        """
+        rows = []
+        for row in range(c.ROWS):
+            fen_row, empty = '', 0
+            for code in self.board[row * c.COLUMNS:(row + 1) * c.COLUMNS]:
+                if code == c.EMPTY:
+                    empty += 1
+                    continue
+                if empty:
+                    fen_row += str(empty)
+                    empty = 0
+                fen_row += _FEN_CHARACTERS[code]
+            rows.append(fen_row + str(empty) if empty else fen_row)
+
+        castle_rights = ''.join(character for flag, character in ((c.WHITE_KING_SIDE, 'K'), (c.WHITE_QUEEN_SIDE, 'Q'),
+                                                                  (c.BLACK_KING_SIDE, 'k'), (c.BLACK_QUEEN_SIDE, 'q'))
+                                if self.castle_rights & flag)
+        en_passant = '-'
+        if self._en_passant_capturable():
+            row = self.en_passant[0] - (1 if self.player == 'white' else -1)
+            en_passant = chr(self.en_passant[1] + 97) + str(c.ROWS - row)
+
+        return ' '.join(('/'.join(rows), self.player[0], castle_rights or '-', en_passant, str(self.halfmove_clock),
+                         str(self.fullmove_number)))
+
+    def position_key(self) -> bytes:
+        """
+        Returns a key which is equal for two states if they are the same position in terms of the repetition rule:
+        Same pieces on the same squares, same player to move, same castle rights and the same en passant capture.
+        """
+        en_passant = self.en_passant[1] + 1 if self._en_passant_capturable() else 0
+        return bytes(self.board) + bytes((self.player == 'white', self.castle_rights, en_passant))
+
+    def _en_passant_capturable(self) -> bool:
+        # checks for a pawn of the player to move next to the pawn which has just moved two squares
+        if not self.en_passant:
+            return False
+        row, column = self.en_passant
+        pawn = c.PIECE_CODES[f'{self.player}_pawn']
+        return (column > 0 and self.board[row * c.COLUMNS + column - 1] == pawn) \
+            or (column < c.COLUMNS - 1 and self.board[row * c.COLUMNS + column + 1] == pawn)
+
+    @property
+    def pieces(self) -> dict:
+        """
+        Positions of all pieces as Dict(piece: Set(position)).
+        """
+        pieces = {piece: set() for piece in c.WHITE_PIECES + c.BLACK_PIECES}
+        for index, code in enumerate(self.board):
+            if code != c.EMPTY:
+                pieces[c.PIECE_NAMES[code]].add(divmod(index, c.COLUMNS))
+        return pieces
 
     def entry(self, position: Tuple[int, int]) -> str:
-        return self.board[position[0]][position[1]]
+        return c.PIECE_NAMES[self.board[position[0] * c.COLUMNS + position[1]]]
+
+    def set_entry(self, position: Tuple[int, int], piece: str) -> None:
+        self.set_code(position[0] * c.COLUMNS + position[1], c.PIECE_CODES[piece])
+
+    def set_code(self, index: int, code: int) -> None:
+        """
+        Sets the piece code of a square, updates the evaluation and drops the move cache. All changes of the board
+        have to go through this method.
+
+        :param index: Square as row * c.COLUMNS + column
+        :param code: Piece code, see c.PIECE_CODES
+        """
+        self.evaluation += SQUARE_VALUES[code][index] - SQUARE_VALUES[self.board[index]][index]
+        if self.planes is not None:
+            self.planes.set_code(index, self.board[index], code)
+        self.board[index] = code
+        self.move_cache = None
+
+    def track_planes(self) -> None:
+        """
+        Keeps the network input planes of the board up to date with every following move, which is passed on to all
+        successors and copies of the state. Worth it when consecutive positions are evaluated, e.g. along a game or a
+        line of a search.
+        """
+        if self.planes is None:
+            self.planes = InputPlanes(self.board)
 
     def swap_player(self) -> None:
         self.player = 'black' if self.player == 'white' else 'white'
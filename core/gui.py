@@ -1,14 +1,17 @@
 import tkinter as tk
 from threading import Thread
+from queue import Queue, Empty
 from PIL import Image, ImageTk
-import copy
 import time
 import math
-from typing import Any, Tuple
+from typing import Any, Callable, Optional, Tuple
 import os
 
-from game import Game
+from game import Game, State
 from neural_network import NNet
+from book import OpeningBook
+from tablebase import Tablebase
+from instrumentation import stats
 import constants as c
 import ai
 
@@ -18,24 +21,42 @@ image_dir = f'{os.path.dirname(os.path.abspath(__file__))}\\images'
 class GUI(tk.Frame):
     """
     GUI for chess allowing to make moves, set the players to 'Human' or 'Neural Network' and restarting the game.
+    Moves, legal moves and searches are computed by an engine thread. Its results are queued and picked up by the Tk
+    main thread every c.GUI_POLL_INTERVAL milliseconds, so only the main thread touches the widgets.
     """
-    def __init__(self, ai_width: int, ai_depth: int, fen_position: str = c.DEFAULT_POSITION,  sleep_time: int = 0):
+    def __init__(self, ai_width: int, ai_depth: int, fen_position: str = c.DEFAULT_POSITION,  sleep_time: int = 0,
+                 search: str = 'fast_tree', search_time: float = c.DEFAULT_SEARCH_TIME):
+        """
+        :param search: 'fast_tree' for ai.fast_tree_search or 'alpha_beta' for ai.alpha_beta_search with ai_depth as
+            maximal depth and search_time as time limit in seconds
+        """
         super().__init__()
         self.game = Game(fen_position)
 
         start = time.time()
-        self.nn = NNet()
+        self.nn = NNet(inference_only=True)
         print(f'Loading nn took: {time.time() - start}s')
+        self.book = OpeningBook() if OpeningBook.exists() else None
+        self.tablebases = Tablebase.load_all()
 
         self.images = self._import_images()
 
         self.ai_width = ai_width
         self.ai_depth = ai_depth
+        self.search = search
+        self.search_time = search_time
         self.sleep_time = sleep_time
 
         self.selected = None
-        self.legal_moves = self.game.game_legal_moves()
-        self.ai_lock = False
+        self.legal_moves = set()
+        # moves are not accepted while the engine computes the result of the last one
+        self.waiting = False
+        self.ai_pending = False
+        # results of jobs submitted before a restart are dropped
+        self.generation = 0
+        self.jobs = Queue()
+        self.results = Queue()
+        Thread(target=self._work, daemon=True).start()
 
         """GUI elements"""
         self.header = tk.Label(self)
@@ -71,30 +92,76 @@ class GUI(tk.Frame):
 
         """Bind"""
         self.board.bind('<Button-1>', self._move_event)
+        self.pieces = {}
         self._draw_board()
         self._update_header()
+        self._submit(Game.get_legal_moves, (self.game.state,), self._set_legal_moves)
+        self.after(c.GUI_POLL_INTERVAL, self._poll)
         self.mainloop()
 
-    def _option_trigger(self, _event) -> None:
-        # overwriting the current game to prevent still ongoing threads from interacting
-        state = copy.deepcopy(self.game.state)
-        self.game = Game()
-        self.game.state = state
+    def _work(self) -> None:
+        # engine thread, runs the submitted jobs one after another
+        while True:
+            generation, function, args, callback = self.jobs.get()
+            # an error is handed to the main thread, otherwise the GUI would wait for the result forever
+            try:
+                self.results.put((generation, callback, function(*args), None))
+            except Exception as e:
+                self.results.put((generation, callback, None, e))
+
+    def _submit(self, function: Callable, args: tuple, callback: Callable) -> None:
+        self.jobs.put((self.generation, function, args, callback))
+
+    def _poll(self) -> None:
+        # hands the results of the engine thread to their callbacks on the main thread
+        while True:
+            try:
+                generation, callback, result, error = self.results.get_nowait()
+            except Empty:
+                break
+            if generation != self.generation:
+                continue
+            if error is not None:
+                self._on_error(error)
+            else:
+                callback(result)
+        self.after(c.GUI_POLL_INTERVAL, self._poll)
+
+    def _on_error(self, error: Exception) -> None:
+        # moves are accepted again, the AI is not restarted to not repeat the error until the options change
+        print(f"The error '{error}' occurred in the engine thread")
+        self.waiting = False
+        self.ai_pending = False
+        self.selected = None
+        self.board.delete('highlight')
+        self.header.config(text=f'Engine error: {error}')
 
+    def _option_trigger(self, _event) -> None:
+        if self.ai_pending:
+            # the running search may be for a player who is now human, its result is dropped
+            self.generation += 1
+            self.ai_pending = False
+            self.waiting = False
         self._check_ai()
 
     def _restart(self) -> None:
+        self.generation += 1
         self.game = Game()
         self.board.delete('highlight', 'last_move')
-        self.game.player = 'white'
         self.selected = None
-        self.legal_moves = self.game.game_legal_moves()
+        self.legal_moves = set()
+        self.waiting = False
+        self.ai_pending = False
         self._update_board()
         self._update_header()
+        self._submit(Game.get_legal_moves, (self.game.state,), self._set_legal_moves)
         self._check_ai()
 
+    def _set_legal_moves(self, legal_moves: set) -> None:
+        self.legal_moves = legal_moves
+
     def _move_event(self, event: Any) -> None:
-        if self.game.state.winner or self._is_nnet(self.game.state.player):
+        if self.game.state.winner or self._is_nnet(self.game.state.player) or self.waiting:
             return
         if self.selected:
             target_pos = self._coords_to_grid(event.x, event.y)
@@ -104,16 +171,13 @@ class GUI(tk.Frame):
                 self.selected = None
                 return
 
-            if (self.selected, target_pos) in self.legal_moves:
-                self.game.make_move(self.selected, target_pos)
-                self._highlight_last_move(self.selected, target_pos)
-                self.legal_moves = self.game.game_legal_moves()
-                self._update_header()
-
+            # promotions by the player are always to a queen
+            moves = {(self.selected, target_pos), (self.selected, target_pos, 'queen')} & self.legal_moves
+            if moves:
+                self.waiting = True
+                self._submit(self._play, (self.game.state, moves.pop()), self._on_move)
                 self.selected = None
                 self.board.delete('highlight')
-                self._update_board()
-                self._check_ai()
                 return
         self.board.delete('highlight')
         self._update_board()
@@ -145,26 +209,45 @@ class GUI(tk.Frame):
 
     def _check_ai(self) -> None:
         self._update_header()
-        if self._is_nnet(self.game.state.player) and not self.game.state.winner:
-            if self.ai_lock:
-                return
-            self.ai_lock = True
-            Thread(target=self._ai_move).start()
+        if self._is_nnet(self.game.state.player) and not self.game.state.winner and not self.waiting:
+            self.ai_pending = True
+            self.waiting = True
+            self._submit(self._ai_move, (self.game.state,), self._on_move)
 
-    def _ai_move(self) -> None:
+    def _ai_move(self, state: State) -> Optional[Tuple[tuple, State, set]]:
+        # runs on the engine thread
         start = time.time()
-        move = ai.fast_tree_search(self.game.state, self.nn, self.ai_width, self.ai_depth)
+        # a single report for the lookup and the search, see c.INSTRUMENTATION_DIR
+        with stats.session('ai_move'), stats.timer('ai_move'):
+            move = ai.lookup_move(state, self.book, self.tablebases)
+            if move is None and self.search == 'alpha_beta':
+                move = ai.alpha_beta_search(state, self.nn, self.ai_depth, self.search_time)
+            elif move is None:
+                move = ai.fast_tree_search(state, self.nn, self.ai_width, self.ai_depth)
         print('Calculating move took ', time.time() - start)
+        if move not in Game.get_legal_moves(state):
+            return None
+        return self._play(state, move)
 
-        if move in self.legal_moves:
-            self.game.make_move(move[0], move[1])
+    @staticmethod
+    def _play(state: State, move: tuple) -> Tuple[tuple, State, set]:
+        # runs on the engine thread, the legal moves of the new state are needed for the next selection
+        new_state = Game.move(state, *move)
+        return move, new_state, Game.get_legal_moves(new_state)
+
+    def _on_move(self, result: Optional[Tuple[tuple, State, set]]) -> None:
+        self.waiting = False
+        ai_move = self.ai_pending
+        self.ai_pending = False
+        if result is not None:
+            move, self.game.state, self.legal_moves = result
             self._highlight_last_move(move[0], move[1])
-
-        self.legal_moves = self.game.game_legal_moves()
-        self._update_board()
-        self.ai_lock = False
-        time.sleep(self.sleep_time)
-        self._check_ai()
+            self._update_board()
+        if ai_move and self.sleep_time:
+            self._update_header()
+            self.after(int(self.sleep_time * 1000), self._check_ai)
+        else:
+            self._check_ai()
 
     def _update_header(self) -> None:
         if self.game.state.winner == 'draw':
@@ -194,13 +277,20 @@ class GUI(tk.Frame):
         self._update_board()
 
     def _update_board(self) -> None:
-        self.board.delete('piece')
+        # only the squares whose piece changed are redrawn, self.pieces holds the shown piece and its canvas item
         for row in range(c.ROWS):
             for column in range(c.COLUMNS):
                 piece = self.game.state.entry((row, column))
+                shown, item = self.pieces.get((row, column), ('empty', None))
+                if piece == shown:
+                    continue
+                if item is not None:
+                    self.board.delete(item)
+                    del self.pieces[(row, column)]
                 if piece != 'empty':
                     image_x, image_y = self._get_position(row, column)
-                    self.board.create_image(image_x, image_y, image=self.images[piece], tags='piece', anchor='c')
+                    item = self.board.create_image(image_x, image_y, image=self.images[piece], tags='piece', anchor='c')
+                    self.pieces[(row, column)] = (piece, item)
         self.board.tag_raise('highlight')
         self.board.tag_raise('piece')
 
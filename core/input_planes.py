@@ -0,0 +1,77 @@
+import numpy as np
+from typing import Optional
+
+import constants as c
+
+_PLANES = 6 * 2 + 6
+_EN_PASSANT_PLANE = 16
+# plane of every piece code from the perspective of each player, the own pieces follow the pieces of the opponent
+_WHITE_PLANES = [0] + [(code - 1) % 6 + 6 * int(code in c.WHITE_CODES) for code in range(1, 13)]
+_BLACK_PLANES = [0] + [(code - 1) % 6 + 6 * int(code in c.BLACK_CODES) for code in range(1, 13)]
+
+
+class InputPlanes:
+    """
+    Network input of a board, see NNet._to_binary_state(), for both players at once. The planes are updated square
+    by square with every change of the board instead of being encoded again for every position. The planes of black
+    are stored with flipped rows, so the input of the player to move can be used without copying.
+
+    Attrs:
+        white (np.array): Input planes of shape (rows, columns, planes) with white to move
+        black (np.array): Input planes with black to move
+        en_passant (tuple): En passant position currently marked in the planes of white
+    """
+    __slots__ = ('white', 'black', 'en_passant')
+
+    def __init__(self, board: bytearray):
+        self.white = np.zeros((c.ROWS, c.COLUMNS, _PLANES), dtype=np.float32)
+        self.black = np.zeros((c.ROWS, c.COLUMNS, _PLANES), dtype=np.float32)
+        # four constant planes, which the trained weights expect at 12-15 for white and at 14-17 for black
+        self.white[:, :, 12:16] = 1
+        self.black[:, :, 14:18] = 1
+        self.en_passant = None
+        for index, code in enumerate(board):
+            if code != c.EMPTY:
+                self.set_code(index, c.EMPTY, code)
+
+    def copy(self) -> 'InputPlanes':
+        planes = InputPlanes.__new__(InputPlanes)
+        planes.white = self.white.copy()
+        planes.black = self.black.copy()
+        planes.en_passant = self.en_passant
+        return planes
+
+    def set_code(self, index: int, old_code: int, code: int) -> None:
+        """
+        Replaces the piece on a square.
+
+        :param index: Square as row * c.COLUMNS + column
+        :param old_code: Piece code currently on the square
+        :param code: New piece code, see c.PIECE_CODES
+        """
+        row, column = divmod(index, c.COLUMNS)
+        if old_code != c.EMPTY:
+            self.white[row, column, _WHITE_PLANES[old_code]] = 0
+            self.black[c.ROWS - 1 - row, column, _BLACK_PLANES[old_code]] = 0
+        if code != c.EMPTY:
+            self.white[row, column, _WHITE_PLANES[code]] = 1
+            self.black[c.ROWS - 1 - row, column, _BLACK_PLANES[code]] = 1
+
+    def view(self, player: str, en_passant: Optional[tuple]) -> np.array:
+        """
+        Returns the input planes from the perspective of a player. The array is not copied and changes with the next
+        change of the board.
+
+        :param player: Player to move
+        :param en_passant: En passant position of the state, see State.en_passant
+        """
+        if player == 'black':
+            # the en passant plane is one of the constant planes of black
+            return self.black
+        if en_passant != self.en_passant:
+            if self.en_passant:
+                self.white[self.en_passant[0], self.en_passant[1], _EN_PASSANT_PLANE] = 0
+            if en_passant:
+                self.white[en_passant[0], en_passant[1], _EN_PASSANT_PLANE] = 1
+            self.en_passant = en_passant
+        return self.white
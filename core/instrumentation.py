@@ -0,0 +1,141 @@
+import json
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import constants as c
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# upper bounds in milliseconds of the buckets of the inference latency histogram
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+class Instrumentation:
+    """
+    Counters and timers of the engine, e.g. move generation, state copies, encoding, inference, cache hits and tree
+    size. Recording is off by default and only costs a flag check then. Use the module instance stats, either
+    programmatically with measure() or for every search and match by setting c.INSTRUMENTATION_DIR.
+
+    Attrs:
+        enabled (bool): Whether events are recorded
+        counters (dict): Number of events as Dict(name: count)
+        timers (dict): Timed events as Dict(name: [count, total seconds])
+        batch_sizes (dict): Number of network calls per batch size
+        latencies (list): Number of network calls per bucket of LATENCY_BUCKETS, the last entry counts slower calls
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._session = False
+        self.reset()
+
+    def reset(self) -> None:
+        self.counters = {}
+        self.timers = {}
+        self.batch_sizes = {}
+        self.latencies = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def count(self, name: str, number: int = 1) -> None:
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + number
+
+    def add_time(self, name: str, seconds: float) -> None:
+        if self.enabled:
+            timer = self.timers.setdefault(name, [0, 0.])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        Times the enclosed block, intended for blocks which take much longer than the measurement itself.
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def record_inference(self, batch_size: int, seconds: float) -> None:
+        """
+        Records a forward pass of a network.
+
+        :param batch_size: Number of evaluated states
+        :param seconds: Latency of the call
+        """
+        if not self.enabled:
+            return
+        self.add_time('inference', seconds)
+        self.count('inference_states', batch_size)
+        self.batch_sizes[batch_size] = self.batch_sizes.get(batch_size, 0) + 1
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds * 1000 > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        self.latencies[bucket] += 1
+
+    def report(self) -> dict:
+        """
+        Returns all recorded values as JSON serializable dict.
+        """
+        histogram = {f'<={bound}': number for bound, number in zip(LATENCY_BUCKETS, self.latencies)}
+        histogram[f'>{LATENCY_BUCKETS[-1]}'] = self.latencies[-1]
+        return {
+            'counters': dict(self.counters),
+            'timers': {name: {'count': count, 'total_s': total, 'mean_ms': total / count * 1000}
+                       for name, (count, total) in self.timers.items()},
+            'inference': {
+                'batch_sizes': {str(batch_size): number for batch_size, number in sorted(self.batch_sizes.items())},
+                'latency_histogram_ms': histogram,
+            },
+        }
+
+    def dump(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(self.report(), file, indent=2)
+
+    @contextmanager
+    def measure(self, path: Optional[str] = None) -> Iterator['Instrumentation']:
+        """
+        Records the enclosed block from zero, the values are kept afterwards until the next reset.
+
+        :param path: Writes the report as JSON to this file at the end of the block
+        """
+        enabled = self.enabled
+        self.enabled = True
+        self.reset()
+        try:
+            yield self
+        finally:
+            self.enabled = enabled
+            if path:
+                self.dump(path)
+
+    @contextmanager
+    def session(self, name: str) -> Iterator[None]:
+        """
+        Records a search or match and writes its report to c.INSTRUMENTATION_DIR, if it is set. Sessions within a
+        session are part of the outer one.
+
+        :param name: Prefix of the report file, followed by a timestamp
+        """
+        if c.INSTRUMENTATION_DIR is None or self._session:
+            yield
+            return
+        self._session = True
+        # the suffix keeps the reports of several sessions within a second apart
+        timestamp = f'{time.strftime("%Y%m%d-%H%M%S")}_{time.perf_counter_ns() % 10 ** 6:06d}'
+        path = os.path.join(parent_dir, c.INSTRUMENTATION_DIR, f'{name}_{timestamp}.json')
+        try:
+            with self.measure(path):
+                yield
+        finally:
+            self._session = False
+
+
+stats = Instrumentation()
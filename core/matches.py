@@ -0,0 +1,50 @@
+from typing import List
+
+from game import Game
+from neural_network import NNet
+from instrumentation import stats
+import ai
+
+
+def fast_match(nnet1: NNet, nnet2: NNet) -> int:
+    """
+    :param nnet1: Network playing white
+    :param nnet2: Network playing black
+    :return: 1 if white won, -1 if black won and 0 for a draw
+    """
+    return fast_matches(nnet1, nnet2, 1)[0]
+
+
+def fast_matches(nnet1: NNet, nnet2: NNet, matches: int) -> List[int]:
+    """
+    Plays matches in lockstep, see play_matches().
+
+    :return: Results as in fast_match()
+    """
+    with stats.session('match'), stats.timer('match'):
+        stats.count('matches', matches)
+        games = play_matches(nnet1, nnet2, matches)
+    return [{'white': 1, 'black': -1}.get(game.state.winner, 0) for game in games]
+
+
+def play_matches(nnet1: NNet, nnet2: NNet, matches: int) -> List[Game]:
+    """
+    Plays matches with moves weighted by the policies of the networks. The matches are stopped after 160 half moves.
+
+    :param nnet1: Network playing white
+    :param nnet2: Network playing black
+    :return: Finished games
+    """
+    # all matches have the same player to move, so each half move is a single batch for one of the networks
+    games = [Game() for _ in range(matches)]
+    for game in games:
+        game.state.track_planes()
+    running = games
+    for _ in range(160):
+        if not running:
+            break
+        nn = nnet1 if running[0].state.player == 'white' else nnet2
+        for game, move in zip(running, ai.moves_weighted([game.state for game in running], nn)):
+            game.make_move(*move)
+        running = [game for game in running if not game.state.winner]
+    return games
@@ -1,18 +1,27 @@
 import numpy as np
-import tensorflow as tf
-from tensorflow import keras
-from tensorflow.keras.layers import Dense, Flatten, Conv2D, Input, BatchNormalization, Activation, Add
 import os
 import math
-from typing import Optional, Dict, Tuple, Any
+import json
+import time
+from typing import Optional, Dict, List, Tuple, Any, Union, TYPE_CHECKING
 
 from game import Game, State
+from instrumentation import stats
 import constants as c
 
+if TYPE_CHECKING:
+    from tensorflow import keras
+
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+def _import_tensorflow() -> Any:
+    # TensorFlow is only imported once a model is built, so importing this module stays cheap
+    import tensorflow as tf
+    return tf
+
+
 class NNet:
     """
     Neural network consisting of residual convolutional layers splitting into policy and value outputs.
@@ -20,57 +29,89 @@ class NNet:
 
     def __init__(self, epochs: int = c.DEFAULT_EPOCHS, learning_rate: float = c.DEFAULT_LEARNING_RATE,
                  batch_size: int = c.DEFAULT_BATCH_SIZE, model_name: str = c.DEFAULT_MODEL_NAME,
-                 load_data: bool = True):
+                 load_data: bool = True, architecture: Optional[dict] = None, inference_only: bool = False):
+        """
+        :param architecture: Sizes of the network, see c.DEFAULT_ARCHITECTURE. Missing entries are taken from the
+            architecture stored with the weights of model_name, or from the default.
+        :param inference_only: Skips compiling the model with optimizer and losses, which speeds up loading. The
+            network can only be used for predictions.
+        """
 
         self.epochs = epochs
         self.batch_size = batch_size
 
         self.model_name = model_name
-        self.model = self._get_model(learning_rate, load_data, model_name)
+        self.inference_only = inference_only
+        stored_architecture = self.load_architecture(model_name)
+        if load_data and architecture and os.path.isfile(self._architecture_path(model_name)):
+            conflicts = {key: value for key, value in architecture.items() if stored_architecture.get(key) != value}
+            if conflicts:
+                raise ValueError(f'The architecture {conflicts} does not fit the saved weights of {model_name}: '
+                                 f'{stored_architecture}!')
+        self.architecture = {**stored_architecture, **(architecture or {})}
+        self.model = self._get_model(learning_rate, load_data, model_name, self.architecture, inference_only)
 
     @classmethod
-    def _get_model(cls, learning_rate: float, load_data: bool, model_name: str) -> keras.Model:
+    def _get_model(cls, learning_rate: float, load_data: bool, model_name: str, architecture: dict,
+                   inference_only: bool = False) -> 'keras.Model':
+        tf = _import_tensorflow()
+        from tensorflow import keras
+        from tensorflow.keras.layers import Dense, Flatten, Conv2D, Input, BatchNormalization, Activation
+
+        filters = architecture['filters']
 
         inputs = Input(shape=(c.ROWS, c.COLUMNS, 6 * 2 + 6))
 
-        x = Conv2D(filters=256, kernel_size=(3, 3), padding='same')(inputs)
+        x = Conv2D(filters=filters, kernel_size=(3, 3), padding='same')(inputs)
         x = BatchNormalization(axis=3)(x)
         x = Activation('relu')(x)
 
-        for _ in range(5):
-            x = cls._res_net(inputs=x, filters=256, kernel_size=(3, 3))
+        for _ in range(architecture['blocks']):
+            x = cls._res_net(inputs=x, filters=filters, kernel_size=(3, 3),
+                             squeeze_excitation=architecture['squeeze_excitation'])
 
-        policy = Conv2D(filters=256, kernel_size=(3, 3), padding='valid')(x)
+        policy = Conv2D(filters=architecture['policy_filters'], kernel_size=(3, 3), padding='valid')(x)
         policy = BatchNormalization(axis=3)(policy)
         policy = Activation('relu')(policy)
         policy = Flatten()(policy)
-        policy = Dense(256, activation='relu')(policy)
-        policy = Dense((c.ROWS * c.COLUMNS) ** 2, activation='softmax', name='policy')(policy)
+        if architecture['policy_dense']:
+            policy = Dense(architecture['policy_dense'], activation='relu')(policy)
+        policy = Dense(cls._policy_size(architecture), activation='softmax', name='policy')(policy)
 
-        value = Conv2D(filters=128, kernel_size=(3, 3), padding='valid')(x)
+        value = Conv2D(filters=architecture['value_filters'], kernel_size=(3, 3), padding='valid')(x)
         value = BatchNormalization(axis=3)(value)
         value = Activation('relu')(value)
         value = Flatten()(value)
+        if architecture['value_dense']:
+            value = Dense(architecture['value_dense'], activation='relu')(value)
         value = Dense(1, activation='sigmoid', name='value')(value)
 
         model = keras.Model(inputs=inputs, outputs=[policy, value])
 
-        model.compile(
-            optimizer=tf.optimizers.Adam(learning_rate=learning_rate),
-            loss={'value': 'mean_squared_error',
-                  'policy': 'categorical_crossentropy'}
-        )
+        if not inference_only:
+            model.compile(
+                optimizer=tf.optimizers.Adam(learning_rate=learning_rate),
+                loss={'value': 'mean_squared_error',
+                      'policy': 'categorical_crossentropy'}
+            )
 
-        if load_data:
+        if load_data and not cls._has_weights(model_name):
+            print('No saved weights found')
+        elif load_data:
             try:
-                model.load_weights(f'{parent_dir}\\weights\\{model_name}\\').expect_partial()
-            except ValueError:
-                print('No saved weights found')
+                model.load_weights(cls.weights_path(model_name)).expect_partial()
+            except Exception as e:
+                # e.g. weights of a different architecture, which are not silently replaced by random ones
+                print(f"The error '{e}' occurred while loading the weights of {model_name}. They may not fit the "
+                      f"architecture {architecture}, the network starts from random weights!")
 
         return model
 
     @staticmethod
-    def _res_net(inputs: Any, filters: int, kernel_size: tuple) -> Any:
+    def _res_net(inputs: Any, filters: int, kernel_size: tuple, squeeze_excitation: int = 0) -> Any:
+        from tensorflow.keras.layers import Dense, Conv2D, BatchNormalization, Activation, Add, \
+            GlobalAveragePooling2D, Reshape, Multiply
+
         x_shortcut = inputs
 
         x = Conv2D(filters=filters, kernel_size=kernel_size, padding='same')(inputs)
@@ -80,25 +121,98 @@ class NNet:
         x = Conv2D(filters=filters, kernel_size=kernel_size, padding='same')(x)
         x = BatchNormalization(axis=3)(x)
 
+        if squeeze_excitation:
+            # rescales the channels with weights computed from their global averages
+            se = GlobalAveragePooling2D()(x)
+            se = Dense(max(filters // squeeze_excitation, 1), activation='relu')(se)
+            se = Dense(filters, activation='sigmoid')(se)
+            se = Reshape((1, 1, filters))(se)
+            x = Multiply()([x, se])
+
         x = Add()([x, x_shortcut])
         x = Activation('relu')(x)
         return x
 
+    @staticmethod
+    def _policy_size(architecture: dict) -> int:
+        return c.UNDERPROMOTION_POLICY_SIZE if architecture['underpromotions'] else c.POLICY_SIZE
+
+    @staticmethod
+    def weights_path(model_name: str) -> str:
+        return os.path.join(parent_dir, 'weights', model_name, '')
+
+    @classmethod
+    def load_architecture(cls, model_name: str) -> dict:
+        """
+        Returns the architecture stored with the weights of a model, or the default architecture.
+
+        :param model_name: Name of the model
+        """
+        path = cls._architecture_path(model_name)
+        if not os.path.isfile(path):
+            return dict(c.DEFAULT_ARCHITECTURE)
+        with open(path) as file:
+            return {**c.DEFAULT_ARCHITECTURE, **json.load(file)}
+
+    @classmethod
+    def _architecture_path(cls, model_name: str) -> str:
+        return os.path.join(cls.weights_path(model_name), 'architecture.json')
+
+    @classmethod
+    def _has_weights(cls, model_name: str) -> bool:
+        path = cls.weights_path(model_name)
+        return os.path.isdir(path) and any(entry.is_file() and entry.name != 'architecture.json'
+                                           for entry in os.scandir(path))
+
+    def save_weights(self) -> None:
+        """
+        Saves the weights together with the architecture of the network.
+        """
+        path = self.weights_path(self.model_name)
+        os.makedirs(path, exist_ok=True)
+        self.model.save_weights(path)
+        with open(self._architecture_path(self.model_name), 'w') as file:
+            json.dump(self.architecture, file, indent=2)
+
     def train(self, examples: list, save_data=False) -> None:
         """
         Trains the neural network from a list of training examples.
 
-        :param examples: Training data as List[(state,(policy,value))]
+        :param examples: Training data as List[(state,(policy,value))]. Policy is either the best move or a dict of
+            move probabilities, value is an evaluation in pawns from white's perspective.
         :param save_data: Always saves the new weights if True
         """
-        x_train = np.array([self._to_binary_state(example[0]) for example in examples])
-        y_policy = np.array([self._to_policy_vector(example[1][0], example[0].player) for example in examples])
-        y_value = np.array([self._get_value(example[1][1], example[0].player) for example in examples])
+        if self.inference_only:
+            raise ValueError('Network was loaded for inference only!')
+        x_train, y_policy, y_value = self._to_training_data(examples, self._policy_size(self.architecture))
 
         self.model.fit(x=x_train, y={'policy': y_policy, 'value': y_value},
                        epochs=self.epochs, batch_size=self.batch_size, shuffle=True)
         if save_data:
-            self.model.save_weights(f'{parent_dir}\\weights\\{self.model_name}\\')
+            self.save_weights()
+
+    def evaluate(self, examples: list) -> Dict[str, float]:
+        """
+        Returns the losses of the network on a list of examples without training on them.
+
+        :param examples: Examples in the same format as for train()
+        :return: Dict with 'loss', 'policy_loss' and 'value_loss'
+        """
+        if self.inference_only:
+            raise ValueError('Network was loaded for inference only!')
+        x, y_policy, y_value = self._to_training_data(examples, self._policy_size(self.architecture))
+        losses = self.model.evaluate(x=x, y={'policy': y_policy, 'value': y_value}, batch_size=self.batch_size,
+                                     verbose=0, return_dict=True)
+        return {name: float(loss) for name, loss in losses.items()}
+
+    @classmethod
+    def _to_training_data(cls, examples: list, policy_size: int = c.POLICY_SIZE) \
+            -> Tuple[np.array, np.array, np.array]:
+        x = np.array([cls._to_binary_state(example[0]) for example in examples])
+        y_policy = np.array([cls._to_policy_vector(example[1][0], example[0].player, policy_size)
+                             for example in examples])
+        y_value = np.array([cls._get_value(example[1][1], example[0].player) for example in examples])
+        return x, y_policy, y_value
 
     def prediction(self, state: State) -> Tuple[dict, float]:
         """
@@ -109,33 +223,99 @@ class NNet:
         :return: (policy, vector). Policy is given as probability vector and value between 0 and 1.
         """
         binary_state = self._to_binary_state(state)
-        prediction = self.model.predict(np.array([binary_state]))
+        start = time.perf_counter()
+        prediction = self.model.predict(binary_state[np.newaxis], verbose=0)
+        stats.record_inference(1, time.perf_counter() - start)
 
         policy = self._get_policy(prediction[0][0], state)
         value = prediction[1][0][0]
         return policy, value
 
+    def predictions(self, states: List[State]) -> List[Tuple[dict, float]]:
+        """
+        Returns policy and value predictions for a list of states, evaluated in a single batch. See prediction().
+
+        :param states: States to evaluate
+        :return: List of (policy, value) in the same order
+        """
+        if not states:
+            return []
+        binary_states = np.array([self._to_binary_state(state) for state in states])
+        start = time.perf_counter()
+        prediction = self.model.predict(binary_states, verbose=0)
+        stats.record_inference(len(states), time.perf_counter() - start)
+        policies = self._get_policies(prediction[0], states)
+        return list(zip(policies, prediction[1][:, 0]))
+
+    def export_quantized(self, mode: str = 'float16', representative_states: Optional[list] = None) -> str:
+        """
+        Exports the model as quantized TensorFlow Lite model for inference, which can be loaded with QuantizedNNet.
+
+        :param mode: 'float16' stores the weights as float16, 'int8' quantizes the weights to int8
+        :param representative_states: States used to calibrate the activations for 'int8', without them only the
+            weights are quantized. They should resemble the positions of play, e.g. example_states() of
+            quantized_network.py. The command line uses positions of random games unless a table is given.
+        :return: Path of the exported model
+        """
+        tf = _import_tensorflow()
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if mode == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        elif mode == 'int8':
+            if representative_states:
+                converter.representative_dataset = lambda: (
+                    [np.array([self._to_binary_state(state)], dtype=np.float32)] for state in representative_states
+                )
+        else:
+            raise ValueError(f'Unknown quantization mode: {mode}')
+
+        path = self.quantized_path(self.model_name, mode)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(converter.convert())
+        return path
+
+    @classmethod
+    def quantized_path(cls, model_name: str, mode: str) -> str:
+        return os.path.join(cls.weights_path(model_name), f'model_{mode}.tflite')
+
     # policy vectors are from the perspective of the player making the move
     @classmethod
-    def _to_policy_vector(cls, move: tuple, player: str) -> np.array:
-        policy = np.zeros(c.ROWS ** 2 * c.COLUMNS ** 2)
-        policy[cls._policy_index(move, player)] = 1
+    def _to_policy_vector(cls, move: Union[tuple, dict], player: str, policy_size: int = c.POLICY_SIZE) -> np.array:
+        # without underpromotion outputs, underpromotions are trained on the output of the queen promotion
+        policy = np.zeros(policy_size)
+        underpromotions = policy_size > c.POLICY_SIZE
+        if isinstance(move, dict):
+            # distribution over moves, e.g. from a search
+            for move_, probability in move.items():
+                policy[cls._policy_index(move_, player, underpromotions)] += probability
+            return policy
+        policy[cls._policy_index(move, player, underpromotions)] = 1
         return policy
 
     @staticmethod
-    def _policy_index(move: tuple, player: str) -> int:
-        if player == 'black':
-            # mirror row of move
-            move = ((c.ROWS - move[0][0] - 1, move[0][1]), (c.ROWS - move[1][0] - 1, move[1][1]))
-        base = (1, c.ROWS, c.ROWS * c.COLUMNS, c.ROWS * c.COLUMNS * c.ROWS)
-        return move[0][0] * base[0] + move[0][1] * base[1] + move[1][0] * base[2] + move[1][1] * base[3]
+    def _policy_index(move: tuple, player: str, underpromotions: bool = False) -> int:
+        return Game.policy_index(move, player, underpromotions)
 
     @classmethod
     def _get_policy(cls, policy: np.ndarray, state: State) -> Dict:
-        legal_moves = Game.get_legal_moves(state)
-        policy_dict = {move: policy[cls._policy_index(move, state.player)] for move in legal_moves}
-        value_sum = sum(policy_dict.values())
-        return {move: value / value_sum for move, value in policy_dict.items()}
+        return cls._get_policies(policy[np.newaxis], [state])[0]
+
+    @classmethod
+    def _get_policies(cls, policies: np.ndarray, states: List[State]) -> List[Dict]:
+        # states without legal moves get an empty policy
+        legal_moves, masks = [], np.zeros(policies.shape, dtype=bool)
+        for i, state in enumerate(states):
+            moves, indices = Game.get_legal_move_indices(state, policies.shape[1] > c.POLICY_SIZE)
+            legal_moves.append((moves, indices))
+            masks[i, indices] = True
+        masked = np.where(masks, policies, 0)
+        # legal moves without any probability, e.g. after int8 quantization, are weighted equally
+        unassigned = masked.sum(axis=1) == 0
+        masked[unassigned] = masks[unassigned]
+        masked /= np.maximum(masked.sum(axis=1, keepdims=True), 1e-12)
+        return [dict(zip(moves, masked[i, indices])) for i, (moves, indices) in enumerate(legal_moves)]
 
     @staticmethod
     def _get_value(evaluation, player):
@@ -148,22 +328,26 @@ class NNet:
     # binary states are from the perspective of the player making the move
     @classmethod
     def _to_binary_state(cls, state: State) -> np.array:
+        if state.planes is not None:
+            # kept up to date by the moves, see State.track_planes()
+            stats.count('encodings_incremental')
+            return state.planes.view(state.player, state.en_passant)
+        with stats.timer('encoding'):
+            return cls._encode(state)
+
+    @staticmethod
+    def _encode(state: State) -> np.array:
         black = state.player == 'black'
         bin_state = np.zeros(shape=(c.ROWS, c.COLUMNS, 6 * 2 + 6))
-        for row in range(c.ROWS):
-            for column in range(c.COLUMNS):
-                index = cls._piece_index(state.board[row][column])
-                if index:
-                    piece_index = index[1] + 6 * int(state.player == index[0])
-                    bin_state[row, column, piece_index] = 1
-
-                for i, right in enumerate(state.castle_rights):
-                    if black:
-                        i = i + 2 % 4
-                    bin_state[row, column, 12 + i] = 1
+        own_pieces = c.BLACK_CODES if black else c.WHITE_CODES
+        for index, code in enumerate(state.board):
+            if code != c.EMPTY:
+                piece_index = (code - 1) % 6 + 6 * int(code in own_pieces)
+                bin_state[index // c.COLUMNS, index % c.COLUMNS, piece_index] = 1
 
-                if black:
-                    bin_state[row, column, 17] = 1
+        # four constant planes, which the trained weights expect at 12-15 for white and at 14-17 for black
+        first_plane = 14 if black else 12
+        bin_state[:, :, first_plane:first_plane + 4] = 1
 
         if state.en_passant:
             bin_state[state.en_passant[0], state.en_passant[1], 16] = 1
@@ -172,21 +356,6 @@ class NNet:
             bin_state = np.flip(bin_state, axis=0)
         return bin_state
 
-    @staticmethod
-    def _piece_index(piece: str) -> Optional[tuple]:
-        if piece == 'empty':
-            return None
-        piece = piece.split('_')
-        typing = {
-            'pawn': 0,
-            'knight': 1,
-            'bishop': 2,
-            'rook': 3,
-            'queen': 4,
-            'king': 5
-        }
-        return piece[0], typing.get(piece[1])
-
 
 if __name__ == '__main__':
     nn = NNet()
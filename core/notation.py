@@ -0,0 +1,26 @@
+import constants as c
+
+_PROMOTION_CHARACTERS = {'queen': 'q', 'knight': 'n', 'bishop': 'b', 'rook': 'r'}
+_PROMOTION_PIECES = {character: piece for piece, character in _PROMOTION_CHARACTERS.items()}
+
+
+def to_algebraic(move: tuple) -> str:
+    """
+    :param move: Move as (origin_position, target_position) or (origin_position, target_position, piece)
+    :return: Move in long algebraic notation, e.g. 'e2e4' or 'a7a8q'
+    """
+    return "".join((chr(ord('`') + move[0][1] + 1), str(c.ROWS - move[0][0]),
+                    chr(ord('`') + move[1][1] + 1), str(c.ROWS - move[1][0]),
+                    _PROMOTION_CHARACTERS[move[2]] if len(move) == 3 else ''))
+
+
+def from_algebraic(algebraic: str) -> tuple:
+    """
+    :param algebraic: Move in long algebraic notation, e.g. 'e2e4' or 'a7a8q'
+    :return: Move as (origin_position, target_position) or (origin_position, target_position, piece)
+    """
+    alg = list(algebraic)
+    move = (c.ROWS - int(alg[1]), ord(alg[0]) - 97), (c.ROWS - int(alg[3]), ord(alg[2]) - 97)
+    if len(alg) == 5:
+        return (*move, _PROMOTION_PIECES[alg[4]])
+    return move
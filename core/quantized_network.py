@@ -0,0 +1,146 @@
+import numpy as np
+import argparse
+import random
+import time
+from typing import Any, List, Tuple
+
+from game import Game, State
+from instrumentation import stats
+from neural_network import NNet, _import_tensorflow
+import constants as c
+
+
+class QuantizedNNet:
+    """
+    Inference only version of NNet running a quantized TensorFlow Lite export of the network. Create the export with
+    NNet.export_quantized() first. If the tflite_runtime package is installed the model is run without importing
+    TensorFlow at all.
+    """
+
+    def __init__(self, model_name: str = c.DEFAULT_MODEL_NAME, mode: str = 'float16'):
+        self.model_name = model_name
+        self.mode = mode
+        self.interpreter = _interpreter_class()(model_path=NNet.quantized_path(model_name, mode))
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]['index']
+        # the order of the outputs is not preserved by the converter, the policy is the larger one
+        outputs = sorted(self.interpreter.get_output_details(), key=lambda detail: detail['shape'][-1])
+        self._value_output, self._policy_output = outputs[0]['index'], outputs[1]['index']
+
+    def prediction(self, state: State) -> Tuple[dict, float]:
+        """
+        Returns a policy and value prediction for a given state, see NNet.prediction.
+
+        :param state: State to evaluate
+        :return: (policy, value)
+        """
+        policies, values = self.predict_binary(np.array([NNet._to_binary_state(state)]))
+        return NNet._get_policy(policies[0], state), values[0]
+
+    def predictions(self, states: List[State]) -> List[Tuple[dict, float]]:
+        """
+        Returns policy and value predictions for a list of states in a single batch, see NNet.predictions.
+        """
+        if not states:
+            return []
+        policies, values = self.predict_binary(np.array([NNet._to_binary_state(state) for state in states]))
+        return list(zip(NNet._get_policies(policies, states), values))
+
+    def predict_binary(self, binary_states: np.array) -> Tuple[np.array, np.array]:
+        """
+        Returns the raw network outputs for a batch of binary states.
+
+        :param binary_states: Array of shape (batch, rows, columns, planes)
+        :return: (policies, values) with shapes (batch, policy_size) and (batch,)
+        """
+        start = time.perf_counter()
+        binary_states = binary_states.astype(np.float32)
+        if tuple(self.interpreter.get_input_details()[0]['shape']) != binary_states.shape:
+            self.interpreter.resize_tensor_input(self._input, binary_states.shape)
+            self.interpreter.allocate_tensors()
+        self.interpreter.set_tensor(self._input, binary_states)
+        self.interpreter.invoke()
+        policies = self.interpreter.get_tensor(self._policy_output)
+        values = self.interpreter.get_tensor(self._value_output)[:, 0]
+        stats.record_inference(len(binary_states), time.perf_counter() - start)
+        return policies, values
+
+
+def _interpreter_class() -> Any:
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        return _import_tensorflow().lite.Interpreter
+
+
+def compare_models(reference: NNet, quantized: QuantizedNNet, states: List[State]) -> dict:
+    """
+    Compares a quantized network with the float32 network it was exported from.
+
+    :param reference: Original network
+    :param quantized: Quantized network
+    :param states: Held-out sample of states
+    :return: Dict with the agreement of the best legal moves ('top1_agreement') and the mean squared difference of
+        the values ('value_mse')
+    """
+    agreements = 0
+    squared_errors = 0.
+    for state in states:
+        policy, value = reference.prediction(state)
+        quantized_policy, quantized_value = quantized.prediction(state)
+        agreements += max(policy, key=policy.get) == max(quantized_policy, key=quantized_policy.get)
+        squared_errors += (float(value) - float(quantized_value)) ** 2
+    return {'samples': len(states), 'top1_agreement': agreements / len(states),
+            'value_mse': squared_errors / len(states)}
+
+
+def example_states(number: int, table: str = c.DEFAULT_TABLE) -> List[State]:
+    """
+    Returns a random sample of the positions stored as training data, which match the positions the network sees
+    during play better than random_states().
+
+    :param number: Number of states
+    :param table: Name of the database table
+    """
+    from db_connector import Connector
+    return [State(fen) for fen in Connector().get_data(number, table)['state']]
+
+
+def random_states(number: int, max_moves: int = 80) -> List[State]:
+    """
+    Returns states from games with random moves, which can be used as a sample when no training data is available.
+
+    :param number: Number of states
+    :param max_moves: Maximum length of the random games
+    """
+    states = []
+    while len(states) < number:
+        game = Game()
+        for _ in range(random.randint(0, max_moves)):
+            if game.state.winner:
+                break
+            move = random.choice(list(game.game_legal_moves()))
+            game.make_move(*move)
+        if not game.state.winner:
+            states.append(game.state)
+    return states
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exports a quantized network and checks its accuracy.')
+    parser.add_argument('--model', default=c.DEFAULT_MODEL_NAME)
+    parser.add_argument('--mode', default='float16', choices=['float16', 'int8'])
+    parser.add_argument('--samples', type=int, default=200)
+    parser.add_argument('--table', help='Database table with training examples for the calibration and comparison, '
+                                        'positions of random games are used without it')
+    args = parser.parse_args()
+
+    nnet = NNet(model_name=args.model)
+    if args.table:
+        sample = example_states(args.samples + 50, args.table)
+        sample, calibration = sample[:args.samples], sample[args.samples:]
+    else:
+        sample, calibration = random_states(args.samples), random_states(50)
+    print(f'exported to {nnet.export_quantized(args.mode, representative_states=calibration)}')
+    print(compare_models(nnet, QuantizedNNet(args.model, args.mode), sample))
@@ -0,0 +1,220 @@
+from collections import deque
+from threading import Thread, Condition, Event
+import random
+from typing import Iterator, List, Optional
+
+from game import Game
+from neural_network import NNet
+from sprt import SPRT
+import constants as c
+import trainer
+import ai
+
+
+class ReplayBuffer:
+    """
+    Bounded, thread safe storage of self-play examples. When the buffer is full the oldest examples are dropped.
+
+    Attrs:
+        games (int): Number of games added since the buffer was created
+    """
+
+    def __init__(self, capacity: int = c.DEFAULT_REPLAY_BUFFER_SIZE):
+        self.examples = deque(maxlen=capacity)
+        self.games = 0
+        self._condition = Condition()
+
+    def __len__(self) -> int:
+        return len(self.examples)
+
+    def add_game(self, examples: List[tuple]) -> None:
+        """
+        Adds the examples of a finished game.
+
+        :param examples: List of examples as List[(state,(policy, value))]
+        """
+        with self._condition:
+            self.examples.extend(examples)
+            self.games += 1
+            self._condition.notify_all()
+
+    def sample(self, number: int) -> List[tuple]:
+        """
+        Returns a uniform sample of examples without replacement.
+
+        :param number: Number of examples, all examples are returned if the buffer holds fewer
+        """
+        with self._condition:
+            return random.sample(list(self.examples), min(number, len(self.examples)))
+
+    def wait_for_games(self, games: int, stop: Optional[Event] = None, timeout: float = 1.) -> bool:
+        """
+        Blocks until the total number of added games reaches the given number.
+
+        :param games: Total number of games to wait for
+        :param stop: Stops waiting early when set
+        :param timeout: Interval in which the stop event is checked
+        :return: True if the games are available
+        """
+        with self._condition:
+            while self.games < games:
+                if stop and stop.is_set():
+                    return False
+                self._condition.wait(timeout)
+            return True
+
+
+def play_game(nnet: NNet, move_number: int = c.DEFAULT_SELF_PLAY_WIDTH, depth: int = c.DEFAULT_SELF_PLAY_DEPTH,
+              temperature: float = c.DEFAULT_SELF_PLAY_TEMPERATURE,
+              max_moves: int = c.DEFAULT_SELF_PLAY_MAX_MOVES) -> List[tuple]:
+    """
+    Plays a game of the network against itself. Every move is sampled from the distribution returned by
+    ai.search_policy, which is also stored as policy target together with the final outcome of the game.
+
+    :param nnet: Neural network used for the search
+    :param move_number: Number of moves considered for each state
+    :param depth: Search depth
+    :param temperature: Temperature of the search distribution
+    :param max_moves: Games exceeding this number of moves are counted as draws
+    :return: List of examples as List[(state,(policy, value))] with the value as evaluation from white's perspective
+    """
+    return next(play_games(nnet, 1, 1, move_number, depth, temperature, max_moves))
+
+
+def play_games(nnet: NNet, games: int, parallel: int = c.DEFAULT_SELF_PLAY_PARALLEL,
+               move_number: int = c.DEFAULT_SELF_PLAY_WIDTH, depth: int = c.DEFAULT_SELF_PLAY_DEPTH,
+               temperature: float = c.DEFAULT_SELF_PLAY_TEMPERATURE,
+               max_moves: int = c.DEFAULT_SELF_PLAY_MAX_MOVES) -> Iterator[List[tuple]]:
+    """
+    Plays games like play_game, but advances many games in lockstep: The searches of all running games are
+    evaluated together with ai.search_policies, so every network call gets a batch of positions from all games.
+    Finished games are replaced by new ones until the given number of games has been started.
+
+    :param nnet: Neural network used for the search
+    :param games: Total number of games
+    :param parallel: Number of games played at the same time
+    :return: Iterator over the examples of each game as soon as it is finished, see play_game for the other
+        parameters
+    """
+    started = 0
+    running = []
+    while started < games or running:
+        while started < games and len(running) < parallel:
+            running.append((Game(), []))
+            started += 1
+        policies = ai.search_policies([game.state for game, _ in running], nnet, move_number, depth, temperature)
+        still_running = []
+        for (game, history), policy in zip(running, policies):
+            history.append((game.state, policy))
+            move = random.choices(list(policy.keys()), weights=list(policy.values()))[0]
+            game.make_move(*move)
+            if game.state.winner or len(history) >= max_moves:
+                value = _outcome_evaluation(game.state.winner)
+                yield [(state, (policy_, value)) for state, policy_ in history]
+            else:
+                still_running.append((game, history))
+        running = still_running
+
+
+def _outcome_evaluation(winner: Optional[str]) -> float:
+    # same scale as the mate evaluation in trainer._value, so outcomes and Stockfish examples can be mixed
+    if winner == 'white':
+        return 100
+    if winner == 'black':
+        return -100
+    return 0
+
+
+class SelfPlayPipeline:
+    """
+    Continuous self-play training. Games are generated in a background thread with the currently accepted network and
+    stored in a replay buffer. Meanwhile the main thread periodically trains a candidate network on samples of the
+    buffer and gates it with a match series against the accepted network. Accepted weights are saved and picked up
+    by the generator before its next game. An error of the generator stops the pipeline and is raised again by run().
+    """
+
+    def __init__(self, model_name: str = c.DEFAULT_MODEL_NAME, buffer_size: int = c.DEFAULT_REPLAY_BUFFER_SIZE,
+                 games_per_iteration: int = c.DEFAULT_SELF_PLAY_GAMES, sample_size: int = c.DEFAULT_SELF_PLAY_SAMPLE,
+                 learning_rate: float = c.DEFAULT_LEARNING_RATE, epochs: int = c.DEFAULT_EPOCHS,
+                 batch_size: int = c.DEFAULT_BATCH_SIZE, gating: str = c.DEFAULT_GATING, matches: int = 10,
+                 threshold: int = c.DEFAULT_THRESHOLD, max_matches: int = c.DEFAULT_SPRT_MAX_MATCHES,
+                 move_number: int = c.DEFAULT_SELF_PLAY_WIDTH, depth: int = c.DEFAULT_SELF_PLAY_DEPTH,
+                 temperature: float = c.DEFAULT_SELF_PLAY_TEMPERATURE, max_moves: int = c.DEFAULT_SELF_PLAY_MAX_MOVES,
+                 parallel: int = c.DEFAULT_SELF_PLAY_PARALLEL):
+        self.model_name = model_name
+        self.games_per_iteration = games_per_iteration
+        self.sample_size = sample_size
+
+        self.gating = gating
+        self.matches = matches
+        self.threshold = threshold
+        self.max_matches = max_matches
+
+        self.move_number = move_number
+        self.depth = depth
+        self.temperature = temperature
+        self.max_moves = max_moves
+        self.parallel = parallel
+
+        self.buffer = ReplayBuffer(buffer_size)
+        self.best_net = NNet(model_name=model_name)
+        self.candidate = NNet(learning_rate=learning_rate, epochs=epochs, batch_size=batch_size, model_name=model_name)
+        # the generator uses its own network, so predictions never run while weights are replaced
+        self._generator_net = NNet(model_name=model_name)
+        self._new_weights = None
+        self._stop = Event()
+        self._error = None
+
+    def run(self, iterations: Optional[int] = None) -> None:
+        """
+        Runs the pipeline.
+
+        :param iterations: Number of training and gating rounds, None runs until interrupted
+        """
+        generator = Thread(target=self._generate, daemon=True)
+        generator.start()
+        try:
+            iteration = 0
+            while iterations is None or iteration < iterations:
+                iteration += 1
+                if not self.buffer.wait_for_games(iteration * self.games_per_iteration, self._stop):
+                    break
+                print(f'iteration {iteration}: {self.buffer.games} games, {len(self.buffer)} examples in buffer')
+                self._train_and_gate()
+        finally:
+            self._stop.set()
+            generator.join()
+        if self._error is not None:
+            raise RuntimeError(f'Self-play stopped: {self._error}') from self._error
+
+    def _generate(self) -> None:
+        try:
+            self._play()
+        except Exception as e:
+            self._error = e
+            print(f"The error '{e}' occurred, self-play stopped")
+            self._stop.set()
+
+    def _play(self) -> None:
+        while not self._stop.is_set():
+            if self._new_weights is not None:
+                self._generator_net.model.set_weights(self._new_weights)
+                self._new_weights = None
+            # new weights are picked up once all games of a round are finished
+            for examples in play_games(self._generator_net, self.parallel, self.parallel, self.move_number, self.depth,
+                                       self.temperature, self.max_moves):
+                self.buffer.add_game(examples)
+                if self._stop.is_set():
+                    break
+
+    def _train_and_gate(self) -> None:
+        self.candidate.train(self.buffer.sample(self.sample_size))
+        if trainer._gate(self.candidate, self.best_net, self.gating, self.matches, self.threshold,
+                         SPRT() if self.gating == 'sprt' else None, self.max_matches):
+            weights = self.candidate.model.get_weights()
+            self.best_net.model.set_weights(weights)
+            self._new_weights = weights
+
+
+if __name__ == '__main__':
+    SelfPlayPipeline().run()
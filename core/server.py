@@ -0,0 +1,237 @@
+import asyncio
+import argparse
+import json
+import os
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from game import Game, State
+from neural_network import NNet
+from notation import to_algebraic, from_algebraic
+import constants as c
+import ai
+
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+
+class AnalysisServer:
+    """
+    Local HTTP server keeping a network loaded for analysis scripts. Requests are JSON objects with an optional 'fen'
+    (default: start position) and 'moves' in algebraic notation played from it:
+        POST /predict -> {'policy': {move: probability}, 'value': value for the player to move between 0 and 1}
+        POST /search (optional 'width' and 'depth') -> {'move': best move, 'values': {move: searched value}}
+        GET /status -> request and batch counters
+
+    Predictions of concurrent requests, including those made by the searches, are coalesced into batched forward
+    passes. The weights are reloaded when the files in weights/<model_name> change.
+    """
+
+    def __init__(self, model_name: str = c.DEFAULT_MODEL_NAME, host: str = c.SERVER_HOST, port: int = c.SERVER_PORT,
+                 nnet: Optional[NNet] = None, batch_window: float = c.SERVER_BATCH_WINDOW,
+                 max_batch: int = c.SERVER_MAX_BATCH):
+        """
+        :param nnet: Network to serve, loaded from model_name if None
+        :param batch_window: Seconds a prediction waits for other requests to join its batch
+        :param max_batch: Maximal number of states per forward pass
+        """
+        self.model_name = model_name
+        self.host = host
+        self.port = port
+        self.nnet = nnet or NNet(model_name=model_name, inference_only=True)
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.counters = {'requests': 0, 'predictions': 0, 'batches': 0, 'reloads': 0}
+
+        self._weights_version = self._weights_mtime()
+        self._loop = None
+        self._queue = None
+        self._server = None
+        # only the inference thread calls the model, searches run in their own threads
+        self._inference = ThreadPoolExecutor(max_workers=1)
+        self._searches = ThreadPoolExecutor(max_workers=c.SERVER_SEARCH_THREADS)
+
+    async def start(self) -> None:
+        """
+        Starts listening and the background tasks. The port is updated if 0 was given.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._tasks = [asyncio.create_task(self._batch_predictions()), asyncio.create_task(self._watch_weights())]
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        self._searches.shutdown(wait=False)
+        self._inference.shutdown(wait=False)
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        print(f'Serving {self.model_name} on http://{self.host}:{self.port}')
+        await self._server.serve_forever()
+
+    async def predict(self, states: List[State]) -> List[Tuple[dict, float]]:
+        """
+        Queues states for the next batch and returns their predictions, see NNet.predictions.
+        """
+        futures = []
+        for state in states:
+            futures.append(self._loop.create_future())
+            await self._queue.put((state, futures[-1]))
+        return list(await asyncio.gather(*futures))
+
+    async def _batch_predictions(self) -> None:
+        while True:
+            batch = [await self._queue.get()]
+            # requests arriving within the window share the forward pass
+            await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            nnet = self.nnet
+            try:
+                predictions = await self._loop.run_in_executor(self._inference, nnet.predictions,
+                                                               [state for state, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.cancelled():
+                        future.set_exception(e)
+                continue
+            self.counters['batches'] += 1
+            self.counters['predictions'] += len(batch)
+            for (_, future), prediction in zip(batch, predictions):
+                if not future.cancelled():
+                    future.set_result(prediction)
+
+    async def _watch_weights(self) -> None:
+        while True:
+            await asyncio.sleep(c.SERVER_RELOAD_INTERVAL)
+            version = self._weights_mtime()
+            if version is None or version == self._weights_version:
+                continue
+            # loaded next to the running predictions, which switch to the new network with the next batch
+            try:
+                self.nnet = await self._loop.run_in_executor(None, lambda: NNet(model_name=self.model_name,
+                                                                                inference_only=True))
+            except Exception as e:
+                # e.g. weights which are still being written, the old network is kept and the next check retries
+                print(f"The error '{e}' occurred while reloading the weights of {self.model_name}")
+                continue
+            self._weights_version = version
+            self.counters['reloads'] += 1
+            print(f'Reloaded weights of {self.model_name}')
+
+    def _weights_mtime(self) -> Optional[float]:
+        path = NNet.weights_path(self.model_name)
+        if not os.path.isdir(path):
+            return None
+        return max((entry.stat().st_mtime for entry in os.scandir(path) if entry.is_file()), default=None)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            method, path, _ = (await reader.readline()).decode().split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode().split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            self.counters['requests'] += 1
+            request = json.loads(body) if body else {}
+            if not isinstance(request, dict):
+                raise ValueError('The request has to be a JSON object!')
+            status, response = await self._route(method, path, request)
+        except (ValueError, KeyError, IndexError, asyncio.IncompleteReadError) as e:
+            status, response = 400, {'error': str(e)}
+        except Exception as e:
+            # e.g. a failed prediction, the client gets an answer instead of a dropped connection
+            print(f"The error '{e}' occurred while handling a request")
+            status, response = 500, {'error': str(e)}
+        data = json.dumps(response).encode()
+        writer.write(f'HTTP/1.1 {status} {_REASONS[status]}\r\nContent-Type: application/json\r\n'
+                     f'Content-Length: {len(data)}\r\nConnection: close\r\n\r\n'.encode() + data)
+        await writer.drain()
+        writer.close()
+
+    async def _route(self, method: str, path: str, request: dict) -> Tuple[int, dict]:
+        if method == 'GET' and path == '/status':
+            return 200, {'model_name': self.model_name, **self.counters}
+        if method == 'POST' and path == '/predict':
+            state = self._to_state(request)
+            policy, value = (await self.predict([state]))[0]
+            return 200, {'policy': {to_algebraic(move): float(p) for move, p in policy.items()},
+                         'value': float(value)}
+        if method == 'POST' and path == '/search':
+            state = self._to_state(request)
+            width = self._field(request, 'width', int, c.DEFAULT_SELF_PLAY_WIDTH)
+            depth = self._field(request, 'depth', int, c.DEFAULT_SELF_PLAY_DEPTH)
+            values = await self._loop.run_in_executor(self._searches, ai._search_move_values, state, _ServerNet(self),
+                                                      width, depth, c.DEFAULT_PRUNE_MARGIN)
+            return 200, {'move': to_algebraic(max(values, key=values.get)),
+                         'values': {to_algebraic(move): float(value) for move, value in values.items()}}
+        return 404, {'error': f'Unknown request: {method} {path}'}
+
+    @staticmethod
+    def _field(request: dict, name: str, field_type: type, default):
+        value = request.get(name, default)
+        # bool is a subclass of int but no valid width or depth
+        if not isinstance(value, field_type) or isinstance(value, bool):
+            raise ValueError(f'{name} has to be of type {field_type.__name__}!')
+        return value
+
+    @classmethod
+    def _to_state(cls, request: dict) -> State:
+        game = Game(cls._field(request, 'fen', str, c.DEFAULT_POSITION))
+        moves = cls._field(request, 'moves', list, [])
+        if not all(isinstance(algebraic, str) for algebraic in moves):
+            raise ValueError('moves has to be a list of strings!')
+        for algebraic in moves:
+            move = from_algebraic(algebraic)
+            if move not in game.game_legal_moves():
+                raise ValueError(f'Illegal move: {algebraic}')
+            game.make_move(*move)
+        if not game.game_legal_moves():
+            raise ValueError('The game is over!')
+        return game.state
+
+
+class _ServerNet:
+    # stands in for NNet in searches running in other threads, their predictions join the batches of the server
+    def __init__(self, server: AnalysisServer):
+        self.server = server
+
+    def prediction(self, state: State) -> Tuple[dict, float]:
+        return self.predictions([state])[0]
+
+    def predictions(self, states: List[State]) -> List[Tuple[dict, float]]:
+        if not states:
+            return []
+        return asyncio.run_coroutine_threadsafe(self.server.predict(states), self.server._loop).result()
+
+
+def request(path: str, payload: Optional[dict] = None, host: str = c.SERVER_HOST, port: int = c.SERVER_PORT) -> dict:
+    """
+    Sends a request to a running AnalysisServer.
+
+    :param path: '/predict', '/search' or '/status'
+    :param payload: Request as dict, a GET request is sent if None
+    :return: Response as dict
+    """
+    data = json.dumps(payload).encode() if payload is not None else None
+    with urllib.request.urlopen(urllib.request.Request(f'http://{host}:{port}{path}', data=data)) as response:
+        return json.loads(response.read())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves network predictions and searches for local clients.')
+    parser.add_argument('--model-name', default=c.DEFAULT_MODEL_NAME)
+    parser.add_argument('--host', default=c.SERVER_HOST)
+    parser.add_argument('--port', type=int, default=c.SERVER_PORT)
+    args = parser.parse_args()
+
+    asyncio.run(AnalysisServer(args.model_name, args.host, args.port).serve_forever())
@@ -0,0 +1,113 @@
+import math
+from typing import List, Optional, Tuple
+
+import constants as c
+
+
+class SPRT:
+    """
+    Sequential probability ratio test on the results of a match series. The hypotheses H0: elo = elo0 and
+    H1: elo = elo1 are tested after every result using the trinomial (win/draw/loss) approximation of the log
+    likelihood ratio, so the series can be stopped as soon as one of them is accepted.
+
+    Attrs:
+        wins, draws, losses (int): Results from the perspective of the tested player
+        log (List[dict]): Every recorded result in order
+    """
+
+    def __init__(self, elo0: float = c.DEFAULT_SPRT_ELO0, elo1: float = c.DEFAULT_SPRT_ELO1,
+                 alpha: float = c.DEFAULT_SPRT_ALPHA, beta: float = c.DEFAULT_SPRT_BETA):
+        if elo0 >= elo1:
+            raise ValueError('elo0 has to be smaller than elo1!')
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.lower_bound = math.log(beta / (1 - alpha))
+        self.upper_bound = math.log((1 - beta) / alpha)
+
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.log: List[dict] = []
+
+    def add_result(self, result: int, **info) -> None:
+        """
+        Records the result of a single game.
+
+        :param result: 1 for a win, 0 for a draw and -1 for a loss of the tested player
+        :param info: Additional information stored in the match log, e.g. the color of the tested player
+        """
+        if result == 1:
+            self.wins += 1
+        elif result == 0:
+            self.draws += 1
+        elif result == -1:
+            self.losses += 1
+        else:
+            raise ValueError('Result has to be 1, 0 or -1!')
+        self.log.append({'game': len(self.log) + 1, 'result': result, **info})
+
+    @property
+    def games(self) -> int:
+        return self.wins + self.draws + self.losses
+
+    def llr(self) -> float:
+        """
+        Returns the log likelihood ratio of H1 against H0 for the recorded results.
+        """
+        if not self.games:
+            return 0.
+        score, variance = self._score_variance()
+        if variance == 0:
+            # all games had the same result, regularize with half a draw to get a finite ratio
+            score, variance = self._score_variance(extra_draws=0.5)
+        s0, s1 = self._expected_score(self.elo0), self._expected_score(self.elo1)
+        return self.games * (s1 - s0) * (2 * score - s0 - s1) / (2 * variance)
+
+    def status(self) -> Optional[str]:
+        """
+        Returns 'accepted' if H1 is accepted, 'rejected' if H0 is accepted and None if the test is undecided.
+        """
+        llr = self.llr()
+        if llr >= self.upper_bound:
+            return 'accepted'
+        if llr <= self.lower_bound:
+            return 'rejected'
+        return None
+
+    def elo(self, z: float = 1.96) -> Tuple[float, float, float]:
+        """
+        Returns the Elo difference estimated from the recorded results with a confidence interval.
+
+        :param z: Quantile of the normal distribution, 1.96 corresponds to a 95% interval
+        :return: (elo, lower, upper)
+        """
+        if not self.games:
+            return 0., -math.inf, math.inf
+        score, variance = self._score_variance()
+        margin = z * math.sqrt(variance / self.games)
+        return self._to_elo(score), self._to_elo(score - margin), self._to_elo(score + margin)
+
+    def summary(self) -> dict:
+        elo, lower, upper = self.elo()
+        return {'games': self.games, 'wins': self.wins, 'draws': self.draws, 'losses': self.losses,
+                'llr': self.llr(), 'bounds': (self.lower_bound, self.upper_bound), 'status': self.status(),
+                'elo': elo, 'elo_interval': (lower, upper), 'log': self.log}
+
+    def _score_variance(self, extra_draws: float = 0.) -> Tuple[float, float]:
+        games = self.games + extra_draws
+        score = (self.wins + (self.draws + extra_draws) / 2) / games
+        variance = (self.wins * (1 - score) ** 2 + (self.draws + extra_draws) * (0.5 - score) ** 2
+                    + self.losses * score ** 2) / games
+        return score, variance
+
+    @staticmethod
+    def _expected_score(elo: float) -> float:
+        return 1 / (1 + 10 ** (-elo / 400))
+
+    @staticmethod
+    def _to_elo(score: float) -> float:
+        if score <= 0:
+            return -math.inf
+        if score >= 1:
+            return math.inf
+        return -400 * math.log10(1 / score - 1)
@@ -0,0 +1,219 @@
+import numpy as np
+import argparse
+import os
+from typing import List, Optional, Tuple
+
+from game import Game, State
+import constants as c
+
+parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PIECES = {'Q': 'queen', 'R': 'rook'}
+_SQUARES = c.ROWS * c.COLUMNS
+# number of indices per player to move: strong king, piece and weak king
+_POSITIONS = _SQUARES ** 3
+_DRAW = -1
+
+
+def _symmetries() -> np.array:
+    # the 8 symmetries of the board, which keep positions without pawns and castle rights equivalent
+    rows, columns = np.divmod(np.arange(_SQUARES), c.COLUMNS)
+    last = c.ROWS - 1
+    transforms = []
+    for row, column in ((rows, columns), (columns, rows)):
+        for flip_row in (False, True):
+            for flip_column in (False, True):
+                transforms.append((last - row if flip_row else row) * c.COLUMNS
+                                  + (last - column if flip_column else column))
+    return np.array(transforms)
+
+
+class Tablebase:
+    """
+    Distance to mate table of an endgame with king and one piece against a lone king, generated by retrograde
+    analysis with Game. The table is indexed by the player to move and the squares of the strong king, the piece and
+    the weak king and stored as .npy file, which is memory-mapped when loaded.
+    """
+
+    def __init__(self, endgame: str = 'KQK'):
+        self.endgame = endgame
+        self.piece = _PIECES[endgame[1]]
+        self.table = np.load(self.path(endgame), mmap_mode='r')
+
+    @staticmethod
+    def path(endgame: str) -> str:
+        return os.path.join(parent_dir, 'lookup', f'{endgame}.npy')
+
+    @classmethod
+    def load_all(cls) -> List['Tablebase']:
+        """
+        Returns all tablebases of c.TABLEBASE_ENDGAMES which have been generated.
+        """
+        return [cls(endgame) for endgame in c.TABLEBASE_ENDGAMES if os.path.isfile(cls.path(endgame))]
+
+    def covers(self, state: State) -> bool:
+        return self._index(state) is not None
+
+    def probe(self, state: State) -> Optional[Tuple[str, int]]:
+        """
+        Returns the result of a state with perfect play.
+
+        :param state: State to look up
+        :return: (winner, half moves until mate) with winner 'white', 'black' or 'draw', None if the state is not
+            covered by the table
+        """
+        index = self._index(state)
+        if index is None:
+            return None
+        value = int(self.table[index])
+        if value == _DRAW:
+            return 'draw', 0
+        return self._strong_player(state), value
+
+    def best_move(self, state: State) -> Optional[tuple]:
+        """
+        Returns a move keeping the best result for the player to move: The fastest mate for the winning side, the
+        longest resistance or a draw for the defending side.
+
+        :param state: State to look up
+        :return: Move or None if the state is not covered by the table or has no legal moves
+        """
+        if not self.covers(state):
+            return None
+        strong = self._strong_player(state) == state.player
+        best_move, best_score = None, None
+        for move in Game.get_legal_moves(state):
+            # a capture of the piece leaves the table and is a draw
+            result = self.probe(Game.move(state, *move, update_winner=False)) or ('draw', 0)
+            if result[0] == 'draw':
+                score = -_POSITIONS if strong else _POSITIONS
+            else:
+                score = -result[1] if strong else result[1]
+            if best_score is None or score > best_score:
+                best_move, best_score = move, score
+        return best_move
+
+    def _strong_player(self, state: State) -> str:
+        return 'white' if c.PIECE_CODES[f'white_{self.piece}'] in state.board else 'black'
+
+    def _index(self, state: State) -> Optional[int]:
+        pieces = {c.PIECE_NAMES[code]: index for index, code in enumerate(state.board) if code != c.EMPTY}
+        if len(pieces) != 3:
+            return None
+        strong = 'white' if f'white_{self.piece}' in pieces else 'black'
+        weak = Game.swap_player(strong)
+        if {f'{strong}_king', f'{strong}_{self.piece}', f'{weak}_king'} != set(pieces):
+            return None
+        squares = [pieces[f'{strong}_king'], pieces[f'{strong}_{self.piece}'], pieces[f'{weak}_king']]
+        if strong == 'black':
+            # mirror the rows, so the strong side is always white in the table
+            squares = [(c.ROWS - 1 - square // c.COLUMNS) * c.COLUMNS + square % c.COLUMNS for square in squares]
+        return (state.player != strong) * _POSITIONS + squares[0] * _SQUARES ** 2 + squares[1] * _SQUARES \
+            + squares[2]
+
+    @classmethod
+    def build(cls, endgame: str = 'KQK') -> 'Tablebase':
+        """
+        Generates the table of an endgame and saves it. Only one position of each group of symmetric positions is
+        analysed. Starting from the mates, the distance to mate is propagated backwards one half move at a time: A
+        position with the strong side to move is won if one move reaches a won position, a position with the weak
+        side to move is lost if all moves reach won positions.
+
+        :param endgame: Endgame from c.TABLEBASE_ENDGAMES
+        :return: The new tablebase
+        """
+        piece = _PIECES[endgame[1]]
+        symmetries = _symmetries()
+        indices = np.arange(_POSITIONS)
+        squares = np.stack((indices // _SQUARES ** 2, indices // _SQUARES % _SQUARES, indices % _SQUARES))
+        canonical = np.min(symmetries[:, squares[0]] * _SQUARES ** 2 + symmetries[:, squares[1]] * _SQUARES
+                           + symmetries[:, squares[2]], axis=0)
+
+        # two extra entries: a draw for captures of the piece and a mate for padding the moves of the weak side
+        table = np.full(2 * _POSITIONS + 2, _DRAW, dtype=np.int16)
+        capture, padding = 2 * _POSITIONS, 2 * _POSITIONS + 1
+        table[padding] = 0
+        positions, successors = ([], []), ([], [])
+        for player in (0, 1):
+            for index in np.flatnonzero(canonical == indices):
+                state = cls._build_state(piece, squares[:, index], player)
+                if state is None:
+                    continue
+                moves = Game.get_legal_moves(state)
+                if not moves:
+                    if player == 1 and Game.is_check(state):
+                        table[_POSITIONS + index] = 0
+                    continue
+                positions[player].append(player * _POSITIONS + index)
+                successors[player].append([cls._successor(squares[:, index], move, player, canonical, capture)
+                                           for move in moves])
+        positions = [np.array(player_positions) for player_positions in positions]
+        successors = [cls._pad(successors[0], capture), cls._pad(successors[1], padding)]
+
+        distance = 0
+        while True:
+            distance += 1
+            player = distance % 2 == 0
+            values = table[successors[player]]
+            if player:
+                solved = (values != _DRAW).all(axis=1) & (values.max(axis=1) == distance - 1)
+            else:
+                solved = (values == distance - 1).any(axis=1)
+            solved &= table[positions[player]] == _DRAW
+            if not solved.any():
+                break
+            table[positions[player][solved]] = distance
+        table = table[:2 * _POSITIONS]
+
+        # fill in the symmetric positions
+        table = np.concatenate((table[:_POSITIONS][canonical], table[_POSITIONS:][canonical]))
+        path = cls.path(endgame)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.save(path, table)
+        return cls(endgame)
+
+    @staticmethod
+    def _build_state(piece: str, squares: np.array, player: int) -> Optional[State]:
+        strong_king, strong_piece, weak_king = (divmod(int(square), c.COLUMNS) for square in squares)
+        if len({strong_king, strong_piece, weak_king}) < 3:
+            return None
+        if abs(strong_king[0] - weak_king[0]) <= 1 and abs(strong_king[1] - weak_king[1]) <= 1:
+            return None
+        state = State(c.EMPTY_BOARD)
+        state.set_entry(strong_king, 'white_king')
+        state.set_entry(strong_piece, f'white_{piece}')
+        state.set_entry(weak_king, 'black_king')
+        if player == 0:
+            # the player who is not to move cannot be in check
+            state.player = 'black'
+            if Game.is_check(state):
+                return None
+        state.player = 'white' if player == 0 else 'black'
+        return state
+
+    @staticmethod
+    def _pad(successors: List[list], padding: int) -> np.array:
+        padded = np.full((len(successors), max(map(len, successors))), padding)
+        for i, successor_indices in enumerate(successors):
+            padded[i, :len(successor_indices)] = successor_indices
+        return padded
+
+    @staticmethod
+    def _successor(squares: np.array, move: tuple, player: int, canonical: np.array, capture: int) -> int:
+        origin = move[0][0] * c.COLUMNS + move[0][1]
+        target = move[1][0] * c.COLUMNS + move[1][1]
+        if target == squares[1]:
+            return capture
+        squares = [target if square == origin else int(square) for square in squares]
+        return (1 - player) * _POSITIONS + int(canonical[squares[0] * _SQUARES ** 2 + squares[1] * _SQUARES
+                                                         + squares[2]])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generates endgame tablebases.')
+    parser.add_argument('--endgames', nargs='*', default=c.TABLEBASE_ENDGAMES, choices=c.TABLEBASE_ENDGAMES)
+    args = parser.parse_args()
+
+    for name in args.endgames:
+        tablebase = Tablebase.build(name)
+        print(f'{name}: longest mate in {int(tablebase.table.max())} half moves, saved to {Tablebase.path(name)}')
@@ -3,22 +3,24 @@ import random
 from typing import Optional
 import sys
 import os
-import pandas as pd
+import json
 
 from game import Game, State
-from db_connector import Connector
+from db_connector import Connector, ExampleWriter
 from neural_network import NNet
+from sprt import SPRT
+from matches import fast_match, fast_matches
+from notation import to_algebraic, from_algebraic
 import constants as c
-import ai
-
-parent_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
 def gen_examples(randomness: float = 0.7, randomness_decline: float = 0.95, max_moves: int = 80,
-                 table: str = c.DEFAULT_TABLE) -> None:
+                 table: str = c.DEFAULT_TABLE, aggregate: bool = False, backend: str = c.DATABASE_BACKEND,
+                 writer: Optional[ExampleWriter] = None, stockfish: Optional[Stockfish] = None) -> None:
     """
     Generates training examples using Stockfish and stores them in a database in algebraic notation. Set up a MySQL 
-    database first and set the connection in constants.py. Also make sure that Stockfish is installed correctly.
+    database first and set the connection in constants.py, or use the SQLite backend. Also make sure that Stockfish is
+    installed correctly.
 
     :param table: Table the data is stored in.
     :param randomness: Starting Probability for proceeding with are random move instead of the best move. This is
@@ -26,9 +28,15 @@ def gen_examples(randomness: float = 0.7, randomness_decline: float = 0.95, max_
     :param randomness_decline: Factor applied to the randomness with each move. Should be less than 1 to have less 
         randomness later in the game.
     :param max_moves: Stops the simulated game early to prevent too long end games.
+    :param aggregate: Stores the examples in a position store, which keeps the targets of repeated positions, see
+        Connector.insert_positions(). Otherwise repeated positions are skipped.
+    :param backend: Database backend, 'mysql' or 'sqlite'
+    :param writer: Queues the examples in a background writer instead of inserting them with a new connection, table,
+        aggregate and backend are then taken from the writer. See gen_games().
+    :param stockfish: Running Stockfish instance, a new one is started if None
     """
     game = Game()
-    stockfish = Stockfish(c.STOCKFISH_PATH)
+    stockfish = stockfish or Stockfish(c.STOCKFISH_PATH)
     examples = []
     moves = []
     for _ in range(max_moves):
@@ -37,40 +45,59 @@ def gen_examples(randomness: float = 0.7, randomness_decline: float = 0.95, max_
 
         value = _value(stockfish.get_evaluation())
         if best_move:
-            examples.append((_truncate_fen(stockfish.get_fen_position()), (best_move[:4], value)))
+            examples.append((_truncate_fen(game.state.to_fen()), (best_move, value)))
 
         if best_move and random.random() > randomness:
-            move_alg = best_move
-            move_tuple = _from_algebraic(move_alg)
+            move_tuple = from_algebraic(best_move)
         else:
-            move_tuple = random.sample(game.game_legal_moves(), 1)[0]
-            move_alg = _to_algebraic(move_tuple)
+            move_tuple = _random_move(game.state)
 
-        if len(move_alg) == 5:
-            print('pawn promotion')
-
-        try:
-            game.make_move(move_tuple[0], move_tuple[1])
-            moves.append(move_alg)
-        except ValueError:
-            moves[-1] = moves[-1] + 'q'
-            print(examples)
+        game.make_move(*move_tuple)
+        moves.append(to_algebraic(move_tuple))
 
         randomness *= randomness_decline
 
         if game.game_winner():
             break
-    db = Connector()
-    db.insert_examples(examples, table)
+    if writer:
+        writer.put(examples)
+        return
+    db = Connector(backend)
+    if aggregate:
+        db.insert_positions(examples, table)
+    else:
+        db.insert_examples(examples, table)
+
+
+def gen_games(games: int, randomness: float = 0.7, randomness_decline: float = 0.95, max_moves: int = 80,
+              table: str = c.DEFAULT_TABLE, aggregate: bool = False, backend: str = c.DATABASE_BACKEND) -> None:
+    """
+    Runs gen_examples() for a number of games with one Stockfish instance. The examples are written by an
+    ExampleWriter in the background, which inserts the examples of many games at once over a single connection while
+    the next games are generated.
+
+    :param games: Number of games, see gen_examples() for the other parameters
+    """
+    stockfish = Stockfish(c.STOCKFISH_PATH)
+    with ExampleWriter(table, aggregate, backend) as writer:
+        for i in range(games):
+            gen_examples(randomness, randomness_decline, max_moves, writer=writer, stockfish=stockfish)
+            sys.stdout.write(f'\rgame: {i + 1}/{games}')
+            sys.stdout.flush()
+    print('')
 
 
 def train(table: str = c.DEFAULT_TABLE, model_name: str = c.DEFAULT_MODEL_NAME,
           learning_rate: float = c.DEFAULT_LEARNING_RATE, epochs: int = c.DEFAULT_EPOCHS,
           batch_size: int = c.DEFAULT_BATCH_SIZE, matches: int = 10,
-          threshold: int = c.DEFAULT_THRESHOLD, data_limit: Optional[int] = 50000) -> None:
+          threshold: int = c.DEFAULT_THRESHOLD, data_limit: Optional[int] = 50000, gating: str = c.DEFAULT_GATING,
+          sprt: Optional[SPRT] = None, max_matches: int = c.DEFAULT_SPRT_MAX_MATCHES,
+          aggregate: bool = False, backend: str = c.DATABASE_BACKEND) -> None:
     """
     Trains the network with stored example sin the database. Before saving the new weights, the new network simulates
     a series of game vs. the old network, only accepting the new network if a certain number of matches is won.
+    With gating='sprt' the series is stopped as soon as a sequential probability ratio test decides whether the new
+    network is stronger, and the match log is saved next to the weights.
     
     :param table: Database table were examples were stored with gen_examples(). 
     :param model_name: Determines the save folder for the weights of the neural network.
@@ -80,67 +107,99 @@ def train(table: str = c.DEFAULT_TABLE, model_name: str = c.DEFAULT_MODEL_NAME,
     :param matches: Number of matches simulated to test the new network
     :param threshold: Minimum difference of wins and losses from the matches to accept the new network.   
     :param data_limit: Number of examples used to train. Examples are drawn uniformly. None for no limit.
+    :param gating: 'fixed' plays a fixed number of matches and compares the score with the threshold, 'sprt' uses
+        a sequential test.
+    :param sprt: Test used with gating='sprt', a test with the default hypotheses is created if None.
+    :param max_matches: Maximum number of matches simulated with gating='sprt'. The new network is rejected if the
+        test is still undecided after these matches.
+    :param aggregate: Reads from a position store created with gen_examples(aggregate=True). The network is trained
+        on the average values and the move frequencies of the positions.
+    :param backend: Database backend, 'mysql' or 'sqlite'
     """
     new_net = NNet(learning_rate=learning_rate, epochs=epochs, batch_size=batch_size, model_name=model_name)
     old_net = NNet(model_name=model_name)
-    db = Connector()
-    examples = _df_to_examples(db.get_data(data_limit, table))
+    db = Connector(backend)
+    examples = db.to_examples(db.get_positions(data_limit, table) if aggregate else db.get_data(data_limit, table))
     new_net.train(examples)
-    score = _match_series(nnet1=new_net, nnet2=old_net, matches=matches)
-    _evaluate_score(new_net, score, model_name, threshold)
+    _gate(new_net, old_net, gating, matches, threshold, sprt, max_matches)
+
+
+def _gate(new_net: NNet, old_net: NNet, gating: str, matches: int, threshold: int, sprt: Optional[SPRT],
+          max_matches: int) -> bool:
+    # saves the weights of the new network and returns True if it is accepted
+    if gating == 'sprt':
+        sprt = _sprt_match_series(nnet1=new_net, nnet2=old_net, sprt=sprt or SPRT(), max_matches=max_matches)
+        return _evaluate_sprt(new_net, sprt)
+    if gating == 'fixed':
+        score = _match_series(nnet1=new_net, nnet2=old_net, matches=matches)
+        return _evaluate_score(new_net, score, threshold)
+    raise ValueError(f'Unknown gating mode: {gating}')
 
 
 def _match_series(nnet1: NNet, nnet2: NNet, matches: int = 20) -> int:
-    score = 0
-    for i in range(int(matches / 2)):
-        score += _fast_match(nnet1, nnet2)
-        score += _fast_match(nnet2, nnet1) * -1
-        sys.stdout.write(f'\rmatch: {(i + 1) * 2}/{matches}, score: {score}')
-        sys.stdout.flush()
-    print('')
+    # the matches of each color are played in lockstep, see matches.fast_matches()
+    score = sum(fast_matches(nnet1, nnet2, int(matches / 2)))
+    score -= sum(fast_matches(nnet2, nnet1, int(matches / 2)))
+    print(f'matches: {int(matches / 2) * 2}, score: {score}')
     return score
 
 
-def _fast_match(nnet1: NNet, nnet2: NNet) -> int:
-    game = Game()
-    for _ in range(160):
-        nn = nnet1 if game.state.player == 'white' else nnet2
-        move = ai.move_weighted(game.state, nn)
-        game.make_move(move[0], move[1])
-        if game.state.winner:
-            if game.state.winner == 'draw':
-                return 0
-            else:
-                return 1 if game.state.winner == 'white' else -1
-    return 0
+def _sprt_match_series(nnet1: NNet, nnet2: NNet, sprt: SPRT, max_matches: int) -> SPRT:
+    # results are recorded in pairs, so both networks played each color equally often when the test stops
+    for _ in range(int(max_matches / 2)):
+        sprt.add_result(fast_match(nnet1, nnet2), color='white')
+        sprt.add_result(fast_match(nnet2, nnet1) * -1, color='black')
+        elo, lower, upper = sprt.elo()
+        sys.stdout.write(f'\rmatch: {sprt.games}/{max_matches}, +{sprt.wins} ={sprt.draws} -{sprt.losses}, '
+                         f'elo: {elo:.0f} [{lower:.0f}, {upper:.0f}], llr: {sprt.llr():.2f} '
+                         f'[{sprt.lower_bound:.2f}, {sprt.upper_bound:.2f}]')
+        sys.stdout.flush()
+        if sprt.status():
+            break
+    print('')
+    return sprt
 
 
-def _to_algebraic(move: tuple) -> str:
-    return "".join((chr(ord('`') + move[0][1] + 1), str(c.ROWS - move[0][0]),
-                    chr(ord('`') + move[1][1] + 1), str(c.ROWS - move[1][0])))
+def _random_move(state: State) -> tuple:
+    # the squares are chosen first, so that a promotion is not four times as likely as any other move
+    moves = {}
+    for move in sorted(Game.get_legal_moves(state)):
+        moves.setdefault(move[:2], []).append(move)
+    options = moves[random.choice(list(moves))]
+    if len(options) == 1:
+        return options[0]
+    if random.random() < c.RANDOM_UNDERPROMOTION_RATE:
+        return random.choice([move for move in options if move[2] != 'queen'])
+    return next(move for move in options if move[2] == 'queen')
 
 
-def _from_algebraic(algebraic: str) -> tuple:
-    alg = list(algebraic)
-    return (c.ROWS - int(alg[1]), ord(alg[0]) - 97), (c.ROWS - int(alg[3]), ord(alg[2]) - 97)
+def _evaluate_score(nnet: NNet, score: int, threshold: int) -> bool:
+    if score > threshold:
+        nnet.save_weights()
+        print(f'new model accepted with score: {score}')
+        return True
+    print(f'new model rejected with score: {score}')
+    return False
 
 
-def _df_to_examples(df: pd.DataFrame) -> list:
-    examples = []
-    for entry in df.to_dict('records'):
-        state = State(entry['state'])
-        move = _from_algebraic(entry['move'])
-        value = entry['val']
-        examples.append((state, (move, value)))
-    return examples
+def _evaluate_sprt(nnet: NNet, sprt: SPRT) -> bool:
+    summary = sprt.summary()
+    elo, (lower, upper) = summary['elo'], summary['elo_interval']
+    if summary['status'] == 'accepted':
+        nnet.save_weights()
+        print(f'new model accepted after {sprt.games} matches with elo: {elo:.0f} [{lower:.0f}, {upper:.0f}]')
+    else:
+        print(f"new model {'rejected' if summary['status'] else 'undecided'} after {sprt.games} matches "
+              f"with elo: {elo:.0f} [{lower:.0f}, {upper:.0f}]")
+    _save_match_log(summary, nnet.model_name)
+    return summary['status'] == 'accepted'
 
 
-def _evaluate_score(nnet: NNet, score: int, model_name: str, threshold: int) -> None:
-    if score > threshold:
-        nnet.model.save_weights(f'{parent_dir}\\weights\\{model_name}\\')
-        print(f'new model accepted with score: {score}')
-    else:
-        print(f'new model rejected with score: {score}')
+def _save_match_log(summary: dict, model_name: str) -> None:
+    directory = NNet.weights_path(model_name)
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, 'match_log.json'), 'w') as file:
+        json.dump(summary, file, indent=2)
 
 
 def _value(evaluation: dict) -> float:
@@ -1,117 +1,159 @@
-import copy
 import unittest
+import os
+import tempfile
+import json
+import asyncio
+import urllib.error
+import io
+import math
+import random
+from unittest import mock
+import numpy as np
+import pandas as pd
 from core.game import Game, State
 from core import trainer
+from core import ai
 from core.neural_network import NNet
+from core import quantized_network
+from core.sprt import SPRT
+from core.self_play import ReplayBuffer, SelfPlayPipeline, play_games
+from core import self_play
+from core.book import OpeningBook, encode_move, decode_move
+from core.tablebase import Tablebase
+from core.evaluation import evaluate
+from core.db_connector import Connector, ExampleWriter
+from core import db_connector
+from core import instrumentation
+from core import benchmark
+from core import server
+from core import analysis
+from core import notation
 from core import constants as c
 
 
 class TestImportPosition(unittest.TestCase):
     def setUp(self):
         self.state = State(c.DEFAULT_POSITION)
-        self.state.board = [['empty' for _ in range(8)] for _ in range(8)]
-        self.state.pieces = {piece: set() for piece in c.WHITE_PIECES + c.BLACK_PIECES}
+        self.state.board = bytearray(64)
 
     def test__get_piece(self):
         self.assertEqual(self.state._get_piece('n'), 'black_knight')
 
     def test__add_piece(self):
-        state, pieces = self.state._add_piece('black_queen', self.state.board, self.state.pieces, 1, 2)
-        self.assertEqual(state[1][2], 'black_queen')
-        self.assertEqual(pieces['black_queen'], {(1, 2)})
+        self.state.board = self.state._add_piece('black_queen', self.state.board, 1, 2)
+        self.assertEqual(self.state.entry((1, 2)), 'black_queen')
+        self.assertEqual(self.state.pieces['black_queen'], {(1, 2)})
+
+    def test_copy(self):
+        state = State(c.DEFAULT_POSITION)
+        copied = state.copy()
+        copied.set_entry((6, 4), 'empty')
+        copied.castle_rights = 0
+        self.assertEqual(state.entry((6, 4)), 'white_pawn')
+        self.assertEqual(state.castle_rights, 15)
+        self.assertFalse(hasattr(state, '__dict__'))
 
     def test_import_caste_rights(self):
-        self.assertDictEqual(
-            self.state._import_castle_rights('Kq'),
-            {'white_king_side': True, 'white_queen_side': False, 'black_king_side': False, 'black_queen_side': True}
-        )
-        self.assertDictEqual(
-            self.state._import_castle_rights('-'),
-            {'white_king_side': False, 'white_queen_side': False, 'black_king_side': False, 'black_queen_side': False}
-        )
+        self.assertEqual(self.state._import_castle_rights('Kq'), c.WHITE_KING_SIDE | c.BLACK_QUEEN_SIDE)
+        self.assertEqual(self.state._import_castle_rights('-'), 0)
+
+    def test_fen(self):
+        fen = 'rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3'
+        state = State(fen)
+        self.assertEqual(state.en_passant, (3, 5))
+        self.assertEqual((state.halfmove_clock, state.fullmove_number), (0, 3))
+        self.assertEqual(state.to_fen(), fen)
+        self.assertEqual(State(c.DEFAULT_POSITION).to_fen(), c.DEFAULT_POSITION)
+
+    def test_fen_clocks(self):
+        game = Game()
+        for move in (((7, 6), (5, 5)), ((0, 6), (2, 5)), ((6, 4), (4, 4))):
+            game.make_move(move[0], move[1])
+        self.assertEqual(game.state.to_fen(), 'rnbqkb1r/pppppppp/5n2/8/4P3/5N2/PPPP1PPP/RNBQKB1R b KQkq - 0 2')
+        game.make_move((0, 1), (2, 2))
+        self.assertEqual((game.state.halfmove_clock, game.state.fullmove_number), (1, 3))
+
+    def test_fifty_move_rule(self):
+        game = Game('7k/8/8/8/8/8/8/K6R w - - 99 80')
+        game.make_move((7, 7), (6, 7))
+        self.assertEqual(game.state.winner, 'draw')
+        game = Game('k7/8/1K6/8/8/8/8/7R w - - 99 80')
+        game.make_move((7, 7), (0, 7))
+        self.assertEqual(game.state.winner, 'white')
 
 
 class TestUpdatePosition(unittest.TestCase):
     def setUp(self):
         self.game = Game()
         self.state = State(c.EMPTY_BOARD)
-        self.state.castle_rights = {'white_king_side': True, 'white_queen_side': True,
-                                    'black_king_side': True, 'black_queen_side': True}
-
-        self.state.board[1][3] = 'white_pawn'
-        self.state.board[7][6] = 'white_pawn'
-        self.state.board[2][3] = 'black_queen'
-        self.state.board[7][7] = 'white_rook'
-        self.state.board[1][2] = 'black_pawn'
-        self.state.board[7][4] = 'white_king'
-
-        self.state.pieces['white_pawn'].add((1, 3))
-        self.state.pieces['white_pawn'].add((7, 6))
-        self.state.pieces['black_queen'].add((2, 3))
-        self.state.pieces['white_rook'].add((7, 7))
-        self.state.pieces['black_pawn'].add((1, 2))
-        self.state.pieces['white_king'].add((7, 4))
+        self.state.castle_rights = c.WHITE_KING_SIDE | c.WHITE_QUEEN_SIDE | c.BLACK_KING_SIDE | c.BLACK_QUEEN_SIDE
+
+        self.state.set_entry((1, 3), 'white_pawn')
+        self.state.set_entry((7, 6), 'white_pawn')
+        self.state.set_entry((2, 3), 'black_queen')
+        self.state.set_entry((7, 7), 'white_rook')
+        self.state.set_entry((1, 2), 'black_pawn')
+        self.state.set_entry((7, 4), 'white_king')
 
     def test_move1(self):
         state = self.game.move(self.state, (2, 3), (1, 3))
-        self.assertEqual(state.board[1][3], 'black_queen')
-        self.assertEqual(state.board[2][3], 'empty')
+        self.assertEqual(state.entry((1, 3)), 'black_queen')
+        self.assertEqual(state.entry((2, 3)), 'empty')
         self.assertSetEqual(state.pieces['black_queen'], {(1, 3)})
         self.assertSetEqual(state.pieces['white_pawn'], {(7, 6)})
         self.assertEqual(state.en_passant, None)
-        self.assertDictEqual(state.castle_rights, self.state.castle_rights)
+        self.assertEqual(state.castle_rights, self.state.castle_rights)
 
     def test_move2(self):
         state = self.game.move(self.state, (1, 3), (3, 3))
-        self.assertEqual(state.board[3][3], 'white_pawn')
-        self.assertEqual(state.board[1][3], 'empty')
-        self.assertEqual(state.board[2][3], 'black_queen')
+        self.assertEqual(state.entry((3, 3)), 'white_pawn')
+        self.assertEqual(state.entry((1, 3)), 'empty')
+        self.assertEqual(state.entry((2, 3)), 'black_queen')
         self.assertSetEqual(state.pieces['black_queen'], {(2, 3)})
         self.assertSetEqual(state.pieces['white_pawn'], {(7, 6), (3, 3)})
         self.assertEqual(state.en_passant, (3, 3))
-        self.assertDictEqual(state.castle_rights, self.state.castle_rights)
+        self.assertEqual(state.castle_rights, self.state.castle_rights)
 
     def test_move3(self):
         state = self.game.move(self.state, (7, 7), (7, 6))
-        self.assertEqual(state.castle_rights,
-                         {'white_king_side': False, 'white_queen_side': True,
-                          'black_king_side': True, 'black_queen_side': True}
-                         )
+        self.assertEqual(state.castle_rights, c.WHITE_QUEEN_SIDE | c.BLACK_KING_SIDE | c.BLACK_QUEEN_SIDE)
 
     def test_move_en_passant(self):
         state = self.game.move(self.state, (1, 3), (2, 2))
-        self.assertEqual(state.board[2][2], 'white_pawn')
-        self.assertEqual(state.board[1][2], 'empty')
+        self.assertEqual(state.entry((2, 2)), 'white_pawn')
+        self.assertEqual(state.entry((1, 2)), 'empty')
         self.assertSetEqual(state.pieces['black_pawn'], set())
 
     def test_move_castling(self):
         state = self.game.move(self.state, (7, 4), (7, 6))
-        self.assertEqual(state.board[7][5], 'white_rook')
-        self.assertEqual(state.board[7][7], 'empty')
+        self.assertEqual(state.entry((7, 5)), 'white_rook')
+        self.assertEqual(state.entry((7, 7)), 'empty')
         self.assertSetEqual(state.pieces['white_rook'], {(7, 5)})
         self.assertEqual(state.player, 'black')
 
     def test_move_promotion(self):
         state = self.game.move(self.state, (1, 3), (0, 3))
-        self.assertEqual(state.board[0][3], 'white_queen')
+        self.assertEqual(state.entry((0, 3)), 'white_queen')
         self.assertSetEqual(state.pieces['white_queen'], {(0, 3)})
         self.assertSetEqual(state.pieces['white_pawn'], {(7, 6)})
 
+    def test_move_underpromotion(self):
+        state = self.game.move(self.state, (1, 3), (0, 3), 'knight')
+        self.assertEqual(state.entry((0, 3)), 'white_knight')
+        moves = self.game.get_legal_moves(self.state)
+        self.assertIn(((1, 3), (0, 3), 'rook'), moves)
+        self.assertNotIn(((1, 3), (0, 3)), moves)
+
 
 class TestGetLegalMoves(unittest.TestCase):
     def setUp(self):
         self.game = Game()
         self.state = State(c.EMPTY_BOARD)
 
-        self.state.board[1][2] = 'white_knight'
-        self.state.board[5][7] = 'black_knight'
-        self.state.board[3][3] = 'white_pawn'
-        self.state.board[3][4] = 'black_king'
-
-        self.state.pieces['white_knight'].add((1, 2))
-        self.state.pieces['black_knight'].add((5, 7))
-        self.state.pieces['white_pawn'].add((3, 3))
-        self.state.pieces['black_king'].add((3, 4))
+        self.state.set_entry((1, 2), 'white_knight')
+        self.state.set_entry((5, 7), 'black_knight')
+        self.state.set_entry((3, 3), 'white_pawn')
+        self.state.set_entry((3, 4), 'black_king')
 
     def test_knight(self):
         self.assertSetEqual(self.game._get_normal_moves('white_knight', (1, 2), self.state),
@@ -126,24 +168,75 @@ class TestGetLegalMoves(unittest.TestCase):
         self.assertIn(((3, 4), (2, 4)), self.game._get_pseudolegal_moves(self.state))
         self.assertNotIn(((3, 4), (2, 4)), self.game.get_legal_moves(self.state))
 
+    def test_has_legal_move(self):
+        self.assertTrue(self.game.has_legal_move(Game().state))
+        self.assertSetEqual(set(self.game.iter_legal_moves(self.state)), self.game.get_legal_moves(self.state))
+        mate = State('rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3')
+        self.assertFalse(self.game.has_legal_move(mate))
+        self.assertEqual(self.game.get_winner(mate), 'black')
+        stalemate = State('7k/5Q2/6K1/8/8/8/8/8 b - - 0 1')
+        self.assertFalse(self.game.has_legal_move(stalemate))
+        self.assertEqual(self.game.get_winner(stalemate), 'draw')
+
+    def test_move_cache(self):
+        state = Game().state
+        self.assertTrue(self.game.has_legal_move(state))
+        self.assertEqual(len(state.move_cache.moves), 1)
+        self.assertEqual(len(self.game.get_legal_moves(state)), 20)
+        self.assertIs(state.copy().move_cache, state.move_cache)
+        state.swap_player()
+        self.assertEqual(len(self.game.get_legal_moves(state)), 20)
+        self.assertTrue(all(move[0][0] < 2 for move in self.game.get_legal_moves(state)))
+        # new states keep the check status, but no suspended generation
+        new_state = Game.move(Game().state, (6, 4), (4, 4))
+        self.assertIsNone(new_state.move_cache.pending)
+        self.assertFalse(new_state.move_cache.check)
+        self.assertEqual(len(self.game.get_legal_moves(new_state)), 20)
+        # changes of the board drop the cache, also while moves are generated from the snapshot
+        moves = self.game.iter_legal_moves(new_state)
+        first = next(moves)
+        new_state.set_entry((1, 4), 'empty')
+        self.assertIsNone(new_state.move_cache)
+        self.assertEqual(len([first, *moves]), 20)
+        self.assertEqual(len(self.game.get_legal_moves(new_state)), 29)
+        self.state.player = 'black'
+        self.assertFalse(self.game.is_check(self.state))
+        self.state.set_entry((3, 7), 'white_rook')
+        self.assertTrue(self.game.is_check(self.state))
+
     def test_repetition(self):
-        old_state = State(c.DEFAULT_POSITION)
-        new_state = State(c.DEFAULT_POSITION)
-        Game._add_repetition(new_state, old_state)
-        old_state = copy.deepcopy(new_state)
-        Game._add_repetition(new_state, old_state)
-        old_state = copy.deepcopy(new_state)
-        Game._add_repetition(new_state, old_state)
-        print(new_state.repetition_counter)
-        self.assertEqual(new_state.winner, 'draw')
+        game = Game()
+        for _ in range(2):
+            for move in (((7, 6), (5, 5)), ((0, 6), (2, 5)), ((5, 5), (7, 6)), ((2, 5), (0, 6))):
+                self.assertIsNone(game.state.winner)
+                game.make_move(move[0], move[1])
+        self.assertEqual(game.state.winner, 'draw')
+
+    def test_repetition_reset(self):
+        game = Game()
+        for move in (((7, 6), (5, 5)), ((0, 6), (2, 5)), ((5, 5), (7, 6)), ((2, 5), (0, 6)), ((6, 0), (5, 0))):
+            game.make_move(move[0], move[1])
+        self.assertIsNone(game.state.history.previous)
+        self.assertEqual(game.state.history.count(), 1)
 
 
 class TestConversions(unittest.TestCase):
-    def test__to_algebraic(self):
-        self.assertEqual(trainer._to_algebraic(((0, 1), (2, 3))), 'b8d6')
+    def test_to_algebraic(self):
+        self.assertEqual(notation.to_algebraic(((0, 1), (2, 3))), 'b8d6')
+        self.assertEqual(notation.to_algebraic(((6, 0), (7, 1), 'knight')), 'a2b1n')
+
+    def test__random_move(self):
+        # five king moves and a promotion with four pieces
+        state = State('4k3/1P6/8/8/8/8/8/4K3 w - - 0 1')
+        random.seed(0)
+        moves = [trainer._random_move(state) for _ in range(3000)]
+        promotions = [move for move in moves if len(move) == 3]
+        self.assertAlmostEqual(len(promotions) / len(moves), 1 / 6, delta=0.03)
+        self.assertGreater(sum(move[2] == 'queen' for move in promotions) / len(promotions), 0.8)
 
-    def test__from_algebraic(self):
-        self.assertEqual(trainer._from_algebraic('b8d6'), ((0, 1), (2, 3)))
+    def test_from_algebraic(self):
+        self.assertEqual(notation.from_algebraic('b8d6'), ((0, 1), (2, 3)))
+        self.assertEqual(notation.from_algebraic('a2b1n'), ((6, 0), (7, 1), 'knight'))
 
     def test_policy1(self):
         state = State(c.DEFAULT_POSITION)
@@ -156,11 +249,499 @@ class TestConversions(unittest.TestCase):
         move = ((1, 2), (3, 2))
         self.assertEqual(NNet._get_policy(NNet._to_policy_vector(move, 'black'), game.state)[move], 1)
 
+    def test_policy_indices(self):
+        game = Game()
+        game.make_move((6, 4), (4, 4))
+        moves, indices = Game.get_legal_move_indices(game.state)
+        self.assertListEqual(list(indices), [NNet._policy_index(move, 'black') for move in moves])
+        self.assertEqual(Game.get_legal_mask(game.state).sum(), 20)
+
+    def test_underpromotion_indices(self):
+        state = State('8/2P5/8/8/8/8/8/k1K5 w - - 0 1')
+        moves, indices = Game.get_legal_move_indices(state, underpromotions=True)
+        self.assertEqual(len(set(indices)), len(moves))
+        self.assertTrue(all(index < c.UNDERPROMOTION_POLICY_SIZE for index in indices))
+        moves, indices = Game.get_legal_move_indices(state)
+        self.assertIn(((1, 2), (0, 2), 'queen'), moves)
+        self.assertNotIn(((1, 2), (0, 2), 'knight'), moves)
+
+    def test_batch_policies(self):
+        game = Game()
+        game.make_move((6, 4), (4, 4))
+        states = [State(c.DEFAULT_POSITION), game.state]
+        policies = np.random.rand(2, c.POLICY_SIZE)
+        for policy, state, batch_policy in zip(policies, states, NNet._get_policies(policies, states)):
+            self.assertEqual(batch_policy.keys(), NNet._get_policy(policy, state).keys())
+            for move, probability in NNet._get_policy(policy, state).items():
+                self.assertAlmostEqual(batch_policy[move], probability)
+
+    def test_policy_edge_cases(self):
+        mate = State('rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3')
+        self.assertDictEqual(NNet._get_policy(np.random.rand(c.POLICY_SIZE), mate), {})
+        policies = NNet._get_policies(np.zeros((2, c.POLICY_SIZE), dtype=np.float32),
+                                      [State(c.DEFAULT_POSITION), mate])
+        self.assertEqual(len(policies[0]), 20)
+        for probability in policies[0].values():
+            self.assertAlmostEqual(probability, 1 / 20)
+        self.assertDictEqual(policies[1], {})
+
+    def test_policy_distribution(self):
+        policy = NNet._to_policy_vector({((6, 2), (4, 2)): 0.75, ((6, 3), (4, 3)): 0.25}, 'white')
+        self.assertAlmostEqual(policy.sum(), 1)
+        self.assertEqual(policy[NNet._policy_index(((6, 2), (4, 2)), 'white')], 0.75)
+
     def test_prediction(self):
         nn = NNet()
         state = State(c.DEFAULT_POSITION)
         self.assertIsInstance(nn.prediction(state), tuple)
 
+    def test_input_planes(self):
+        game = Game()
+        game.state.track_planes()
+        for move in (((6, 4), (4, 4)), ((1, 0), (3, 0)), ((4, 4), (3, 4)), ((1, 3), (3, 3)), ((3, 4), (2, 3))):
+            game.make_move(*move)
+            untracked = game.state.copy(planes=False)
+            self.assertTrue(np.array_equal(NNet._to_binary_state(game.state), NNet._to_binary_state(untracked)))
+
+    def test_architecture(self):
+        nn = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1, 'squeeze_excitation': 4})
+        self.assertEqual(nn.architecture['filters'], 8)
+        self.assertEqual(nn.architecture['value_filters'], c.DEFAULT_ARCHITECTURE['value_filters'])
+        self.assertLess(nn.model.count_params(), NNet(load_data=False).model.count_params())
+        policy, value = nn.prediction(State(c.DEFAULT_POSITION))
+        self.assertAlmostEqual(sum(policy.values()), 1, places=5)
+
+    def test_architecture_mismatch(self):
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(NNet, 'weights_path', staticmethod(
+                lambda model_name: os.path.join(directory, model_name, ''))), mock.patch('builtins.print') as output:
+            os.makedirs(NNet.weights_path('small'))
+            with open(os.path.join(NNet.weights_path('small'), 'architecture.json'), 'w') as file:
+                json.dump({'filters': 8, 'blocks': 1}, file)
+            with self.assertRaises(ValueError):
+                NNet(model_name='small', architecture={'filters': 16})
+            # without weight files only the stored architecture is used
+            self.assertEqual(NNet(model_name='small').architecture['filters'], 8)
+            self.assertEqual(output.call_args.args[0], 'No saved weights found')
+            # weight files which cannot be loaded are reported instead of being taken as missing
+            with open(os.path.join(NNet.weights_path('small'), 'checkpoint'), 'w') as file:
+                file.write('broken')
+            NNet(model_name='small')
+            self.assertIn('may not fit the architecture', output.call_args.args[0])
+
+    def test_inference_only(self):
+        nn = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1}, inference_only=True)
+        state = State(c.DEFAULT_POSITION)
+        self.assertIsInstance(nn.prediction(state), tuple)
+        with self.assertRaises(ValueError):
+            nn.train([(state, (((6, 2), (4, 2)), 0.3))])
+
+
+class TestQuantizedNetwork(unittest.TestCase):
+    def test_export(self):
+        nn = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1})
+        states = quantized_network.random_states(4, max_moves=20)
+        with tempfile.TemporaryDirectory() as directory:
+            path = classmethod(lambda cls, model_name, mode: os.path.join(directory, f'{mode}.tflite'))
+            # quantized_network imports the module as neural_network, not core.neural_network
+            with mock.patch.object(NNet, 'quantized_path', path), \
+                    mock.patch.object(quantized_network.NNet, 'quantized_path', path):
+                for mode in ('float16', 'int8'):
+                    nn.export_quantized(mode, representative_states=states)
+                    quantized = quantized_network.QuantizedNNet(nn.model_name, mode)
+                    for (policy, value), (quantized_policy, quantized_value) in zip(nn.predictions(states),
+                                                                                    quantized.predictions(states)):
+                        self.assertSetEqual(set(policy), set(quantized_policy))
+                        self.assertAlmostEqual(sum(quantized_policy.values()), 1, places=5)
+                        self.assertAlmostEqual(float(value), float(quantized_value), delta=0.05)
+                        if mode == 'float16':
+                            for move, probability in policy.items():
+                                self.assertAlmostEqual(probability, quantized_policy[move], delta=1e-4)
+                    self.assertSetEqual(set(quantized.prediction(states[0])[0]), set(nn.prediction(states[0])[0]))
+
+
+class TestSPRT(unittest.TestCase):
+    def test_accept(self):
+        sprt = SPRT(elo0=0, elo1=50)
+        while not sprt.status():
+            sprt.add_result(1)
+        self.assertEqual(sprt.status(), 'accepted')
+        self.assertLess(sprt.games, 20)
+
+    def test_reject(self):
+        sprt = SPRT(elo0=0, elo1=50)
+        while not sprt.status():
+            sprt.add_result(-1)
+        self.assertEqual(sprt.status(), 'rejected')
+
+    def test_elo(self):
+        sprt = SPRT()
+        for result in (1, -1, 0, 0):
+            sprt.add_result(result, color='white')
+        elo, lower, upper = sprt.elo()
+        self.assertAlmostEqual(elo, 0)
+        self.assertLess(lower, 0)
+        self.assertGreater(upper, 0)
+        self.assertEqual(sprt.log[0], {'game': 1, 'result': 1, 'color': 'white'})
+
+
+class TestReplayBuffer(unittest.TestCase):
+    def test_capacity(self):
+        buffer = ReplayBuffer(capacity=5)
+        buffer.add_game(list(range(3)))
+        buffer.add_game(list(range(3, 7)))
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(buffer.games, 2)
+        self.assertEqual(set(buffer.sample(10)), {2, 3, 4, 5, 6})
+        self.assertTrue(buffer.wait_for_games(2))
+
+    def test_play_games(self):
+        nn = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1})
+        games = list(play_games(nn, games=3, parallel=2, move_number=2, depth=1, max_moves=4))
+        self.assertEqual(len(games), 3)
+        self.assertTrue(all(0 < len(examples) <= 4 for examples in games))
+        self.assertAlmostEqual(sum(games[0][0][1][0].values()), 1, places=5)
+
+    def test_pipeline_error(self):
+        pipeline = SelfPlayPipeline.__new__(SelfPlayPipeline)
+        pipeline.buffer = ReplayBuffer(10)
+        pipeline.games_per_iteration = 1
+        pipeline.parallel, pipeline.move_number, pipeline.depth, pipeline.temperature, pipeline.max_moves = 1, 1, 1, 1, 1
+        pipeline._generator_net = None
+        pipeline._new_weights = None
+        pipeline._stop = self_play.Event()
+        pipeline._error = None
+        error = ValueError('No legal moves!')
+        with mock.patch.object(self_play, 'play_games', side_effect=error):
+            with self.assertRaises(RuntimeError) as context:
+                pipeline.run(iterations=1)
+        self.assertIs(context.exception.__cause__, error)
+
+    def test_search_policies(self):
+        nn = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1})
+        states = [State(c.DEFAULT_POSITION), Game.move(State(c.DEFAULT_POSITION), (6, 4), (4, 4))]
+        policies = ai.search_policies(states, nn, 3, 2)
+        for state, policy in zip(states, policies):
+            single = ai.search_policy(state, nn, 3, 2)
+            self.assertSetEqual(set(policy), set(single))
+            for move in policy:
+                self.assertAlmostEqual(policy[move], single[move], places=4)
+
+
+class TestPositionStore(unittest.TestCase):
+    def test_aggregate(self):
+        examples = [('fen1', ('e2e4', 0.5)), ('fen1', ('d2d4', 0.25)), ('fen1', ('e2e4', 0.)), ('fen2', ('e7e5', -1))]
+        positions, moves = Connector._aggregate(examples)
+        self.assertListEqual(positions, [('fen1', 3, 0.75), ('fen2', 1, -1.)])
+        self.assertListEqual(moves, [('fen1', 'e2e4', 2), ('fen1', 'd2d4', 1), ('fen2', 'e7e5', 1)])
+
+    def test_positions(self):
+        rows = pd.DataFrame({'state': [c.DEFAULT_POSITION] * 2, 'visits': [4, 4], 'val': [0.3, 0.3],
+                             'move': ['e2e4', 'd2d4'], 'move_visits': [1, 3]})
+        positions = Connector._to_positions(rows)
+        self.assertEqual(len(positions), 1)
+        self.assertEqual(positions['move'][0], 'd2d4')
+        state, (policy, value) = Connector.to_examples(positions)[0]
+        self.assertDictEqual(policy, {((6, 4), (4, 4)): 0.25, ((6, 3), (4, 3)): 0.75})
+
+    def test_sqlite(self):
+        db = Connector('sqlite', ':memory:')
+        db.insert_examples([('fen1', ('e2e4', 0.5)), ('fen1', ('d2d4', 0.)), ('fen2', ('e7e5', -1))], 'examples')
+        self.assertEqual(len(db.get_data(None, 'examples')), 2)
+        db.insert_positions([('fen1', ('e2e4', 0.5)), ('fen1', ('d2d4', 0.))], 'positions')
+        db.insert_positions([('fen1', ('e2e4', 0.25))], 'positions')
+        positions = db.get_positions(None, 'positions')
+        self.assertEqual(positions['visits'][0], 3)
+        self.assertAlmostEqual(positions['val'][0], 0.25)
+        self.assertDictEqual(positions['policy'][0], {'e2e4': 2 / 3, 'd2d4': 1 / 3})
+
+    def test_mysql_move_column(self):
+        # existing MySQL tables are widened for the promotion piece, without a server the queries are only recorded
+        db = Connector.__new__(Connector)
+        db.backend = 'mysql'
+        db.dialect = db_connector._DIALECTS['mysql']
+        with mock.patch.object(db, '_send_query') as send_query:
+            db._create_training_data_table('examples')
+        self.assertEqual(send_query.call_args_list[-1],
+                         mock.call('ALTER TABLE examples MODIFY move VARCHAR(5) NOT NULL;'))
+
+    def test_writer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'test.db')
+            with ExampleWriter('examples', backend='sqlite', path=path, batch_size=3) as writer:
+                writer.put([('fen1', ('e2e4', 0.5)), ('fen2', ('d2d4', 0.))])
+                writer.put([('fen3', ('e7e5', -1)), ('fen4', ('e2e4', 1))])
+                writer.put([('fen5', ('g1f3', 0.1))])
+            self.assertEqual(writer.written, 5)
+            self.assertEqual(len(Connector('sqlite', path).get_data(None, 'examples')), 5)
+
+    def test_writer_error(self):
+        # e.g. a MySQL connection which failed and is None
+        error = AttributeError("'NoneType' object has no attribute 'cursor'")
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(Connector, 'insert_examples', side_effect=error):
+            writer = ExampleWriter('examples', backend='sqlite', path=os.path.join(directory, 'test.db'),
+                                   batch_size=1)
+            writer.put([('fen1', ('e2e4', 0.5))])
+            writer._thread.join(timeout=10)
+            self.assertIs(writer.error, error)
+            self.assertRaises(RuntimeError, writer.put, [('fen2', ('d2d4', 0.))])
+            self.assertRaises(RuntimeError, writer.close)
+
+
+class TestSearch(unittest.TestCase):
+    def test_mate_in_one(self):
+        state = State('k7/8/1K6/8/8/8/8/7R w - - 0 1')
+        self.assertEqual(ai.alpha_beta_search(state, max_depth=2), ((7, 7), (0, 7)))
+
+    def test_material(self):
+        state = State('rnb1kbnr/pppp1ppp/8/4p1q1/3P4/2N5/PPP1PPPP/R1BQKBNR w KQkq - 0 1')
+        self.assertEqual(ai.alpha_beta_search(state, max_depth=2), ((7, 2), (3, 6)))
+        self.assertGreater(Game.move(state, (7, 2), (3, 6)).evaluation - state.evaluation, 800)
+
+    def test_quiescence(self):
+        search = ai._AlphaBeta(None, 'handcrafted', 0, None)
+        # the capture of the rook mates
+        state = State('r6k/6pp/8/8/8/8/8/R5K1 w - - 0 1')
+        moves = Game.get_legal_moves(state)
+        self.assertEqual(search._quiescence(state, moves, -math.inf, math.inf, 2), c.MATE_SCORE - 3)
+        self.assertEqual(search._quiescence(state, moves, -math.inf, 1, 2), 1)
+        # the capture of the rook stalemates, so it does not win the rook
+        state = State('k7/1pK5/1P6/8/4r3/8/8/4R3 w - - 0 1')
+        moves = Game.get_legal_moves(state)
+        self.assertLess(search._quiescence(state, moves, -math.inf, math.inf, 0), 1)
+
+    def test_incremental_evaluation(self):
+        game = Game()
+        for move in (((6, 4), (4, 4)), ((1, 3), (3, 3)), ((4, 4), (3, 3)), ((0, 3), (3, 3)), ((7, 6), (5, 5)),
+                     ((3, 3), (0, 3)), ((7, 5), (6, 4)), ((0, 3), (1, 3)), ((7, 4), (7, 6))):
+            game.make_move(*move)
+            self.assertEqual(game.state.evaluation, evaluate(game.state.board))
+        self.assertEqual(State(c.DEFAULT_POSITION).evaluation, 0)
+
+
+class TestLookup(unittest.TestCase):
+    def test_move_encoding(self):
+        for move in (((6, 4), (4, 4)), ((1, 0), (0, 1), 'knight')):
+            self.assertEqual(decode_move(encode_move(move)), move)
+
+    def test_book(self):
+        state = State(c.DEFAULT_POSITION)
+        entries = [(state, ((6, 4), (4, 4)), 2), (state, ((6, 3), (4, 3)), 1), (state, ((6, 3), (4, 3)), 3)]
+        with tempfile.TemporaryDirectory() as directory, mock.patch.object(OpeningBook, 'path', staticmethod(
+                lambda name: os.path.join(directory, f'{name}.npy'))):
+            book = OpeningBook.build(entries, 'test_book')
+            self.assertTrue(OpeningBook.exists('test_book'))
+            self.assertEqual(book.moves(state), {((6, 4), (4, 4)): 2, ((6, 3), (4, 3)): 4})
+            self.assertEqual(book.move(state), ((6, 3), (4, 3)))
+            self.assertIsNone(book.move(Game.move(state, (6, 4), (4, 4))))
+            # the records are memory-mapped, the file is closed before the directory is removed
+            del book
+
+    def test_tablebase_index(self):
+        tablebase = Tablebase.__new__(Tablebase)
+        tablebase.piece = 'rook'
+        self.assertEqual(tablebase._index(State('k7/8/1K6/8/8/8/8/7R w - - 0 1')),
+                         tablebase._index(State('7r/8/8/8/8/1k6/8/K7 b - - 0 1')))
+        self.assertFalse(tablebase.covers(State(c.DEFAULT_POSITION)))
+
+
+class TestTablebase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.patcher = mock.patch.object(Tablebase, 'path', staticmethod(
+            lambda endgame: os.path.join(cls.directory.name, f'{endgame}.npy')))
+        cls.patcher.start()
+        cls.tablebase = Tablebase.build('KRK')
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.tablebase
+        cls.patcher.stop()
+        cls.directory.cleanup()
+
+    def test_distance_to_mate(self):
+        self.assertEqual(self.tablebase.probe(State('R6k/8/6K1/8/8/8/8/8 b - - 0 1')), ('white', 0))
+        self.assertEqual(self.tablebase.probe(State('k7/8/1K6/8/8/8/8/7R w - - 0 1')), ('white', 1))
+        self.assertEqual(self.tablebase.probe(State('7r/8/8/8/8/1k6/8/K7 b - - 0 1')), ('black', 1))
+        # the longest mate of KRK takes 16 moves
+        self.assertEqual(int(self.tablebase.table[:len(self.tablebase.table) // 2].max()), 31)
+
+    def test_draws(self):
+        # stalemate
+        self.assertEqual(self.tablebase.probe(State('k7/8/K7/8/8/8/8/1R6 b - - 0 1')), ('draw', 0))
+        # the rook can be captured
+        self.assertEqual(self.tablebase.probe(State('k7/1R6/8/8/8/8/8/4K3 b - - 0 1')), ('draw', 0))
+        self.assertEqual(self.tablebase.best_move(State('k7/1R6/8/8/8/8/8/4K3 b - - 0 1')), ((0, 0), (1, 1)))
+
+    def test_best_move(self):
+        state = State('8/8/8/4k3/8/8/8/R3K3 w - - 0 1')
+        winner, distance = self.tablebase.probe(state)
+        self.assertEqual(winner, 'white')
+        while distance > 0:
+            state = Game.move(state, *self.tablebase.best_move(state))
+            self.assertEqual(self.tablebase.probe(state), ('white', distance - 1))
+            distance -= 1
+        self.assertEqual(state.winner, 'white')
+
+
+class TestBenchmark(unittest.TestCase):
+    def test_engine(self):
+        results = benchmark.benchmark_engine(duration=0.01)
+        self.assertSetEqual(set(results), {'legal_moves_per_s', 'moves_per_s', 'encodes_per_s', 'move_encodes_per_s',
+                                           'incremental_move_encodes_per_s'})
+        self.assertTrue(all(rate > 0 for rate in results.values()))
+
+
+class TestServer(unittest.TestCase):
+    def test_requests(self):
+        nn = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1})
+
+        async def run():
+            analysis_server = server.AnalysisServer('untrained', port=0, nnet=nn, batch_window=0.05)
+            await analysis_server.start()
+            loop = asyncio.get_running_loop()
+
+            def send(path, payload=None):
+                return loop.run_in_executor(None, server.request, path, payload, c.SERVER_HOST, analysis_server.port)
+            try:
+                predictions = await asyncio.gather(*[send('/predict', {'moves': moves})
+                                                     for moves in ([], ['e2e4'], ['e2e4', 'e7e5'], ['d2d4'])])
+                search = await send('/search', {'moves': ['e2e4'], 'width': 2, 'depth': 1})
+                errors = []
+                for path, payload in (('/predict', {'moves': ['e2e5']}), ('/predict', ['e2e4']),
+                                      ('/predict', {'moves': 'e2e4'}), ('/search', {'depth': '3'})):
+                    with self.assertRaises(urllib.error.HTTPError) as context:
+                        await send(path, payload)
+                    errors.append(context.exception.code)
+                # a failing prediction is answered instead of dropping the connection
+                with mock.patch.object(nn, 'predictions', side_effect=RuntimeError('no model')), \
+                        self.assertRaises(urllib.error.HTTPError) as context:
+                    await send('/predict', {})
+                errors.append(context.exception.code)
+                status = await send('/status')
+            finally:
+                await analysis_server.stop()
+            return predictions, search, errors, status
+
+        predictions, search, errors, status = asyncio.run(run())
+        self.assertEqual(len(predictions[0]['policy']), 20)
+        self.assertIn('e7e5', predictions[1]['policy'])
+        self.assertTrue(all(0 <= prediction['value'] <= 1 for prediction in predictions))
+        self.assertEqual(len(search['values']), 2)
+        self.assertIn(search['move'], search['values'])
+        self.assertListEqual(errors, [400, 400, 400, 400, 500])
+        self.assertEqual(status['requests'], 11)
+        # the concurrent predictions share batches
+        self.assertLess(status['batches'], status['predictions'])
+
+    def test_reload(self):
+        nn = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1})
+        reloaded = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1})
+
+        async def run():
+            analysis_server = server.AnalysisServer('untrained', port=0, nnet=nn)
+            analysis_server._weights_mtime = lambda: 1.
+            await analysis_server.start()
+            try:
+                for _ in range(200):
+                    if analysis_server.counters['reloads']:
+                        break
+                    await asyncio.sleep(0.01)
+            finally:
+                await analysis_server.stop()
+            return analysis_server
+
+        # the first load fails as if the weights were still being written
+        with mock.patch.object(server.c, 'SERVER_RELOAD_INTERVAL', 0.01), \
+                mock.patch.object(server, 'NNet', side_effect=[OSError('incomplete file'), reloaded]) as loader:
+            analysis_server = asyncio.run(run())
+        self.assertEqual(analysis_server.counters['reloads'], 1)
+        self.assertIs(analysis_server.nnet, reloaded)
+        self.assertEqual(loader.call_count, 2)
+
+
+class TestAnalysis(unittest.TestCase):
+    pgn = """[Event "Test"]
+[Result "1-0"]
+
+1. e4 {best by test} e5 2. Nf3 (2. f4 exf4) Nc6 3. Bb5 $1 a6 4. O-O Nf6
+5. Re1 1-0
+
+[FEN "4k3/1P6/8/8/8/8/8/R3K2R w KQ - 0 1"]
+
+1. b8=N Kf7 2. O-O-O *
+"""
+
+    def test_from_san(self):
+        state = State('r3k2r/1P6/8/8/8/8/8/R3K1NR w KQkq - 0 1')
+        self.assertEqual(analysis.from_san(state, 'Nf3'), ((7, 6), (5, 5)))
+        self.assertEqual(analysis.from_san(state, 'bxa8=Q+'), ((1, 1), (0, 0), 'queen'))
+        self.assertEqual(analysis.from_san(state, 'b8=R'), ((1, 1), (0, 1), 'rook'))
+        self.assertEqual(analysis.from_san(state, 'O-O-O'), ((7, 4), (7, 2)))
+        self.assertEqual(analysis.from_san(state, 'Rb1'), ((7, 0), (7, 1)))
+        self.assertRaises(ValueError, analysis.from_san, state, 'O-O')
+        self.assertRaises(ValueError, analysis.from_san, state, 'Nd5')
+        state = State('4k3/8/8/8/8/8/4K3/R6R w - - 0 1')
+        self.assertRaises(ValueError, analysis.from_san, state, 'Rd1')
+        self.assertEqual(analysis.from_san(state, 'Rhd1'), ((7, 7), (7, 3)))
+
+    def test_pgn_positions(self):
+        positions = list(analysis.iter_pgn_positions(io.StringIO(self.pgn)))
+        self.assertListEqual([info['played'] for info, _ in positions],
+                             ['e2e4', 'e7e5', 'g1f3', 'b8c6', 'f1b5', 'a7a6', 'e1g1', 'g8f6', 'f1e1',
+                              'b7b8n', 'e8f7', 'e1c1'])
+        self.assertEqual(positions[9][0]['game'], 2)
+        self.assertEqual(positions[9][0]['fen'], '4k3/1P6/8/8/8/8/8/R3K2R w KQ - 0 1')
+
+    def test_invalid_fen(self):
+        pgn = '[FEN "4k3/8/8/8/8/8/8/R3K3"]\n\n1. Ra8+ *\n\n' + self.pgn
+        self.assertEqual(len(list(analysis.iter_pgn_positions(io.StringIO(pgn)))), 12)
+        lines = ['rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR', c.DEFAULT_POSITION]
+        self.assertEqual([info['fen'] for info, _ in analysis.iter_fen_positions(lines)], [c.DEFAULT_POSITION])
+
+    def test_analyse(self):
+        nn = NNet(load_data=False, architecture={'filters': 8, 'blocks': 1})
+        lines = [c.DEFAULT_POSITION, '', 'invalid', '4k3/4Q3/4K3/8/8/8/8/8 b - - 0 1', '4k3/8/4K3/8/8/8/8/R7 w - - 0 1',
+                 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR']
+        output = io.StringIO()
+        self.assertEqual(analysis.analyse(analysis.iter_fen_positions(lines), nn, output, batch_size=2, top_k=2), 2)
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertListEqual([result['fen'] for result in results], [lines[0], lines[4]])
+        self.assertEqual(len(results[0]['policy']), 2)
+        self.assertIn(results[0]['move'], results[0]['policy'])
+
+
+class TestInstrumentation(unittest.TestCase):
+    def test_measure(self):
+        stats = instrumentation.Instrumentation()
+        stats.count('moves')
+        with stats.measure() as measured:
+            measured.count('moves', 2)
+            measured.record_inference(8, 0.003)
+            with measured.timer('search'):
+                pass
+        stats.count('moves')
+        report = stats.report()
+        self.assertDictEqual(report['counters'], {'moves': 2, 'inference_states': 8})
+        self.assertEqual(report['timers']['search']['count'], 1)
+        self.assertDictEqual(report['inference']['batch_sizes'], {'8': 1})
+        self.assertEqual(report['inference']['latency_histogram_ms']['<=5'], 1)
+
+    def test_session(self):
+        stats = instrumentation.Instrumentation()
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch.object(instrumentation.c, 'INSTRUMENTATION_DIR', directory):
+                with stats.session('search'):
+                    stats.count('nodes')
+                    with stats.session('inner'):
+                        stats.count('nodes')
+            files = os.listdir(directory)
+            self.assertEqual(len(files), 1)
+            with open(os.path.join(directory, files[0])) as file:
+                self.assertEqual(json.load(file)['counters']['nodes'], 2)
+        self.assertFalse(stats.enabled)
+
 
 if __name__ == '__main__':
     unittest.main()